@@ -0,0 +1,7 @@
+"""Load-test and benchmark suite.
+
+Runs chabi blueprints against local stand-ins of API.AI and Graph API, so
+that throughput and tail latency can be measured without the real services.
+
+    $ python -m bench.run --requests 1000 --concurrency 16
+"""
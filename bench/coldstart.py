@@ -0,0 +1,164 @@
+"""Measure cold start time of chabi imports and app creation in fresh
+interpreters, and report which heavy dependencies each one loads.
+
+    $ python -m bench.coldstart --runs 10
+    $ python -m bench.coldstart --compare bench/results/coldstart-<time>.json
+
+Each target runs in a new process, so module caches of previous runs don't
+count. Times are measured within the process, excluding interpreter start.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+from bench.run import RESULTS_DIR, git_revision, _diff
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('flask', 'jinja2', 'pony', 'requests', 'apiai', 'aiohttp')
+
+APP_STARTUP = '''
+from flask import Flask
+from chabi.vendor import make_vendor
+app = Flask('coldstart')
+make_vendor('facebook', app, 'page_token', 'verify_token')
+make_vendor('apiai', app, 'apiai_token', api_url='http://127.0.0.1:1')
+'''
+
+# target: code to time
+TARGETS = dict(
+    chabi='import chabi',
+    aio='import chabi.aio',
+    vendor_registry='import chabi.vendor',
+    facebook='import chabi.vendor.facebook',
+    apiai='import chabi.vendor.apiai',
+    app_startup=APP_STARTUP,
+)
+
+CHILD = '''
+import sys, json
+from timeit import default_timer
+st = default_timer()
+exec({code!r})
+elapsed = default_timer() - st
+print(json.dumps(dict(elapsed=elapsed, modules=[
+    m for m in {heavy!r} if m in sys.modules])))
+'''
+
+
+def measure_once(code):
+    """Run code in a fresh interpreter.
+
+    Returns:
+        float: Elapsed seconds within the process.
+        list: Heavy modules loaded.
+    """
+    out = subprocess.check_output(
+        [sys.executable, '-c', CHILD.format(code=code, heavy=HEAVY_MODULES)],
+        cwd=ROOT)
+    res = json.loads(out.decode('utf8').strip().splitlines()[-1])
+    return res['elapsed'], res['modules']
+
+
+def measure_target(code, runs):
+    times = []
+    modules = None
+    for _ in range(runs):
+        elapsed, modules = measure_once(code)
+        times.append(elapsed * 1000)
+    times.sort()
+    return dict(runs=runs, min=round(times[0], 1),
+                median=round(times[len(times) // 2], 1),
+                max=round(times[-1], 1), modules=modules)
+
+
+def print_report(results, baseline=None):
+    header = '{:<16}{:>10}{:>10}  {}'.format('target', 'min ms', 'med ms',
+                                            'heavy modules')
+    if baseline is not None:
+        header = '{:<16}{:>10}{:>10}{:>12}  {}'.format(
+            'target', 'min ms', 'med ms', 'med diff', 'heavy modules')
+    print(header)
+    for name, res in results['targets'].items():
+        modules = ','.join(res['modules']) or '-'
+        base = (baseline or {}).get('targets', {}).get(name)
+        if baseline is None:
+            print('{:<16}{:>10}{:>10}  {}'.format(name, res['min'],
+                                                 res['median'], modules))
+        else:
+            diff = _diff(res['median'], base['median']) if base else '-'
+            print('{:<16}{:>10}{:>10}{:>12}  {}'.format(
+                name, res['min'], res['median'], diff, modules))
+
+
+def regressions(results, baseline, threshold):
+    """Return targets whose median got slower than threshold percent."""
+    slow = []
+    for name, res in results['targets'].items():
+        base = baseline.get('targets', {}).get(name)
+        if base and base['median'] and res['median'] >\
+                base['median'] * (1 + threshold / 100.0):
+            slow.append(name)
+    return slow
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--targets', default=','.join(TARGETS),
+                        help="Comma separated targets of {}."
+                        .format(', '.join(TARGETS)))
+    parser.add_argument('--runs', type=int, default=7,
+                        help="Fresh processes per target.")
+    parser.add_argument('--output', help="Result JSON file. Default is "
+                        "bench/results/coldstart-<time>.json.")
+    parser.add_argument('--compare', help="Previous result JSON file to "
+                        "compare with.")
+    parser.add_argument('--fail-over', type=float, help="With --compare, "
+                        "exit with error if a median is slower by more than "
+                        "this percent.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [name for name in args.targets.split(',') if name]
+    for name in names:
+        if name not in TARGETS:
+            sys.exit("Unknown target '{}'".format(name))
+
+    results = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   revision=git_revision(),
+                   python=platform.python_version(),
+                   options=vars(args), targets={})
+    for name in names:
+        results['targets'][name] = measure_target(TARGETS[name], args.runs)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, time.strftime(
+            'coldstart-%Y%m%d-%H%M%S') + '.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to {}".format(output))
+
+    if baseline is not None and args.fail_over is not None:
+        slow = regressions(results, baseline, args.fail_over)
+        if slow:
+            sys.exit("Cold start regression: {}".format(', '.join(slow)))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Realistic webhook payloads to replay."""
+import json
+import random
+import itertools
+
+from bench.stubs import INTENTS
+
+
+PAGE_ID = '1088226297959512'
+TEXTS = list(INTENTS.keys()) + ['what is the weather like', 'thanks']
+QUICK_REPLIES = [('Yes', 'yes.cancel_order'), ('no', 'no.cancel_order')]
+
+
+class PayloadFactory(object):
+
+    def __init__(self, nsender=100, issue_token=None, seed=0):
+        """Init payload factory.
+
+        Args:
+            nsender (optional): Number of distinct senders.
+            issue_token (optional): Callable returning a fresh postback token
+                value issued by the app. If None, postbacks are predefined
+                buttons only.
+            seed (optional): Random seed, for comparable runs.
+        """
+        self.senders = [str(1500000000000000 + i) for i in range(nsender)]
+        self.issue_token = issue_token
+        self.random = random.Random(seed)
+        self._seq = itertools.count(1)
+        # sender: whether linked by a previous payload
+        self._linked = {}
+
+    def _mevent(self, sender_id, **kwargs):
+        seq = next(self._seq)
+        mevent = dict(sender=dict(id=sender_id), recipient=dict(id=PAGE_ID),
+                      timestamp=1488432412391 + seq)
+        mevent.update(kwargs)
+        return mevent
+
+    def _message(self, sender_id, text, qr_payload=None):
+        seq = next(self._seq)
+        message = dict(mid='mid.bench.{}'.format(seq), seq=seq, text=text)
+        if qr_payload is not None:
+            message['quick_reply'] = dict(payload=qr_payload)
+        return self._mevent(sender_id, message=message)
+
+    def _sender(self):
+        return self.random.choice(self.senders)
+
+    def page(self, *entries):
+        """Wrap lists of messaging events into a page payload."""
+        return dict(object='page', entry=[
+            dict(id=PAGE_ID, time=1488432412391, messaging=list(mevents))
+            for mevents in entries])
+
+    def text(self):
+        return self.page([self._message(self._sender(),
+                                        self.random.choice(TEXTS))])
+
+    def quick_reply(self):
+        text, payload = self.random.choice(QUICK_REPLIES)
+        return self.page([self._message(self._sender(), text, payload)])
+
+    def postback(self):
+        if self.issue_token is None or self.random.random() < 0.5:
+            payload = 'START_BUTTON'
+        else:
+            payload = json.dumps(dict(type='order', token=self.issue_token(),
+                                      id=self.random.randint(1, 10)))
+        return self.page([self._mevent(self._sender(),
+                                       postback=dict(payload=payload))])
+
+    def account_link(self):
+        sender_id = self._sender()
+        linked = not self._linked.get(sender_id, False)
+        self._linked[sender_id] = linked
+        if linked:
+            accnt_link = dict(status='linked', authorization_code='{:05}'.
+                              format(self.random.randint(0, 99999)))
+        else:
+            accnt_link = dict(status='unlinked')
+        return self.page([self._mevent(sender_id,
+                                       account_linking=accnt_link)])
+
+    def batch(self, nentry=3, nmevent=4):
+        """Multi-entry payload of mixed events from several senders."""
+        makers = [self.text, self.quick_reply, self.postback]
+        entries = []
+        for _ in range(nentry):
+            mevents = []
+            for _ in range(nmevent):
+                mevents += self.random.choice(makers)()['entry'][0][
+                    'messaging']
+            entries.append(mevents)
+        return self.page(*entries)
+
+    def apiai_fulfillment(self):
+        """Fulfillment request API.AI sends to `/apiai` webhook."""
+        text = self.random.choice(TEXTS)
+        action, speech, incomplete = INTENTS.get(
+            text, ('input.unknown', "Sorry, I don't understand.", False))
+        return {
+            'id': 'bench.{}'.format(next(self._seq)),
+            'sessionId': self._sender(),
+            'lang': 'en',
+            'result': {
+                'source': 'agent',
+                'resolvedQuery': text,
+                'action': action,
+                'actionIncomplete': incomplete,
+                'parameters': {},
+                'contexts': [],
+                'fulfillment': {'speech': speech},
+                'score': 1.0,
+            },
+            'status': {'code': 200, 'errorType': 'success'},
+            'originalRequest': {'source': 'facebook'},
+        }
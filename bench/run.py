@@ -0,0 +1,310 @@
+"""Replay webhook payloads through chabi blueprints against stub servers, and
+report throughput and latency percentiles.
+
+    $ python -m bench.run --requests 1000 --concurrency 16 \\
+        --apiai-latency 0.05 --graph-latency 0.02
+    $ python -m bench.run --compare bench/results/20170301-120000.json
+
+Requests are served in-process through the Flask test client, while API.AI
+and Graph API calls go over local HTTP to the stub servers.
+"""
+import os
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import platform
+import itertools
+import tempfile
+import threading
+import subprocess
+from timeit import default_timer
+
+from flask import Flask
+from pony import orm
+
+from chabi import EventHandlerBase as _EventHandlerBase,\
+    request_postback_token
+from chabi.cache import AnalysisCache
+from chabi.intent import LocalIntentResolver
+from chabi.outbox import Outbox
+from chabi.warmup import warm_up
+from chabi.models import db, db_session, safe_db_init, write_behind
+from chabi.vendor.apiai import ApiAI
+from chabi.vendor.facebook import Facebook, EventHandlerBase
+from bench.stubs import APIAIStub, GraphStub
+from bench.payloads import PayloadFactory
+
+
+# scenario: (endpoint, payload factory method)
+SCENARIOS = dict(
+    text=('/facebook', 'text'),
+    quick_reply=('/facebook', 'quick_reply'),
+    postback=('/facebook', 'postback'),
+    account_link=('/facebook', 'account_link'),
+    batch=('/facebook', 'batch'),
+    apiai=('/apiai', 'apiai_fulfillment'),
+)
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+class MessengerHandler(EventHandlerBase):
+
+    def handle_postback(self, msg):
+        payload = msg['payload']
+        if payload == 'START_BUTTON':
+            return self.start_msg
+        return "Order {} selected.".format(json.loads(payload)['id'])
+
+
+class FulfillmentHandler(_EventHandlerBase):
+
+    def handle_action(self, data):
+        speech = data['result']['fulfillment']['speech']
+        return dict(speech=speech, displayText=speech, source='chabi')
+
+
+def make_apps(args, apiai_url, graph_url):
+    """Make Flask apps of messenger and API.AI fulfillment webhooks."""
+    cache = AnalysisCache() if args.analysis_cache else None
+
+    msgn_app = Flask('bench')
+    Facebook(msgn_app, 'bench_page_token', 'bench_verify_token',
+             graph_url=graph_url, dispatch_workers=args.dispatch_workers,
+             batch_size=args.batch_size, batch_linger=args.batch_linger,
+             outbox=Outbox(args.outbox_rate, args.outbox_rate * 2) if
+             args.outbox_rate > 0 else None)
+    resolver = LocalIntentResolver() if args.local_intents else None
+    ApiAI(msgn_app, 'bench_token', cache, api_url=apiai_url,
+          intent_resolver=resolver)
+    MessengerHandler(msgn_app, start_msg="Welcome!",
+                     login_image_url='http://localhost/login.png',
+                     login_url='http://localhost/login')
+    msgn_app.wsgi_app = orm.db_session(msgn_app.wsgi_app)
+
+    ff_app = Flask('bench_fulfillment')
+    ApiAI(ff_app, 'bench_token', api_url=apiai_url)
+    FulfillmentHandler(ff_app)
+
+    for app in (msgn_app, ff_app):
+        app.logger.setLevel(args.log_level)
+    return msgn_app, ff_app
+
+
+def make_token_issuer(app):
+    def issue():
+        with app.app_context(), db_session:
+            return request_postback_token().value
+    return issue
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return None
+    k = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, k)]
+
+
+def replay(app, path, payloads, concurrency):
+    """Post payloads to the app endpoint concurrently.
+
+    Returns:
+        list: Latency of each request in seconds.
+        int: Number of non 200 responses.
+        float: Wall clock seconds of the whole replay.
+    """
+    latencies = [None] * len(payloads)
+    errors = []
+    index = itertools.count()
+
+    def work():
+        with app.test_client() as c:
+            while True:
+                i = next(index)
+                if i >= len(payloads):
+                    return
+                st = default_timer()
+                r = c.post(path, data=payloads[i],
+                           content_type='application/json')
+                latencies[i] = default_timer() - st
+                if r.status_code != 200:
+                    errors.append(r.status_code)
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    st = default_timer()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return latencies, len(errors), default_timer() - st
+
+
+def summarize(latencies, errors, elapsed):
+    """Summarize latencies into req/s and percentiles in milliseconds."""
+    values = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return dict(
+        requests=len(values), errors=errors, elapsed=round(elapsed, 3),
+        rps=round(len(values) / elapsed, 1) if elapsed > 0 else None,
+        mean=ms(sum(values) / len(values)) if values else None,
+        p50=ms(percentile(values, 50)), p95=ms(percentile(values, 95)),
+        p99=ms(percentile(values, 99)), max=ms(values[-1] if values else None))
+
+
+def run_scenario(name, apps, factory, args, stubs):
+    path, method = SCENARIOS[name]
+    app = apps[path]
+    make = getattr(factory, method)
+    warmup = [json.dumps(make()) for _ in range(args.warmup)]
+    payloads = [json.dumps(make()) for _ in range(args.requests)]
+    replay(app, path, warmup, args.concurrency)
+
+    calls = [stub.nrequest for stub in stubs]
+    latencies, errors, elapsed = replay(app, path, payloads, args.concurrency)
+    msgn = getattr(app, 'msgn', None)
+    if getattr(msgn, 'batch_sender', None) is not None:
+        msgn.batch_sender.flush()
+    if getattr(msgn, 'outbox', None) is not None:
+        msgn.outbox.flush()
+    if args.write_behind:
+        write_behind.flush()
+    res = summarize(latencies, errors, elapsed)
+    res['apiai_calls'], res['graph_calls'] = [stub.nrequest - n for stub, n
+                                              in zip(stubs, calls)]
+    return res
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return
+    return out.decode('utf8').strip()
+
+
+def print_report(results, baseline=None):
+    header = '{:<14}{:>10}{:>10}{:>10}{:>10}{:>8}'.format(
+        'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors')
+    if baseline is not None:
+        header += '{:>12}{:>12}'.format('req/s diff', 'p95 diff')
+    print(header)
+    for name, res in results['scenarios'].items():
+        line = '{:<14}{:>10}{:>10}{:>10}{:>10}{:>8}'.format(
+            name, res['rps'], res['p50'], res['p95'], res['p99'],
+            res['errors'])
+        base = (baseline or {}).get('scenarios', {}).get(name)
+        if base is not None:
+            line += '{:>12}{:>12}'.format(_diff(res['rps'], base['rps']),
+                                          _diff(res['p95'], base['p95']))
+        print(line)
+
+
+def _diff(value, base):
+    if not value or not base:
+        return '-'
+    return '{:+.1f}%'.format((value - base) * 100.0 / base)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="Comma separated scenarios of {}."
+                        .format(', '.join(SCENARIOS)))
+    parser.add_argument('--requests', type=int, default=500,
+                        help="Measured requests per scenario.")
+    parser.add_argument('--warmup', type=int, default=20,
+                        help="Unmeasured requests per scenario.")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--senders', type=int, default=100,
+                        help="Number of distinct senders.")
+    parser.add_argument('--apiai-latency', type=float, default=0.02,
+                        help="API.AI stub latency in seconds.")
+    parser.add_argument('--graph-latency', type=float, default=0.01,
+                        help="Graph API stub latency in seconds.")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="Maximum random latency added by stubs.")
+    parser.add_argument('--dispatch-workers', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help="Send Graph API batch requests of this size.")
+    parser.add_argument('--batch-linger', type=float, default=0.005)
+    parser.add_argument('--outbox-rate', type=float, default=0,
+                        help="Send through outbox of this rate per second.")
+    parser.add_argument('--analysis-cache', action='store_true')
+    parser.add_argument('--write-behind', action='store_true')
+    parser.add_argument('--local-intents', action='store_true',
+                        help="Resolve login/logout phrases locally.")
+    parser.add_argument('--warm-up', action='store_true',
+                        help="Warm up apps before replaying.")
+    parser.add_argument('--db', help="SQLite file. Default is a temp file.")
+    parser.add_argument('--log-level', default='ERROR')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Result JSON file. Default is "
+                        "bench/results/<time>.json.")
+    parser.add_argument('--compare', help="Previous result JSON file to "
+                        "compare with.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [name for name in args.scenarios.split(',') if name]
+    for name in names:
+        if name not in SCENARIOS:
+            sys.exit("Unknown scenario '{}'".format(name))
+
+    logging.basicConfig(level=args.log_level)
+    dbfile = args.db or os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    safe_db_init(db, os.path.abspath(dbfile))
+    if args.write_behind:
+        write_behind.start()
+
+    stubs = [APIAIStub(args.apiai_latency, args.jitter).start(),
+             GraphStub(args.graph_latency, args.jitter).start()]
+    try:
+        msgn_app, ff_app = make_apps(args, stubs[0].url, stubs[1].url)
+        if args.warm_up:
+            for app in (msgn_app, ff_app):
+                print(warm_up(app))
+        apps = {'/facebook': msgn_app, '/apiai': ff_app}
+        factory = PayloadFactory(args.senders, make_token_issuer(msgn_app),
+                                 args.seed)
+        results = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       revision=git_revision(),
+                       python=platform.python_version(),
+                       options=vars(args), scenarios={})
+        for name in names:
+            results['scenarios'][name] = run_scenario(name, apps, factory,
+                                                      args, stubs)
+    finally:
+        for stub in stubs:
+            stub.stop()
+        if args.write_behind:
+            write_behind.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') +
+                              '.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to {}".format(output))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Local stub servers of API.AI and Facebook Graph API."""
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# normalized query: (action, speech, action incomplete)
+INTENTS = {
+    'hello': ('input.welcome', 'Hi! How can I help you?', False),
+    'hi': ('input.welcome', 'Hi! How can I help you?', False),
+    'login': ('login', 'Please log in.', False),
+    'logout': ('logout', 'Please log out.', False),
+    'order pizza': ('order.pizza', 'What size of pizza do you want?', True),
+    'cancel my order': ('confirm.cancel_order',
+                        'Do you want to cancel your order?', False),
+    'show my orders': ('order.list', 'You have no order.', False),
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, as pooled transports expect
+    protocol_version = 'HTTP/1.1'
+    # avoid delayed ACK stalls between header and body writes
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        # for connection warm-up
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        self.server.stub.sleep()
+        status, data = self.server.stub.respond(urlparse(self.path).path,
+                                                body)
+        res = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(res)))
+        self.end_headers()
+        self.wfile.write(res)
+
+
+class StubServer(object):
+
+    def __init__(self, latency=0.0, jitter=0.0, host='127.0.0.1', port=0):
+        """Init stub server.
+
+        Args:
+            latency (optional): Seconds to wait before each response.
+            jitter (optional): Maximum random seconds added to latency.
+            host (optional): Host to listen.
+            port (optional): Port to listen. 0 for a free port.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.host = host
+        self.port = port
+        self.nrequest = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._server = ThreadingHTTPServer((self.host, self.port), StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name=type(self).__name__)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def sleep(self):
+        with self._lock:
+            self.nrequest += 1
+        delay = self.latency
+        if self.jitter > 0:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def respond(self, path, body):
+        """Make response of a request.
+
+        Returns:
+            int: HTTP status code.
+            dict: Response data.
+        """
+        raise NotImplementedError()
+
+
+class APIAIStub(StubServer):
+    """Mimics API.AI `/v1/query` for both text queries and events."""
+
+    @property
+    def url(self):
+        return super(APIAIStub, self).url + '/v1'
+
+    def respond(self, path, body):
+        if path != '/v1/query':
+            return 404, dict(status=dict(code=404, errorType='not_found'))
+        req = json.loads(body.decode('utf8'))
+        if 'event' in req:
+            name = req['event']['name']
+            query = None
+            action, speech, incomplete = ('event.' + name,
+                                          "Event '{}' done.".format(name),
+                                          False)
+        else:
+            query = req.get('query', '')
+            key = ' '.join(query.lower().split())
+            action, speech, incomplete = INTENTS.get(
+                key, ('input.unknown', "Sorry, I don't understand.", False))
+        contexts = [dict(name=action, lifespan=2)] if incomplete else []
+        return 200, {
+            'id': 'stub',
+            'lang': req.get('lang', 'en'),
+            'sessionId': req.get('sessionId'),
+            'result': {
+                'source': 'agent',
+                'resolvedQuery': query,
+                'action': action,
+                'actionIncomplete': incomplete,
+                'parameters': {},
+                'contexts': contexts,
+                'metadata': {},
+                'fulfillment': {'speech': speech, 'messages': []},
+                'score': 1.0,
+            },
+            'status': {'code': 200, 'errorType': 'success'},
+        }
+
+
+class GraphStub(StubServer):
+    """Mimics Graph API `/v2.6/me/messages`, and batch requests of it."""
+
+    @property
+    def url(self):
+        return super(GraphStub, self).url + '/v2.6'
+
+    def respond(self, path, body):
+        if path == '/v2.6':
+            form = parse_qs(body.decode('utf8'))
+            return 200, [self.respond_batch_op(op) for op in
+                         json.loads(form['batch'][0])]
+        if path != '/v2.6/me/messages':
+            return 404, dict(error=dict(message='Unknown path', code=803))
+        return self.respond_message(json.loads(body.decode('utf8')))
+
+    def respond_batch_op(self, op):
+        if op.get('relative_url') != 'me/messages':
+            return dict(code=404, body=json.dumps(dict(error=dict(
+                message='Unknown path', code=803))))
+        form = parse_qs(op.get('body', ''))
+        req = dict((key, values[0]) for key, values in form.items())
+        if 'recipient' in req:
+            req['recipient'] = json.loads(req['recipient'])
+        status, data = self.respond_message(req)
+        return dict(code=status, body=json.dumps(data))
+
+    def respond_message(self, req):
+        recipient_id = req.get('recipient', {}).get('id')
+        if 'sender_action' in req:
+            return 200, dict(recipient_id=recipient_id)
+        return 200, dict(recipient_id=recipient_id,
+                         message_id='mid.stub.{}'.format(self.nrequest))
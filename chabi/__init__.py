@@ -1,14 +1,31 @@
 import time
 import json
 from datetime import datetime
-
-from flask import current_app as ca
-
-from chabi.models import PostbackToken
+from collections import namedtuple
+
+from chabi.cache import AccountLinkCache
+from chabi.metrics import measure
+from chabi.breaker import NLUUnavailable, DEFAULT_FALLBACK_REPLY
+from chabi.session import SESSION_DT_FMT
+from chabi.router import ACTION, QUICK_REPLY, POSTBACK, compile_routes,\
+    on_action
 from chabi.util import generate_random_token
 from chabi.const import POSTBACK_TEST_TOKEN
 
 
+class _CurrentApp(object):
+    """Proxy of `flask.current_app`, importing Flask on first use."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        from flask import current_app
+        return getattr(current_app, name)
+
+
+ca = _CurrentApp()
+
+
 def analyze_and_action(sender_id, msg_text):
     """Analyze message and do action for the result.
 
@@ -30,19 +47,42 @@ def analyze_and_action(sender_id, msg_text):
         str: Result text message.
     """
     st = time.time()
-    ca.logger.debug('analyzing start: {}'.format(msg_text))
+    ca.logger.debug('analyzing start: %s', msg_text)
     cb_session_id = make_chatbot_session_id(sender_id, ca)
-    res = ca.chatbot.request_analyze(cb_session_id, msg_text)
-    ca.logger.debug('analyzing elapsed: {0:.2f}'.format(time.time() - st))
-    if res is None:
+    try:
+        data = ca.chatbot.analyze(cb_session_id, msg_text)
+    except NLUUnavailable as e:
+        ca.logger.warning("NLU unavailable: %s", e)
+        return ca.chatbot.fallback_reply
+    ca.logger.debug('analyzing elapsed: %.2f', time.time() - st)
+    if data is None:
         return
 
-    if type(res) is not str:
-        res = res.read()
-    data = json.loads(res)
     return action_by_analyzed(sender_id, data)
 
 
+def read_analyzed(res):
+    """Read analyzed result from Chatbot API.
+
+    Args:
+        res(str or HTTP Stream): Analyzed result in JSON format.
+
+    Returns:
+        str: Analyzed result in JSON format.
+    """
+    if hasattr(res, 'read'):
+        res = res.read()
+    return res
+
+
+def _request_and_read(func, *args):
+    res = func(*args)
+    if res is not None:
+        # read stream within timeout
+        res = read_analyzed(res)
+    return res
+
+
 def action_by_analyzed(sender_id, data):
     """Do action based on response from Chatbot.
 
@@ -56,19 +96,19 @@ def action_by_analyzed(sender_id, data):
     # check unknown message
     unknown, res = ca.chatbot.handle_unknown(data)
     if unknown:
-        ca.logger.info("unknown message: {}".format(res))
+        ca.logger.info("unknown message: %s", res)
         return res
 
     # check action needs to be done
     action_done, res = ca.chatbot.handle_action(sender_id, data)
     if action_done:
-        ca.logger.info("action '{}' done".format(action_done))
+        ca.logger.info("action '%s' done", action_done)
         return res
 
     # check entity filling
     incomplete, res = ca.chatbot.handle_incomplete(data)
     if incomplete:
-        ca.logger.info("incomplete message: {}".format(res))
+        ca.logger.info("incomplete message: %s", res)
         return res
 
     # default reply
@@ -76,6 +116,8 @@ def action_by_analyzed(sender_id, data):
 
 
 class CommonBase(object):
+    # vendor name for metrics
+    vendor = ''
 
     def __init__(self, app):
         """Init common base.
@@ -86,20 +128,137 @@ class CommonBase(object):
         self.app = app
         self.logger = app.logger
 
+    def endpoints(self):
+        """Return list of `(transport, url)` of remote endpoints, which can be
+        connected ahead of requests."""
+        return []
+
+
+class AnalysisMixin(object):
+    """Local resolution and caching of analysis, shared by sync and async
+    chatbots."""
+
+    @property
+    def fallback_reply(self):
+        """Canned reply when NLU is unavailable."""
+        if self.nlu_guard is None:
+            return DEFAULT_FALLBACK_REPLY
+        return self.nlu_guard.fallback_reply
+
+    def _analyze_locally(self, session_id, msg):
+        """Return analyzed data by local intent resolver or analysis cache,
+        None if neither has it."""
+        resolver = self.intent_resolver
+        if resolver is not None:
+            data = resolver.resolve(session_id, msg, self.lang)
+            if data is not None:
+                return data
+
+        cache = self.analysis_cache
+        if cache is not None:
+            return cache.get(session_id, msg, self.lang)
+
+    def _load_analyzed(self, session_id, msg, res):
+        res = read_analyzed(res)
+        data = json.loads(res)
+        if self.intent_resolver is not None:
+            self.intent_resolver.observe(session_id,
+                                         self.is_context_free(data))
+        if self.analysis_cache is not None:
+            self.analysis_cache.put(session_id, msg, self.lang, data,
+                                    self.is_context_free(data), len(res))
+        return data
+
+    def is_context_free(self, data):
+        """Check whether analyzed data is free from dialog context.
+
+        Only context-free results can be cached.
+
+        Args:
+            data: Analyzed data from Chatbot.
+
+        Returns:
+            boolean: True if context free.
+        """
+        return False
 
-class ChatbotBase(CommonBase):
 
-    def __init__(self, app, blueprint):
+class ChatbotBase(AnalysisMixin, CommonBase):
+
+    lang = 'en'
+
+    def __init__(self, app, blueprint, analysis_cache=None,
+                 intent_resolver=None, nlu_guard=None, session_registry=None):
         """Init chatbot base.
 
         Args:
             app: A Flask app instance.
             blueprint: Flask blueprint for url routing.
+            analysis_cache (optional): `chabi.cache.AnalysisCache` instance
+                to cache context-free analysis results.
+            intent_resolver (optional): `chabi.intent.LocalIntentResolver`
+                instance to resolve messages locally before remote NLU.
+            nlu_guard (optional): `chabi.breaker.NLUGuard` instance to call
+                NLU with timeout, circuit breaker and hedged retries.
+            session_registry (optional): `chabi.session` registry to keep
+                chatbot session ids of users stable across worker processes
+                and restarts. Default is per process session ids.
         """
         super(ChatbotBase, self).__init__(app)
         app.chatbot = self
         app.register_blueprint(blueprint)
         app.cb_start_dt = datetime.fromtimestamp(time.time())
+        app.cb_sessions = session_registry
+        self.analysis_cache = analysis_cache
+        self.intent_resolver = intent_resolver
+        self.nlu_guard = nlu_guard
+        if nlu_guard is not None:
+            nlu_guard.bind(self.vendor)
+
+    def analyze(self, session_id, msg):
+        """Analyze text, using local intent resolver and analysis cache if
+        any.
+
+        Args:
+            session_id: Chatbot Session ID.
+            msg: Text to analyze.
+
+        Returns:
+            dict: Analyzed data. None if analysis failed.
+        """
+        data = self._analyze_locally(session_id, msg)
+        if data is not None:
+            return data
+
+        with measure('analyze', self.vendor):
+            res = self._call_nlu(self.request_analyze, session_id, msg)
+        if res is None:
+            return
+        return self._load_analyzed(session_id, msg, res)
+
+    def analyze_event(self, session_id, event):
+        """Trigger event and return analyzed data.
+
+        Args:
+            session_id: Chatbot Session ID.
+            event: Name of event.
+
+        Returns:
+            dict: Analyzed data.
+        """
+        with measure('trigger_event', self.vendor, event):
+            res = self._call_nlu(self.trigger_event, session_id, event)
+        return self._load_analyzed(session_id, None, res)
+
+    def _call_nlu(self, func, *args):
+        """Call NLU request function through NLU guard if any.
+
+        Raises:
+            chabi.breaker.NLUUnavailable: If NLU guard gave up.
+        """
+        if self.nlu_guard is None:
+            return func(*args)
+        return self.nlu_guard.call(_request_and_read, func, *args)
 
     def request_analyze(self, session_id, msg):
         """Request text analysis by Chatbot API.
@@ -166,11 +325,16 @@ class ChatbotBase(CommonBase):
 
 class MessengerBase(CommonBase):
 
-    def __init__(self, app, blueprint, page_access_token, verify_token):
+    def __init__(self, app, blueprint, page_access_token, verify_token,
+                 token_store=None, account_cache=None):
         """Init messenger base.
 
         Args:
             app: A Flask app instance.
+            token_store (optional): Postback token store. Default is
+                `chabi.tokens.DBTokenStore`.
+            account_cache (optional): Account link state cache. Default is
+                `chabi.cache.AccountLinkCache`.
         """
         super(MessengerBase, self).__init__(app)
         app.msgn = self
@@ -179,6 +343,13 @@ class MessengerBase(CommonBase):
         self.app = app
         self.page_access_token = page_access_token
         self.verify_token = verify_token
+        if token_store is None:
+            from chabi.tokens import DBTokenStore
+            token_store = DBTokenStore()
+        self.token_store = token_store
+        if account_cache is None:
+            account_cache = AccountLinkCache()
+        self.account_cache = account_cache
 
     def get_text_msg(self, msg_event):
         raise NotImplementedError()
@@ -196,12 +367,16 @@ class MessengerBase(CommonBase):
         self.send_message(recipient_id, msg)
         return msg
 
-    def handle_msg_data(self, data):
+    def handle_msg_data(self, data, collector=None):
         raise NotImplementedError()
 
     def handle_text_message(self, app, sender_id, mevent):
         raise NotImplementedError()
 
+    def is_logged_in(self, sender_id):
+        """Check whether the sender has linked account."""
+        raise NotImplementedError()
+
     def handle_account_link(self, auth_code):
         raise NotImplementedError()
 
@@ -209,17 +384,106 @@ class MessengerBase(CommonBase):
         raise NotImplementedError()
 
 
-class EventHandlerBase(CommonBase):
+class EventRoutingMixin(object):
+    """Route resolution shared by sync and async event handlers.
+
+    Handler getters return the routed method, or the `handle_*` method for
+    ones with no route, to be called(or awaited) by the front end.
+    """
+
+    def routed_handler(self, kind, key):
+        """Return handler method routed by the key, None if no route."""
+        handler = self.router.resolve(kind, key)
+        if handler is not None:
+            return getattr(self, handler)
+
+    def action_handler(self, action):
+        """Return handler of the action, called with `sender_id` and
+        `data`."""
+        return self.routed_handler(ACTION, action) or self.handle_action
+
+    def quick_reply_handler(self, payload):
+        """Return handler of the quick reply payload, called with
+        `sender_id`, `text` and `payload`."""
+        return self.routed_handler(QUICK_REPLY, payload) or\
+            self.handle_quick_reply
+
+    def postback_handler(self, msg, key=None):
+        """Return handler of the postback, called with `msg`.
+
+        Args:
+            msg: Postback data.
+            key (optional): Route key if already known, otherwise got by
+                `postback_type`.
+        """
+        if key is None:
+            key = self.postback_type(msg)
+        return self.routed_handler(POSTBACK, key) or self.handle_postback
+
+    def postback_type(self, msg):
+        """Return route key of the postback."""
+        return msg.get('payload')
+
+    def _confirm_args(self, data):
+        # confirm message and action of `confirm.<action>` action
+        result = data['result']
+        return result['fulfillment']['speech'], result['action'].split('.')[1]
+
+
+class EventHandlerBase(EventRoutingMixin, CommonBase):
 
     def __init__(self, app):
         """Init event handler base.
 
+        Actions, quick reply payloads and postbacks are dispatched to methods
+        declared with `chabi.router.on_action`, `on_quick_reply` and
+        `on_postback`, by a single lookup. `handle_action`,
+        `handle_quick_reply` and `handle_postback` are called for ones with
+        no route.
+
         Args:
             app: A Flask app instance.
         """
         super(EventHandlerBase, self).__init__(app)
+        self.router = compile_routes(type(self))
         app.evth = self
 
+    def route(self, kind, key, *args):
+        """Call handler method routed by the key.
+
+        Returns:
+            boolean: True if routed, False otherwise.
+            object: Result of the handler.
+        """
+        handler = self.routed_handler(kind, key)
+        if handler is None:
+            return False, None
+        return True, handler(*args)
+
+    def route_action(self, action, sender_id, data):
+        """Handle action by its routed method, or `handle_action`."""
+        return self.action_handler(action)(sender_id, data)
+
+    def route_quick_reply(self, sender_id, text, payload):
+        """Handle quick reply by its routed method, or
+        `handle_quick_reply`."""
+        return self.quick_reply_handler(payload)(sender_id, text, payload)
+
+    def route_postback(self, msg, key=None):
+        """Handle postback by its routed method, or `handle_postback`.
+
+        Args:
+            msg: Postback data.
+            key (optional): Route key if already known, otherwise got by
+                `postback_type`.
+        """
+        return self.postback_handler(msg, key)(msg)
+
+    @on_action(prefix='confirm.')
+    def handle_action_confirm(self, sender_id, data):
+        """Confirm intent of `confirm.<action>` action by `confirm_intent`."""
+        return self.confirm_intent(sender_id, *self._confirm_args(data))
+
     def handle_action(self, msg):
         raise NotImplementedError()
 
@@ -242,22 +506,36 @@ class EventHandlerBase(CommonBase):
 
 
 def make_chatbot_session_id(msgn_id, app):
-    """Make chatbot session ID from messenger ID and app start time.
+    """Make chatbot session ID from messenger ID.
+
+    The session is looked up from the session registry of the app if any,
+    otherwise made from app start time.
 
     Args:
         msgn_id: Messenger user ID
         app: Flask app instance (has start time attribute).
     Returns:
+        str: Chatbot session ID.
     """
-    fmt = '%Y-%m-%d %H:%M:%S'
-    return "{}_{}".format(msgn_id, app.cb_start_dt.strftime(fmt))
+    registry = getattr(app, 'cb_sessions', None)
+    if registry is not None:
+        with measure('db', '', 'session'):
+            return registry.session_id(msgn_id)
+    return "{}_{}".format(msgn_id, app.cb_start_dt.strftime(SESSION_DT_FMT))
+
+
+IssuedToken = namedtuple('IssuedToken', ['value', 'issue_dt'])
 
 
 def request_postback_token():
+    """Issue postback token from token store of the messenger.
+
+    Returns:
+        IssuedToken: Issued token.
+    """
     if ca.config['TESTING']:
         token = POSTBACK_TEST_TOKEN
     else:
         token = generate_random_token()
-    dt = datetime.fromtimestamp(time.time())
-    ptoken = PostbackToken(value=token, issue_dt=dt)
-    return ptoken
+    dt = ca.msgn.token_store.issue(token)
+    return IssuedToken(token, dt)
@@ -0,0 +1,428 @@
+"""asyncio-native chatbot and messenger pipeline.
+
+Coroutine counterparts of `chabi` base classes and pipeline functions.
+Components don't rely on Flask `current_app`, but share an `AsyncApp`, which
+is also an ASGI application. One event loop can handle many conversations,
+while the sync API stays available as is.
+
+Note:
+    `aiohttp` is required for `AsyncHTTPClient`.
+"""
+import time
+import asyncio
+import logging
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from chabi import make_chatbot_session_id, AnalysisMixin,\
+    EventRoutingMixin
+from chabi.cache import AccountLinkCache
+from chabi.metrics import measure
+from chabi.breaker import NLUUnavailable
+from chabi.router import compile_routes, on_action
+
+
+class AsyncHTTPClient(object):
+
+    def __init__(self, pool_size=100, connect_timeout=3.05, read_timeout=10):
+        """Init async HTTP client with persistent connection pool.
+
+        Args:
+            pool_size (optional): Maximum number of connections.
+            connect_timeout (optional): Connect timeout in seconds.
+            read_timeout (optional): Read timeout in seconds.
+        """
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError("aiohttp is required for async pipeline.")
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                            sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout)
+        return self._session
+
+    async def post(self, url, params=None, headers=None, data=None):
+        """Send POST request.
+
+        Returns:
+            int: HTTP status code.
+            str: Response body.
+        """
+        session = self._get_session()
+        async with session.post(url, params=params, headers=headers,
+                                data=data) as r:
+            return r.status, await r.text()
+
+    async def close(self):
+        """Close all pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncApp(object):
+
+    def __init__(self, name='chabi', config=None, http=None):
+        """Init async app.
+
+        Args:
+            name (optional): Logger name.
+            config (optional): Config dict. `TESTING` is False by default.
+            http (optional): `AsyncHTTPClient` shared by components.
+        """
+        self.config = dict(TESTING=False)
+        if config is not None:
+            self.config.update(config)
+        self.logger = logging.getLogger(name)
+        self.http = http if http is not None else AsyncHTTPClient()
+        self.routes = {}
+        self.chatbot = None
+        self.msgn = None
+        self.evth = None
+        self._tasks = set()
+
+    def route(self, path, methods, handler):
+        """Register a request handler.
+
+        Args:
+            path: URL path.
+            methods: Iterable of HTTP methods.
+            handler: Coroutine function of `(app, query, body)`, which returns
+                `(status, body)` or `(status, body, content_type)`.
+        """
+        for method in methods:
+            self.routes[(method, path)] = handler
+
+    def spawn(self, coro):
+        """Run coroutine in background, keeping track of it until done."""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error("Background task failed",
+                              exc_info=task.exception())
+
+    async def run_blocking(self, func, *args):
+        """Run blocking function(e.g. DB access) in a DB session on the
+        default executor."""
+        from chabi.models import db_session
+
+        def run():
+            with db_session:
+                return func(*args)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, run)
+
+    async def shutdown(self):
+        """Wait for background tasks, then close HTTP client."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        await self.http.close()
+
+    async def __call__(self, scope, receive, send):
+        """ASGI entry."""
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+
+        body = b''
+        more = True
+        while more:
+            msg = await receive()
+            body += msg.get('body', b'')
+            more = msg.get('more_body', False)
+
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            res = (404, 'Not Found')
+        else:
+            query = parse_qs(scope.get('query_string', b'').decode('utf8'))
+            query = dict((k, v[0]) for k, v in query.items())
+            res = await handler(self, query, body)
+
+        status, res_body = res[:2]
+        ctype = res[2] if len(res) > 2 else 'text/plain; charset=utf-8'
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', ctype.encode('utf8'))]})
+        await send({'type': 'http.response.body',
+                    'body': res_body.encode('utf8')})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            msg = await receive()
+            if msg['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif msg['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def analyze_and_action(app, sender_id, msg_text):
+    """Analyze message and do action for the result.
+
+    Coroutine version of `chabi.analyze_and_action`.
+
+    Returns:
+        str: Result text message.
+    """
+    st = time.time()
+    app.logger.debug('analyzing start: %s', msg_text)
+    cb_session_id = make_chatbot_session_id(sender_id, app)
+    try:
+        data = await app.chatbot.analyze(cb_session_id, msg_text)
+    except NLUUnavailable as e:
+        app.logger.warning("NLU unavailable: %s", e)
+        return app.chatbot.fallback_reply
+    app.logger.debug('analyzing elapsed: %.2f', time.time() - st)
+    if data is None:
+        return
+
+    return await action_by_analyzed(app, sender_id, data)
+
+
+async def action_by_analyzed(app, sender_id, data):
+    """Do action based on response from Chatbot.
+
+    Coroutine version of `chabi.action_by_analyzed`.
+
+    Returns:
+        str: Result text message.
+    """
+    chatbot = app.chatbot
+    unknown, res = chatbot.handle_unknown(data)
+    if unknown:
+        app.logger.info("unknown message: %s", res)
+        return res
+
+    action_done, res = await chatbot.handle_action(sender_id, data)
+    if action_done:
+        app.logger.info("action '%s' done", action_done)
+        return res
+
+    incomplete, res = chatbot.handle_incomplete(data)
+    if incomplete:
+        app.logger.info("incomplete message: %s", res)
+        return res
+
+    return chatbot.extract_text_msg(data)
+
+
+class AsyncCommonBase(object):
+    # vendor name for metrics
+    vendor = ''
+
+    def __init__(self, app):
+        """Init common base.
+
+        Args:
+            app: An `AsyncApp` instance.
+        """
+        self.app = app
+        self.logger = app.logger
+
+
+class AsyncChatbotBase(AnalysisMixin, AsyncCommonBase):
+
+    lang = 'en'
+
+    def __init__(self, app, analysis_cache=None, intent_resolver=None,
+                 nlu_guard=None, session_registry=None):
+        """Init async chatbot base.
+
+        Args:
+            app: An `AsyncApp` instance.
+            analysis_cache (optional): `chabi.cache.AnalysisCache` instance
+                to cache context-free analysis results.
+            intent_resolver (optional): `chabi.intent.LocalIntentResolver`
+                instance to resolve messages locally before remote NLU.
+            nlu_guard (optional): `chabi.breaker.NLUGuard` instance to call
+                NLU with timeout, circuit breaker and hedged retries.
+            session_registry (optional): `chabi.session` registry to keep
+                chatbot session ids of users stable across worker processes
+                and restarts. Default is per process session ids. Called
+                inline in the event loop, so it should be a fast one.
+        """
+        super(AsyncChatbotBase, self).__init__(app)
+        app.chatbot = self
+        app.cb_start_dt = datetime.fromtimestamp(time.time())
+        app.cb_sessions = session_registry
+        self.analysis_cache = analysis_cache
+        self.intent_resolver = intent_resolver
+        self.nlu_guard = nlu_guard
+        if nlu_guard is not None:
+            nlu_guard.bind(self.vendor)
+
+    async def analyze(self, session_id, msg):
+        """Analyze text, using local intent resolver and analysis cache if
+        any.
+
+        Returns:
+            dict: Analyzed data. None if analysis failed.
+        """
+        data = self._analyze_locally(session_id, msg)
+        if data is not None:
+            return data
+
+        with measure('analyze', self.vendor):
+            res = await self._call_nlu(self.request_analyze, session_id, msg)
+        if res is None:
+            return
+        return self._load_analyzed(session_id, msg, res)
+
+    async def analyze_event(self, session_id, event):
+        """Trigger event and return analyzed data."""
+        with measure('trigger_event', self.vendor, event):
+            res = await self._call_nlu(self.trigger_event, session_id, event)
+        return self._load_analyzed(session_id, None, res)
+
+    async def _call_nlu(self, func, *args):
+        if self.nlu_guard is None:
+            return await func(*args)
+        return await self.nlu_guard.call_async(func, *args)
+
+    async def request_analyze(self, session_id, msg):
+        """Request text analysis by Chatbot API.
+
+        Returns:
+            str: Analyzed result in JSON format.
+        """
+        raise NotImplementedError()
+
+    async def trigger_event(self, session_id, event):
+        """Trigger Chatbot event to proceed next intent.
+
+        Returns:
+            str: Analyzed result in JSON format.
+        """
+        raise NotImplementedError()
+
+    async def handle_action(self, sender_id, data):
+        raise NotImplementedError()
+
+    def handle_unknown(self, data):
+        raise NotImplementedError()
+
+    def handle_incomplete(self, data):
+        raise NotImplementedError()
+
+    def extract_text_msg(self, data):
+        raise NotImplementedError()
+
+
+class AsyncMessengerBase(AsyncCommonBase):
+
+    def __init__(self, app, page_access_token, verify_token,
+                 token_store=None, account_cache=None):
+        """Init async messenger base.
+
+        Args:
+            app: An `AsyncApp` instance.
+            token_store (optional): Postback token store. Default is
+                `chabi.tokens.DBTokenStore`.
+            account_cache (optional): Account link state cache. Default is
+                `chabi.cache.AccountLinkCache`.
+        """
+        super(AsyncMessengerBase, self).__init__(app)
+        app.msgn = self
+        self.page_access_token = page_access_token
+        self.verify_token = verify_token
+        if token_store is None:
+            from chabi.tokens import DBTokenStore
+            token_store = DBTokenStore()
+        self.token_store = token_store
+        if account_cache is None:
+            account_cache = AccountLinkCache()
+        self.account_cache = account_cache
+
+    async def send_message(self, recipient_id, res):
+        raise NotImplementedError()
+
+    async def ask_enter_text_msg(self, recipient_id):
+        """Prompt user to enter only text message.
+
+        Return:
+            str: Return message content.
+        """
+        msg = dict(message=dict(text="Please enter text message."))
+        await self.send_message(recipient_id, msg)
+        return msg
+
+    async def handle_msg_data(self, data, collector=None):
+        raise NotImplementedError()
+
+    async def is_logged_in(self, sender_id):
+        raise NotImplementedError()
+
+    async def handle_account_link(self, sender_id, auth_code):
+        raise NotImplementedError()
+
+    async def handle_account_unlink(self, sender_id):
+        raise NotImplementedError()
+
+
+class AsyncEventHandlerBase(EventRoutingMixin, AsyncCommonBase):
+
+    def __init__(self, app):
+        """Init async event handler base.
+
+        Routes are dispatched as by `chabi.EventHandlerBase`, awaiting the
+        handler coroutines.
+
+        Args:
+            app: An `AsyncApp` instance.
+        """
+        super(AsyncEventHandlerBase, self).__init__(app)
+        self.router = compile_routes(type(self))
+        app.evth = self
+
+    async def route(self, kind, key, *args):
+        """Await handler method routed by the key.
+
+        Returns:
+            boolean: True if routed, False otherwise.
+            object: Result of the handler.
+        """
+        handler = self.routed_handler(kind, key)
+        if handler is None:
+            return False, None
+        return True, await handler(*args)
+
+    async def route_action(self, action, sender_id, data):
+        return await self.action_handler(action)(sender_id, data)
+
+    async def route_quick_reply(self, sender_id, text, payload):
+        return await self.quick_reply_handler(payload)(sender_id, text,
+                                                       payload)
+
+    async def route_postback(self, msg, key=None):
+        return await self.postback_handler(msg, key)(msg)
+
+    @on_action(prefix='confirm.')
+    async def handle_action_confirm(self, sender_id, data):
+        return await self.confirm_intent(sender_id, *self._confirm_args(data))
+
+    async def handle_action(self, sender_id, data):
+        raise NotImplementedError()
+
+    async def handle_postback(self, msg):
+        raise NotImplementedError()
+
+    async def handle_quick_reply(self, sender_id, text, payload):
+        raise NotImplementedError()
+
+    async def confirm_intent(self, sender_id, confirm_msg, confirm_action):
+        raise NotImplementedError()
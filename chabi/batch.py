@@ -0,0 +1,181 @@
+"""Batched outbound sends with per-recipient ordering."""
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class BatchItem(object):
+    __slots__ = ('key', 'data', 'future', 'attempts', 'prev')
+
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+        self.future = Future()
+        self.attempts = 0
+        # index of previous item of the same key within a batch
+        self.prev = None
+
+
+def is_retriable(status):
+    """Whether a sub-request of the status can be retried."""
+    return status is None or status == 429 or status >= 500
+
+
+class BatchSender(object):
+
+    def __init__(self, send_batch, max_batch=50, linger=0.005, max_retries=1,
+                 name='chabi-batch-sender'):
+        """Init batch sender.
+
+        Messages are buffered for `linger` seconds, then sent in one batch
+        request by a background thread. Batches are sent one at a time, and
+        items of the same key(recipient) are marked to depend on the previous
+        one in a batch, so that order per key is kept. A retriable failure of
+        an item is retried along with the following items of its key.
+
+        Args:
+            send_batch: Callable of `(items)` sending `BatchItem` list in one
+                request. Returns list of `(status, body)` for each item, with
+                status None if not processed.
+            max_batch (optional): Maximum number of items per batch.
+            linger (optional): Seconds to wait for more items to batch.
+            max_retries (optional): Maximum number of retries of an item.
+            name (optional): Background thread name.
+        """
+        self.send_batch = send_batch
+        self.max_batch = max_batch
+        self.linger = linger
+        self.max_retries = max_retries
+        self.name = name
+        self.logger = logging.getLogger(__name__)
+        self.nbatch = 0
+        self.nsent = 0
+        self.nfailed = 0
+        self.nretried = 0
+        self._queue = queue.Queue()
+        self._retries = deque()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start background sender. Flushed at exit."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def send(self, key, data):
+        """Send a message. Sent inline until started.
+
+        Args:
+            key: Ordering key(e.g. recipient id).
+            data: Message data.
+
+        Returns:
+            Future: Resolved to `(status, body)` of the message.
+        """
+        item = BatchItem(key, data)
+        if self._thread is None:
+            self._send([item])
+        else:
+            self._queue.put(item)
+        return item.future
+
+    def flush(self):
+        """Wait until all messages sent so far are done."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stop(self):
+        """Flush, then stop background sender."""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._queue.put(None)
+            thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.linger
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            items = [item for item in batch if item is not None]
+            self._send(items)
+            while self._retries:
+                # retried items go first, before new ones of their keys
+                self._send([])
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _send(self, items):
+        items = list(self._retries) + items
+        self._retries.clear()
+        if len(items) > self.max_batch:
+            self._retries.extend(items[self.max_batch:])
+            items = items[:self.max_batch]
+        if not items:
+            return
+
+        last = {}
+        for idx, item in enumerate(items):
+            item.prev = last.get(item.key)
+            last[item.key] = idx
+            item.attempts += 1
+
+        try:
+            results = self.send_batch(items)
+        except Exception:
+            self.logger.exception("Fail to send batch of %d", len(items))
+            results = [(None, None)] * len(items)
+        self.nbatch += 1
+
+        retry_keys = set()
+        retries = []
+        for item, (status, body) in zip(items, results):
+            if item.key in retry_keys:
+                # keep order after a retried item
+                retries.append(item)
+            elif status is not None and status < 300:
+                self.nsent += 1
+                item.future.set_result((status, body))
+            elif is_retriable(status) and item.attempts <= self.max_retries:
+                retry_keys.add(item.key)
+                retries.append(item)
+            else:
+                self.nfailed += 1
+                self.logger.error("Fail to send to %s(%s): %s, data: %s",
+                                  item.key, status, body, item.data)
+                item.future.set_result((status, body))
+        if retries:
+            self.nretried += len(retries)
+            self._retries.extend(retries)
+            if self._thread is None:
+                self._send([])
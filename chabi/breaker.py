@@ -0,0 +1,229 @@
+"""Timeouts, circuit breaker and hedged retries for NLU calls."""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from chabi.metrics import REGISTRY
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_FALLBACK_REPLY = "Sorry, I can't understand messages right now. "\
+    "Please try again later."
+
+BREAKER_OPEN = REGISTRY.gauge(
+    'chabi_breaker_open', 'Whether the circuit breaker is open(1) or not(0).',
+    ('breaker',))
+NLU_FAILURES = REGISTRY.counter(
+    'chabi_nlu_failures_total', 'Number of failed or rejected NLU calls by '
+    'reason.', ('breaker', 'reason'))
+
+
+class NLUUnavailable(Exception):
+    """NLU can't give analysis now."""
+
+
+class CircuitOpenError(NLUUnavailable):
+    """Call rejected by open circuit breaker."""
+
+
+class NLUTimeout(NLUUnavailable):
+    """NLU call timed out."""
+
+
+class NLUError(NLUUnavailable):
+    """NLU call raised."""
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, name=''):
+        """Init circuit breaker.
+
+        Opens after `failure_threshold` consecutive failures, rejecting calls
+        for `reset_timeout` seconds. Then one trial call is let through(half
+        open), which closes the breaker on success or opens it again on
+        failure.
+
+        Args:
+            failure_threshold (optional): Consecutive failures to open.
+            reset_timeout (optional): Seconds to stay open.
+            name (optional): Name for metrics. Default is the vendor of the
+                chatbot backend, named by `bind`.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = ''
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._trial = False
+        self._lock = threading.Lock()
+        if name:
+            self.bind(name)
+
+    def bind(self, name):
+        """Name the breaker if not named yet, and expose its state as
+        `chabi_breaker_open` gauge of the name."""
+        if self.name:
+            return
+        self.name = name
+        BREAKER_OPEN.set_function(lambda: int(self.state == OPEN), (name,))
+
+    def allow(self):
+        """Whether a call can be made now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() < self.opened_at + self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+                self._trial = False
+            if self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = CLOSED
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or\
+                    self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
+                self._trial = False
+
+
+class NLUGuard(object):
+
+    def __init__(self, timeout=5.0, breaker=None, hedge_after=None,
+                 max_workers=32, fallback_reply=DEFAULT_FALLBACK_REPLY):
+        """Init guard of NLU calls of a chatbot.
+
+        Args:
+            timeout (optional): Seconds to wait for an NLU call, including
+                hedged one. None for no timeout.
+            breaker (optional): `CircuitBreaker` of the chatbot backend.
+                Default is a new one, named after the chatbot vendor.
+            hedge_after (optional): If given, a second identical call is made
+                when the first one is not done in this seconds, and the first
+                result is taken. Only for idempotent calls.
+            max_workers (optional): Maximum number of concurrent blocking
+                calls. Calls waiting for a worker count toward timeout.
+            fallback_reply (optional): Canned reply when NLU is unavailable.
+        """
+        self.timeout = timeout
+        if breaker is None:
+            breaker = CircuitBreaker()
+        self.breaker = breaker
+        self.hedge_after = hedge_after
+        self.fallback_reply = fallback_reply
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.hedged = 0
+
+    def bind(self, vendor):
+        """Name the breaker after the vendor of the guarded chatbot, unless
+        named explicitly."""
+        self.breaker.bind(vendor)
+
+    def _before(self):
+        if not self.breaker.allow():
+            NLU_FAILURES.inc((self.breaker.name, 'open'))
+            raise CircuitOpenError("Circuit breaker '{}' is open".
+                                   format(self.breaker.name))
+
+    def _after(self, error):
+        if error is None:
+            self.breaker.record_success()
+            return
+        self.breaker.record_failure()
+        reason = 'timeout' if isinstance(error, NLUTimeout) else 'error'
+        NLU_FAILURES.inc((self.breaker.name, reason))
+        raise error
+
+    def call(self, func, *args):
+        """Call blocking NLU function with timeout, breaker and hedging.
+
+        Raises:
+            NLUUnavailable: If rejected, timed out or failed.
+        """
+        self._before()
+        deadline = None if self.timeout is None else\
+            time.time() + self.timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.time())
+
+        futures = [self.executor.submit(func, *args)]
+        error = None
+        if self.hedge_after is not None:
+            timeout = self.hedge_after if deadline is None else\
+                min(self.hedge_after, remaining())
+            done, _ = wait(futures, timeout)
+            if not done:
+                self.hedged += 1
+                futures.append(self.executor.submit(func, *args))
+        while futures:
+            done, _ = wait(futures, remaining(), FIRST_COMPLETED)
+            if not done:
+                error = NLUTimeout("NLU call timed out")
+                break
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None:
+                    self._after(None)
+                    return future.result()
+                error = NLUError(str(future.exception()))
+        self._after(error)
+
+    async def call_async(self, coro_func, *args):
+        """Await NLU coroutine function with timeout, breaker and hedging.
+
+        Raises:
+            NLUUnavailable: If rejected, timed out or failed.
+        """
+        import asyncio
+        self._before()
+        loop = asyncio.get_event_loop()
+        deadline = None if self.timeout is None else\
+            loop.time() + self.timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - loop.time())
+
+        tasks = [asyncio.ensure_future(coro_func(*args))]
+        error = None
+        try:
+            if self.hedge_after is not None:
+                timeout = self.hedge_after if deadline is None else\
+                    min(self.hedge_after, remaining())
+                done, _ = await asyncio.wait(tasks, timeout=timeout)
+                if not done:
+                    self.hedged += 1
+                    tasks.append(asyncio.ensure_future(coro_func(*args)))
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=remaining(),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    error = NLUTimeout("NLU call timed out")
+                    break
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        self._after(None)
+                        return task.result()
+                    error = NLUError(str(task.exception()))
+        finally:
+            for task in tasks:
+                task.cancel()
+        self._after(error)
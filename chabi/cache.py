@@ -0,0 +1,208 @@
+"""In-process caches."""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None):
+        """Init LRU cache with optional TTL and memory cap.
+
+        Args:
+            max_entries (optional): Maximum number of entries.
+            ttl (optional): Time to live of an entry in seconds. None for no
+                expiration.
+            max_bytes (optional): Maximum sum of entry sizes given to `put`.
+                None for no memory cap.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get value of the key, refreshing its recency.
+
+        Returns:
+            Cached value, or `default` if missing or expired.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, size, expire = item
+                if expire is None or expire > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value, size=0):
+        """Put value of the key, evicting least recently used entries.
+
+        Args:
+            key: Cache key.
+            value: Value to cache.
+            size (optional): Approximate size of the value in bytes.
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expire = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, expire)
+            self.nbytes += size
+            while len(self._data) > self.max_entries or\
+                    (self.max_bytes is not None and
+                     self.nbytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key):
+        """Remove the key if exists."""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self.nbytes -= size
+
+
+def normalize_text(text):
+    """Normalize message text for cache key."""
+    return ' '.join(text.lower().split())
+
+
+class AnalysisCache(object):
+
+    def __init__(self, max_entries=1024, ttl=300, max_bytes=4 * 1024 * 1024,
+                 max_sessions=10000):
+        """Init NLU analysis cache.
+
+        Only context-free results are cached, and sessions in the middle of
+        a dialog (having active contexts) always bypass the cache, so that
+        entity filling works as before.
+
+        Args:
+            max_entries (optional): Maximum number of cached results.
+            ttl (optional): Time to live of a result in seconds.
+            max_bytes (optional): Memory cap of cached results in bytes.
+            max_sessions (optional): Maximum number of tracked dialog
+                sessions.
+        """
+        self.results = LRUCache(max_entries, ttl, max_bytes)
+        self.dialogs = LRUCache(max_sessions, ttl)
+        self.bypasses = 0
+
+    @property
+    def hits(self):
+        return self.results.hits
+
+    @property
+    def misses(self):
+        return self.results.misses
+
+    def stats(self):
+        """Return cache counters."""
+        return dict(hits=self.hits, misses=self.misses,
+                    bypasses=self.bypasses, entries=len(self.results),
+                    bytes=self.results.nbytes)
+
+    def get(self, session_id, msg, lang):
+        """Get cached analysis result.
+
+        Returns:
+            dict: Analyzed data, or None. It is shared, do not modify.
+        """
+        if self.dialogs.get(session_id):
+            self.bypasses += 1
+            return
+        return self.results.get((normalize_text(msg), lang, True))
+
+    def put(self, session_id, msg, lang, data, context_free, size=0):
+        """Put analysis result, if context free.
+
+        Args:
+            session_id: Chatbot session id.
+            msg: Analyzed text. None for a result not from text (event).
+            lang: Language of analysis.
+            data: Analyzed data.
+            context_free: Whether the result is context free.
+            size (optional): Approximate size of data in bytes.
+        """
+        if not context_free:
+            self.dialogs.put(session_id, True)
+            return
+        self.dialogs.pop(session_id)
+        if msg is not None:
+            self.results.put((normalize_text(msg), lang, True), data, size)
+
+
+class AccountLinkCache(object):
+
+    def __init__(self, max_entries=10000, ttl=60):
+        """Init account link state cache.
+
+        Caches both linked and unlinked(negative) state of senders. Local
+        changes are broadcast to invalidation hooks, so that other processes
+        can drop their stale state.
+
+        Args:
+            max_entries (optional): Maximum number of cached senders.
+            ttl (optional): Time to live of a state in seconds. Bounds
+                staleness when there is no cross-process invalidation.
+        """
+        self.states = LRUCache(max_entries, ttl)
+        self.hooks = []
+
+    def get(self, sender_id):
+        """Get cached state.
+
+        Returns:
+            boolean: Whether linked or not. None if not cached.
+        """
+        return self.states.get(sender_id)
+
+    def put(self, sender_id, linked):
+        """Cache state read from DB."""
+        self.states.put(sender_id, linked)
+
+    def update(self, sender_id, linked):
+        """Cache state changed by this process, then call hooks.
+
+        Args:
+            sender_id: Messenger user id.
+            linked: Whether linked or not.
+        """
+        self.states.put(sender_id, linked)
+        for hook in self.hooks:
+            hook(sender_id)
+
+    def invalidate(self, sender_id):
+        """Drop cached state, e.g. on invalidation from other process."""
+        self.states.pop(sender_id)
+
+    def add_hook(self, hook):
+        """Add invalidation hook.
+
+        Args:
+            hook: Callable of `(sender_id)`, called when state of the sender
+                is changed by this process.
+        """
+        self.hooks.append(hook)
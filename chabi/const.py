@@ -1 +1,7 @@
 POSTBACK_TEST_TOKEN = 'TEST_TOKEN'
+
+# postback token status
+TOKEN_VALID = 'valid'
+TOKEN_INVALID = 'invalid'
+TOKEN_CLOSED = 'closed'
+TOKEN_EXPIRED = 'expired'
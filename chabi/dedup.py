@@ -0,0 +1,143 @@
+"""De-duplication of redelivered webhook events."""
+import os
+import time
+import sqlite3
+import threading
+
+from chabi.cache import LRUCache
+from chabi.metrics import REGISTRY
+
+
+DUPLICATES = REGISTRY.counter(
+    'chabi_duplicate_events_total', 'Number of dropped duplicate webhook '
+    'events.', ('vendor',))
+
+
+class SeenSetBase(object):
+
+    def __init__(self, ttl=300):
+        """Init seen-set of event keys.
+
+        Args:
+            ttl (optional): Seconds an event key is remembered. Should cover
+                redelivery period of the messenger.
+        """
+        self.ttl = ttl
+        self.checked = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return de-duplication counters."""
+        return dict(checked=self.checked, duplicates=self.duplicates)
+
+    def check(self, key, vendor=''):
+        """Mark the key as seen.
+
+        Args:
+            key: Event key. None for an event which can't be identified.
+            vendor (optional): Vendor name for metrics.
+
+        Returns:
+            boolean: True if the key was already seen(duplicate).
+        """
+        if key is None:
+            return False
+        dup = self._add(key)
+        with self._lock:
+            self.checked += 1
+            if dup:
+                self.duplicates += 1
+        if dup:
+            DUPLICATES.inc((vendor,))
+        return dup
+
+    def _add(self, key):
+        """Atomically add the key.
+
+        Returns:
+            boolean: True if the key already existed.
+        """
+        raise NotImplementedError()
+
+
+class MemorySeenSet(SeenSetBase):
+    """In-memory seen-set for single process deployment."""
+
+    def __init__(self, ttl=300, max_entries=100000):
+        super(MemorySeenSet, self).__init__(ttl)
+        self.keys = LRUCache(max_entries, ttl)
+        self._add_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _add(self, key):
+        with self._add_lock:
+            if self.keys.get(key) is not None:
+                return True
+            self.keys.put(key, True)
+            return False
+
+
+class SQLiteSeenSet(SeenSetBase):
+    """Seen-set on a SQLite file shared by worker processes of a host.
+
+    Keys are inserted with autocommit, so a key is visible to other workers
+    as soon as it is checked.
+    """
+
+    def __init__(self, filename, ttl=300, purge_every=1000):
+        """Init SQLite seen-set.
+
+        Args:
+            filename: SQLite file path.
+            ttl (optional): Seconds an event key is remembered.
+            purge_every (optional): Purge expired keys once per this number
+                of checks.
+        """
+        super(SQLiteSeenSet, self).__init__(ttl)
+        self.filename = os.path.abspath(filename)
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._nadd = 0
+        con = self._connect()
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('CREATE TABLE IF NOT EXISTS seen_event '
+                    '(key TEXT PRIMARY KEY, seen_ts REAL NOT NULL)')
+        con.execute('CREATE INDEX IF NOT EXISTS seen_event_ts ON seen_event '
+                    '(seen_ts)')
+
+    def _connect(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.filename, timeout=5,
+                                  isolation_level=None)
+            self._local.con = con
+        return con
+
+    def _add(self, key):
+        con = self._connect()
+        now = time.time()
+        cur = con.execute('INSERT OR IGNORE INTO seen_event VALUES (?, ?)',
+                          (key, now))
+        if cur.rowcount == 0:
+            # expired key is not a duplicate
+            cur = con.execute('UPDATE seen_event SET seen_ts = ? WHERE key = ?'
+                              ' AND seen_ts < ?', (now, key, now - self.ttl))
+            if cur.rowcount == 0:
+                return True
+        self._nadd += 1
+        if self._nadd % self.purge_every == 0:
+            self.purge()
+        return False
+
+    def purge(self):
+        """Remove expired keys.
+
+        Returns:
+            int: Number of removed keys.
+        """
+        cur = self._connect().execute('DELETE FROM seen_event WHERE seen_ts '
+                                      '< ?', (time.time() - self.ttl,))
+        return cur.rowcount
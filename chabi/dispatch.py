@@ -0,0 +1,77 @@
+"""Per-sender ordered parallel dispatch of messaging events."""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from chabi.util import NULL_COLLECTOR
+
+
+class SenderDispatcher(object):
+
+    def __init__(self, app, handler, key_func, max_workers=8):
+        """Init sender dispatcher.
+
+        Events are sharded by sender. Events of one sender are handled
+        strictly in order by one task, and tasks of different senders run
+        concurrently on a thread pool.
+
+        Args:
+            app: A Flask app instance.
+            handler: Callable of `(event, results)` to handle an event,
+                appending its results to `results`. Called
+                within app context and DB session in a pool thread.
+            key_func: Callable to get sender key from an event.
+            max_workers (optional): Maximum number of concurrent senders.
+        """
+        self.app = app
+        self.logger = app.logger
+        self.handler = handler
+        self.key_func = key_func
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def dispatch(self, events, collector=None):
+        """Dispatch events and wait for all of them.
+
+        Args:
+            events: Iterable of events.
+            collector (optional): Object with `append`(e.g. a list) to
+                receive results, in original event order. If None, results
+                are discarded.
+
+        Returns:
+            The collector.
+        """
+        shards = OrderedDict()
+        nevent = 0
+        for mevent in events:
+            key = self.key_func(mevent)
+            shards.setdefault(key, []).append((nevent, mevent))
+            nevent += 1
+
+        slots = None
+        if collector is not None:
+            slots = [[] for _ in range(nevent)]
+        futures = [self.executor.submit(self._handle_shard, shard, slots)
+                   for shard in shards.values()]
+        for future in futures:
+            future.result()
+        if slots is not None:
+            for results in slots:
+                for res in results:
+                    collector.append(res)
+        return collector
+
+    def _handle_shard(self, shard, slots):
+        from chabi.models import db_session
+        with self.app.app_context(), db_session:
+            for idx, mevent in shard:
+                results = NULL_COLLECTOR if slots is None else slots[idx]
+                try:
+                    self.handler(mevent, results)
+                except Exception:
+                    self.logger.exception("Fail to handle event: %s",
+                                          mevent)
+
+    def shutdown(self, wait=True):
+        """Shutdown thread pool."""
+        self.executor.shutdown(wait)
@@ -0,0 +1,136 @@
+"""Typed messaging events, parsed once from webhook payloads."""
+
+
+TEXT = 'text'
+QUICK_REPLY = 'quick_reply'
+POSTBACK = 'postback'
+ACCOUNT_LINK = 'account_link'
+ATTACHMENT = 'attachment'
+UNKNOWN = 'unknown'
+
+
+class MessagingEvent(object):
+    """Messaging event of a sender.
+
+    Subclasses set all attributes in their own `__init__` rather than by
+    `super()`, which would cost as much as parsing on the hot path.
+
+    Attributes:
+        sender_id: Messenger id of the sender.
+        recipient_id: Messenger id of the recipient(e.g. page).
+        timestamp: Event time in milliseconds.
+        key: Key identifying the event across redeliveries, None if not
+            identifiable.
+    """
+
+    __slots__ = ('sender_id', 'recipient_id', 'timestamp', 'key')
+    # event type for dispatch
+    type = UNKNOWN
+
+    def __init__(self, sender_id, recipient_id=None, timestamp=None,
+                 key=None):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.timestamp = timestamp
+        self.key = key
+
+    def __repr__(self):
+        fields = [name for klass in reversed(type(self).__mro__)
+                  for name in getattr(klass, '__slots__', ())]
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in fields))
+
+
+class UnknownEvent(MessagingEvent):
+    """Event with nothing to handle, e.g. delivery or read receipt."""
+
+    __slots__ = ()
+
+
+class TextEvent(MessagingEvent):
+
+    __slots__ = ('text',)
+    type = TEXT
+
+    def __init__(self, sender_id, recipient_id, timestamp, key, text):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.timestamp = timestamp
+        self.key = key
+        self.text = text
+
+
+class QuickReplyEvent(TextEvent):
+
+    __slots__ = ('payload',)
+    type = QUICK_REPLY
+
+    def __init__(self, sender_id, recipient_id, timestamp, key, text,
+                 payload):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.timestamp = timestamp
+        self.key = key
+        self.text = text
+        self.payload = payload
+
+
+class PostbackEvent(MessagingEvent):
+    """Postback of a button.
+
+    Attributes:
+        postback: Postback data, with `payload`.
+        postback_type: Route key of the postback.
+        token: Postback token of app defined button, None for predefined
+            button.
+    """
+
+    __slots__ = ('postback', 'postback_type', 'token')
+    type = POSTBACK
+
+    def __init__(self, sender_id, recipient_id, timestamp, key, postback,
+                 postback_type=None, token=None):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.timestamp = timestamp
+        self.key = key
+        self.postback = postback
+        self.postback_type = postback_type
+        self.token = token
+
+    @property
+    def payload(self):
+        return self.postback['payload']
+
+
+class AccountLinkEvent(MessagingEvent):
+
+    __slots__ = ('status', 'auth_code')
+    type = ACCOUNT_LINK
+
+    def __init__(self, sender_id, recipient_id, timestamp, key, status,
+                 auth_code=None):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.timestamp = timestamp
+        self.key = key
+        self.status = status
+        self.auth_code = auth_code
+
+    @property
+    def linked(self):
+        return self.status != 'unlinked'
+
+
+class AttachmentEvent(MessagingEvent):
+    """Message with attachments but no text."""
+
+    __slots__ = ('attachments',)
+    type = ATTACHMENT
+
+    def __init__(self, sender_id, recipient_id, timestamp, key, attachments):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.timestamp = timestamp
+        self.key = key
+        self.attachments = attachments
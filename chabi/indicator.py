@@ -0,0 +1,165 @@
+"""Fire-and-forget, coalesced typing indicators."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from chabi.cache import LRUCache
+
+
+class TypingIndicatorBase(object):
+
+    def __init__(self, app, send, window=5.0, max_senders=10000):
+        """Init typing indicator.
+
+        An indicator is sent off the critical path of handling an event.
+        Indicators to a sender within `window` seconds are coalesced into one,
+        until a reply is sent to the sender. A pending indicator is dropped if
+        the reply is ready first.
+
+        Args:
+            app: An app instance.
+            send: Callable of `(recipient_id)` which sends typing indicator.
+            window (optional): Seconds to coalesce indicators to a sender.
+            max_senders (optional): Maximum number of tracked senders.
+        """
+        self.app = app
+        self.logger = app.logger
+        self.send = send
+        self.window = window
+        # sender: [pending send, whether started]
+        self._states = LRUCache(max_senders, window)
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def stats(self):
+        """Return indicator counters."""
+        return dict(sent=self.sent, coalesced=self.coalesced,
+                    dropped=self.dropped)
+
+    def _claim(self, sender_id):
+        """Make state of a new indicator to the sender.
+
+        Returns:
+            list: New state, or None if coalesced into a recent one.
+        """
+        with self._lock:
+            if self._states.get(sender_id) is not None:
+                self.coalesced += 1
+                return
+            state = [None, False]
+            self._states.put(sender_id, state)
+            return state
+
+    def _release(self, sender_id):
+        """Forget indicator state of the sender, as the reply clears it.
+
+        Returns:
+            list: Indicator state, or None.
+        """
+        with self._lock:
+            state = self._states.get(sender_id)
+            self._states.pop(sender_id)
+            return state
+
+
+class TypingIndicator(TypingIndicatorBase):
+
+    def __init__(self, app, send, max_workers=2, window=5.0,
+                 max_senders=10000):
+        """Init typing indicator sending on a thread pool.
+
+        Args:
+            max_workers (optional): Number of sending threads. If 0,
+                indicators are sent inline (still coalesced).
+        """
+        super(TypingIndicator, self).__init__(app, send, window, max_senders)
+        self.executor = None
+        if max_workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers)
+
+    def notify(self, sender_id):
+        """Send typing indicator to the sender in background.
+
+        Returns:
+            boolean: False if coalesced into a recent indicator.
+        """
+        state = self._claim(sender_id)
+        if state is None:
+            return False
+        if self.executor is None:
+            self._send(sender_id, state)
+        else:
+            state[0] = self.executor.submit(self._send, sender_id, state)
+        return True
+
+    def done(self, sender_id):
+        """Call before sending a reply to the sender.
+
+        Drops the pending indicator, or waits for the one being sent, so that
+        it never arrives after the reply.
+        """
+        state = self._release(sender_id)
+        if state is None or state[0] is None:
+            return
+        if state[0].cancel():
+            with self._lock:
+                self.dropped += 1
+        else:
+            state[0].result()
+
+    def _send(self, sender_id, state):
+        state[1] = True
+        try:
+            self.send(sender_id)
+        except Exception:
+            self.logger.exception("Fail to send typing indicator to %s",
+                                  sender_id)
+        else:
+            with self._lock:
+                self.sent += 1
+
+    def shutdown(self, wait=True):
+        """Shutdown thread pool."""
+        if self.executor is not None:
+            self.executor.shutdown(wait)
+
+
+class AsyncTypingIndicator(TypingIndicatorBase):
+    """Typing indicator sending in background tasks of `chabi.aio.AsyncApp`.
+
+    `send` is a coroutine function.
+    """
+
+    def notify(self, sender_id):
+        """Send typing indicator to the sender in a background task.
+
+        Returns:
+            boolean: False if coalesced into a recent indicator.
+        """
+        state = self._claim(sender_id)
+        if state is None:
+            return False
+        state[0] = self.app.spawn(self._send(sender_id, state))
+        return True
+
+    async def done(self, sender_id):
+        """Await before sending a reply to the sender."""
+        state = self._release(sender_id)
+        if state is None or state[0] is None:
+            return
+        if not state[1]:
+            state[0].cancel()
+            self.dropped += 1
+        else:
+            await state[0]
+
+    async def _send(self, sender_id, state):
+        state[1] = True
+        try:
+            await self.send(sender_id)
+        except Exception:
+            self.logger.exception("Fail to send typing indicator to %s",
+                                  sender_id)
+        else:
+            self.sent += 1
@@ -0,0 +1,214 @@
+"""Local fast-path intent resolver in front of the remote NLU."""
+import re
+import json
+import math
+import time
+import threading
+
+from chabi.cache import LRUCache, normalize_text
+from chabi.metrics import REGISTRY
+
+
+DEFAULT_PHRASES = {
+    'login': 'login',
+    'log in': 'login',
+    'sign in': 'login',
+    'logout': 'logout',
+    'log out': 'logout',
+    'sign out': 'logout',
+}
+DEFAULT_STOPWORDS = frozenset(['a', 'an', 'the', 'please', 'me', 'my', 'i',
+                               'to', 'want', 'let', 'can', 'you', 'now'])
+TOKEN_PTN = re.compile(r'\w+', re.UNICODE)
+
+LOCAL_INTENTS = REGISTRY.counter(
+    'chabi_local_intent_total', 'Local intent resolutions by source(miss for '
+    'fall through to the remote NLU).', ('source',))
+
+
+def tokenize(text):
+    """Split text into lower case word tokens."""
+    return TOKEN_PTN.findall(text.lower())
+
+
+def _intent(value):
+    """Make intent dict from action name or dict."""
+    if isinstance(value, dict):
+        return value
+    return dict(action=value)
+
+
+def build_model(examples, stopwords=DEFAULT_STOPWORDS):
+    """Build bag-of-words model from example sentences.
+
+    Args:
+        examples: Dict of action to list of example sentences.
+        stopwords (optional): Tokens to ignore.
+
+    Returns:
+        dict: Model data, which can be saved by `save_model`.
+    """
+    intents = {}
+    for action, sentences in examples.items():
+        weights = {}
+        for sentence in sentences:
+            for token in tokenize(sentence):
+                if token not in stopwords:
+                    weights[token] = weights.get(token, 0) + 1
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1
+        intents[action] = dict(tokens={t: round(w / norm, 4) for t, w in
+                                       weights.items()})
+    return dict(version=1, intents=intents)
+
+
+def save_model(path, model):
+    """Save model in compact JSON."""
+    with open(path, 'w') as f:
+        json.dump(model, f, separators=(',', ':'), sort_keys=True)
+
+
+def load_model(path):
+    """Load model saved by `save_model`."""
+    with open(path) as f:
+        return json.load(f)
+
+
+class LocalIntentResolver(object):
+
+    def __init__(self, phrases=None, keywords=(), model=None, threshold=0.8,
+                 stopwords=DEFAULT_STOPWORDS, max_sessions=10000,
+                 dialog_ttl=300):
+        """Init local intent resolver.
+
+        Messages are matched against exact phrases, then keyword rules, then
+        the model. A match with confidence lower than `threshold` falls
+        through to the remote NLU. Sessions in the middle of a dialog(having
+        active contexts in the remote NLU) always fall through, so that entity
+        filling works as before.
+
+        Args:
+            phrases (optional): Dict of normalized phrase to action name or
+                intent dict(`action`, optional `speech` and `parameters`).
+                Default is `DEFAULT_PHRASES`.
+            keywords (optional): List of `(keywords, intent)` rules. Matches
+                if all keywords are in the message, with confidence of the
+                ratio of keywords to non-stopword tokens of the message.
+            model (optional): Model data or path to model file made by
+                `build_model`/`save_model`. Confidence is cosine similarity of
+                the message to the intent.
+            threshold (optional): Minimum confidence to resolve locally.
+            stopwords (optional): Tokens ignored by keywords and model.
+            max_sessions (optional): Maximum number of tracked dialog
+                sessions.
+            dialog_ttl (optional): Seconds a session stays in dialog after
+                the last remote analysis with contexts.
+        """
+        if phrases is None:
+            phrases = DEFAULT_PHRASES
+        self.phrases = dict((normalize_text(phrase), _intent(intent)) for
+                            phrase, intent in phrases.items())
+        self.keywords = [(frozenset(tokenize(' '.join(kws))), _intent(intent))
+                         for kws, intent in keywords]
+        if isinstance(model, str):
+            model = load_model(model)
+        self.model = model
+        self.threshold = threshold
+        self.stopwords = stopwords
+        self.dialogs = LRUCache(max_sessions, dialog_ttl)
+        self.counts = dict(phrase=0, keyword=0, model=0, miss=0, dialog=0)
+        self._lock = threading.Lock()
+
+    @property
+    def hits(self):
+        return self.counts['phrase'] + self.counts['keyword'] +\
+            self.counts['model']
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.counts['miss'] + self.counts['dialog']
+        return self.hits / float(total) if total else 0.0
+
+    def stats(self):
+        """Return resolution counters and hit rate."""
+        stats = dict(self.counts)
+        stats.update(hits=self.hits, hit_rate=self.hit_rate)
+        return stats
+
+    def observe(self, session_id, context_free):
+        """Track dialog state of the session from remote analysis."""
+        if context_free:
+            self.dialogs.pop(session_id)
+        else:
+            self.dialogs.put(session_id, True)
+
+    def match(self, msg):
+        """Match message to a local intent.
+
+        Returns:
+            dict: Matched intent, or None.
+            str: Match source, one of `phrase`, `keyword` and `model`.
+            float: Confidence.
+        """
+        intent = self.phrases.get(normalize_text(msg))
+        if intent is not None:
+            return intent, 'phrase', 1.0
+
+        tokens = set(t for t in tokenize(msg) if t not in self.stopwords)
+        if not tokens:
+            return None, None, 0.0
+        best = None, None, 0.0
+        for kws, intent in self.keywords:
+            if kws <= tokens:
+                conf = len(kws) / float(len(tokens))
+                if conf > best[2]:
+                    best = intent, 'keyword', conf
+        if best[2] >= self.threshold or self.model is None:
+            return best
+
+        qnorm = math.sqrt(len(tokens))
+        for action, intent in self.model['intents'].items():
+            weights = intent['tokens']
+            conf = sum(weights.get(t, 0) for t in tokens) / qnorm
+            if conf > best[2]:
+                best = dict(intent, action=action), 'model', conf
+        return best
+
+    def resolve(self, session_id, msg, lang='en'):
+        """Resolve message locally.
+
+        Returns:
+            dict: Analyzed data in API.AI result shape, or None to fall
+                through to the remote NLU.
+        """
+        if self.dialogs.get(session_id):
+            source = 'dialog'
+        else:
+            intent, source, conf = self.match(msg)
+            if intent is None or conf < self.threshold:
+                source = 'miss'
+        with self._lock:
+            self.counts[source] += 1
+        LOCAL_INTENTS.inc((source,))
+        if source in ('dialog', 'miss'):
+            return
+
+        action = intent['action']
+        return {
+            'id': 'local',
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'lang': lang,
+            'sessionId': session_id,
+            'result': {
+                'source': 'local',
+                'resolvedQuery': msg,
+                'action': action,
+                'actionIncomplete': False,
+                'parameters': dict(intent.get('parameters', {})),
+                'contexts': [],
+                'metadata': {'intentName': action, 'matchSource': source},
+                'fulfillment': {'speech': intent.get('speech', ''),
+                                'messages': []},
+                'score': round(conf, 4),
+            },
+            'status': {'code': 200, 'errorType': 'success'},
+        }
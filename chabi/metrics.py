@@ -0,0 +1,204 @@
+"""Per-stage latency metrics in Prometheus text format."""
+import bisect
+import threading
+from timeit import default_timer
+
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+                   10)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').\
+        replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """Increase counter of the label values."""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(self, name, doc, labels=()):
+        super(Gauge, self).__init__(name, doc, labels)
+        self._funcs = {}
+
+    def set(self, value, labels=()):
+        """Set gauge value of the label values."""
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, func, labels=()):
+        """Get gauge value of the label values by calling `func` at
+        collection."""
+        with self._lock:
+            self._funcs[labels] = func
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+            items += [(labels, func()) for labels, func in
+                      self._funcs.items()]
+        for labels, value in items:
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # labels: [bucket counts..., sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        """Observe a value of the label values."""
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[idx] += 1
+            counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self._values.get(labels)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(counts)) for labels, counts in
+                     self._values.items()]
+        for labels, counts in items:
+            acc = 0
+            for bound, cnt in zip(self.buckets + ('+Inf',), counts[:-1]):
+                acc += cnt
+                yield self.name + '_bucket', _format_labels(
+                    self.labels, labels, ('le', bound)), acc
+            lbl = _format_labels(self.labels, labels)
+            yield self.name + '_sum', lbl, counts[-1]
+            yield self.name + '_count', lbl, acc
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        """Render all metrics in Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.doc))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    'chabi_stage_seconds', 'Latency of processing stages in seconds.',
+    ('stage', 'vendor', 'action'))
+STAGE_ERRORS = REGISTRY.counter(
+    'chabi_stage_errors_total', 'Number of processing stages which raised.',
+    ('stage', 'vendor', 'action'))
+
+
+class measure(object):
+    """Context manager measuring latency of a stage.
+
+    Stages are `webhook`, `analyze`, `trigger_event`, `action`, `template`,
+    `db` and `send`.
+
+    Example:
+        with measure('analyze', 'apiai'):
+            ...
+    """
+
+    __slots__ = ('labels', 'st')
+
+    def __init__(self, stage, vendor='', action=''):
+        self.labels = (stage, vendor, action or '')
+
+    def __enter__(self):
+        self.st = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(default_timer() - self.st, self.labels)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(self.labels)
+
+
+def metrics():
+    """Expose metrics in Prometheus text format."""
+    from flask import make_response
+    res = make_response(REGISTRY.render())
+    res.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return res
+
+
+class Metrics(object):
+
+    def __init__(self, app):
+        """Expose metrics at `/metrics` of the app.
+
+        Args:
+            app: A Flask app instance.
+        """
+        # Flask is only needed to expose metrics
+        from flask import Blueprint
+        blueprint = Blueprint('metrics', __name__)
+        blueprint.add_url_rule('/metrics', view_func=metrics, methods=['GET'])
+        app.metrics = self
+        app.register_blueprint(blueprint)
+        self.registry = REGISTRY
@@ -1,17 +1,34 @@
+import os
+import time
+import atexit
+import sqlite3
+import logging
+import threading
 from datetime import datetime
 
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
 from pony import orm
 from pony.orm import db_session  # NOQA
 
 db = orm.Database()
 
 
-def safe_db_init(db, sqlite_file):
+def safe_db_init(db, sqlite_file, wal=True):
     """Safe DB binding, mapping
 
     In automated test, multiple DB binds can occur, and cause
         "Database object already bound" error. This function
         handle error of duplicated binding.
+
+    Args:
+        db: Pony database.
+        sqlite_file: SQLite file path.
+        wal (optional): Enable WAL journal mode, so that readers don't block
+            writer.
     """
     try:
         db.bind('sqlite', sqlite_file, create_db=True)
@@ -22,6 +39,140 @@ def safe_db_init(db, sqlite_file):
             db.generate_mapping(create_tables=True)
         except orm.core.MappingError:
             pass
+        if wal:
+            enable_wal(db)
+
+
+def enable_wal(db):
+    """Enable WAL journal mode of SQLite file DB.
+
+    Note:
+        Journal mode can't be changed within a transaction, which Pony starts
+        for raw SQL. So it is set with a separate connection. WAL mode is
+        persistent in the DB file.
+    """
+    filename = db.provider.pool.filename
+    if not os.path.isfile(filename):
+        # in-memory DB
+        return
+    con = sqlite3.connect(filename)
+    try:
+        con.execute('PRAGMA journal_mode=WAL')
+    finally:
+        con.close()
+
+
+class WriteBatcher(object):
+
+    def __init__(self, max_batch=100, linger=0.005):
+        """Init write batcher.
+
+        Until started, submitted writes run inline in the caller's DB session.
+        Once started, writes from concurrent requests are coalesced and
+        committed in one transaction per batch by a background thread.
+
+        Note:
+            Writers must keep their own state for read-your-writes until
+            flushed(e.g. account link cache, token store overlay).
+
+        Args:
+            max_batch (optional): Maximum number of writes per transaction.
+            linger (optional): Seconds to wait for more writes to batch.
+        """
+        self.max_batch = max_batch
+        self.linger = linger
+        self.logger = logging.getLogger(__name__)
+        self.nbatch = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start background committer. Flushed at exit."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='chabi-write-batcher')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, func, *args):
+        """Submit a write.
+
+        Args:
+            func: Function doing DB mutations.
+            args: Arguments of the function.
+
+        Returns:
+            Result of the function if run inline, None if deferred.
+        """
+        # checked and enqueued under the lock, so that a write doesn't come
+        # after the final flush of `stop`
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put((func, args))
+                return
+        return func(*args)
+
+    def flush(self):
+        """Wait until all submitted writes are committed."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stop(self):
+        """Flush, then stop background committer."""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._queue.put(None)
+            thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.linger
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            writes = [w for w in batch if w is not None]
+            if writes:
+                self._commit(writes)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _commit(self, writes):
+        try:
+            with db_session:
+                for func, args in writes:
+                    func(*args)
+            self.nbatch += 1
+        except Exception:
+            if len(writes) == 1:
+                self.logger.exception("Fail to write %s", writes[0])
+                return
+            # isolate failing write
+            for write in writes:
+                self._commit([write])
+
+
+write_behind = WriteBatcher()
 
 
 class AccountLink(db.Entity):
@@ -31,6 +182,6 @@ class AccountLink(db.Entity):
 
 class PostbackToken(db.Entity):
     id = orm.PrimaryKey(int, auto=True)
-    value = orm.Required(str)
+    value = orm.Required(str, index=True)
     issue_dt = orm.Required(datetime)
     close_dt = orm.Optional(datetime)
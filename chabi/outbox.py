@@ -0,0 +1,353 @@
+"""Rate limited outbound outbox with backoff, retry and dead-lettering."""
+import time
+import heapq
+import random
+import atexit
+import logging
+import itertools
+import threading
+from collections import deque, namedtuple
+
+from chabi.metrics import REGISTRY
+
+
+SEND_OK = 'ok'
+SEND_RETRY = 'retry'
+SEND_THROTTLED = 'throttled'
+SEND_FAILED = 'failed'
+
+OUTBOX_DEPTH = REGISTRY.gauge(
+    'chabi_outbox_depth', 'Number of messages waiting in outbox.',
+    ('outbox',))
+OUTBOX_RETRIES = REGISTRY.counter(
+    'chabi_outbox_retries_total', 'Number of retried sends by cause.',
+    ('outbox', 'cause'))
+OUTBOX_DEAD_LETTERS = REGISTRY.counter(
+    'chabi_outbox_dead_letters_total', 'Number of dead-lettered messages by '
+    'reason.', ('outbox', 'reason'))
+
+DeadLetter = namedtuple('DeadLetter', ['key', 'recipient_id', 'data',
+                                       'status', 'body', 'reason',
+                                       'attempts'])
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        """Init token bucket.
+
+        Args:
+            rate: Tokens refilled per second.
+            burst: Maximum number of tokens.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.paused_until = 0
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for refill or pause."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold all takers for seconds, e.g. on throttling."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+class OutboxItem(object):
+    __slots__ = ('key', 'recipient_id', 'data', 'attempts')
+
+    def __init__(self, key, recipient_id, data):
+        self.key = key
+        self.recipient_id = recipient_id
+        self.data = data
+        self.attempts = 0
+
+
+class Outbox(object):
+
+    def __init__(self, rate=40, burst=80, max_queue=10000, max_retries=5,
+                 base_delay=0.5, max_delay=30, workers=4, put_timeout=1.0,
+                 max_dead_letters=1000, on_dead_letter=None, name='outbox'):
+        """Init outbox.
+
+        Messages are sent by background workers, within a token bucket per
+        key(page access token). Throttled and transiently failed sends are
+        retried with exponential backoff and jitter, and throttling also
+        pauses the whole key. Messages to a recipient are sent one at a time
+        in order, so a retry never overtakes or duplicates. Messages which
+        can't be sent are dead-lettered.
+
+        Args:
+            rate (optional): Sends per second per key.
+            burst (optional): Burst size of sends per key.
+            max_queue (optional): Maximum number of waiting messages,
+                including ones in backoff.
+            max_retries (optional): Maximum retries of a message.
+            base_delay (optional): Backoff seconds of the first retry.
+            max_delay (optional): Maximum backoff seconds.
+            workers (optional): Number of sending threads.
+            put_timeout (optional): Seconds to wait for room when full,
+                before dead-lettering the message.
+            max_dead_letters (optional): Number of kept dead letters.
+            on_dead_letter (optional): Callable of `(DeadLetter)`, e.g. to
+                persist it for replay.
+            name (optional): Name for metrics and threads.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.on_dead_letter = on_dead_letter
+        self.name = name
+        self.logger = logging.getLogger(__name__)
+        self.send = None
+        self.classify = None
+        self.depth = 0
+        self.nsent = 0
+        self.nretried = 0
+        self.dead_letters = deque(maxlen=max_dead_letters)
+        self.buckets = {}
+        # recipient: waiting items, head is being sent or due
+        self._queues = {}
+        # (due time, seq, recipient) of recipients ready to send
+        self._ready = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        OUTBOX_DEPTH.set_function(lambda: self.depth, (name,))
+
+    @property
+    def running(self):
+        return len(self._threads) > 0
+
+    def attach(self, send, classify):
+        """Attach vendor send function.
+
+        Args:
+            send: Callable of `(key, recipient_id, data)` returning
+                `(status, body)`. Status None means not sent, safe to retry.
+            classify: Callable of `(status, body)` returning one of
+                `SEND_OK`, `SEND_RETRY`, `SEND_THROTTLED` and `SEND_FAILED`.
+        """
+        self.send = send
+        self.classify = classify
+
+    def stats(self):
+        """Return outbox counters."""
+        return dict(depth=self.depth, sent=self.nsent, retried=self.nretried,
+                    dead_letters=len(self.dead_letters))
+
+    def start(self):
+        """Start sending workers. Flushed at exit."""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                th = threading.Thread(target=self._run,
+                                      name='chabi-{}-{}'.format(self.name, i))
+                th.daemon = True
+                th.start()
+                self._threads.append(th)
+        atexit.register(self.stop, self.max_delay)
+
+    def submit(self, key, recipient_id, data):
+        """Submit a message. Sent inline without retry until started.
+
+        Args:
+            key: Rate limit key(e.g. page access token).
+            recipient_id: Recipient id, which orders messages.
+            data: Message data.
+
+        Returns:
+            boolean: False if dead-lettered.
+        """
+        item = OutboxItem(key, recipient_id, data)
+        if not self._threads:
+            return self._send(item, False)
+
+        deadline = time.time() + self.put_timeout
+        with self._cond:
+            while self.depth >= self.max_queue:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+            if self.depth >= self.max_queue:
+                overflow = True
+            else:
+                overflow = False
+                self.depth += 1
+                items = self._queues.setdefault(recipient_id, deque())
+                items.append(item)
+                if len(items) == 1:
+                    self._schedule(recipient_id, 0)
+        if overflow:
+            self._dead_letter(item, None, None, 'overflow')
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until all submitted messages are sent or dead-lettered.
+
+        Returns:
+            boolean: True if flushed within timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.depth > 0 and self._threads:
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    return False
+                self._cond.wait(wait)
+        return True
+
+    def stop(self, timeout=None):
+        """Flush, then stop workers. Messages left after timeout are
+        dead-lettered."""
+        if not self._threads:
+            return
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for th in threads:
+            th.join()
+        with self._cond:
+            left = [item for items in self._queues.values() for item in items]
+            self._queues.clear()
+            self._ready = []
+            self.depth = 0
+        for item in left:
+            self._dead_letter(item, None, None, 'shutdown')
+
+    def _schedule(self, recipient_id, delay):
+        heapq.heappush(self._ready, (time.time() + delay, next(self._seq),
+                                     recipient_id))
+        self._cond.notify()
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets.setdefault(key, TokenBucket(self.rate,
+                                                              self.burst))
+        return bucket
+
+    def backoff(self, attempts):
+        """Backoff seconds after attempts, with jitter."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.time()
+                    if self._ready and self._ready[0][0] <= now:
+                        recipient_id = heapq.heappop(self._ready)[2]
+                        break
+                    wait = self._ready[0][0] - now if self._ready else None
+                    self._cond.wait(wait)
+                item = self._queues[recipient_id][0]
+
+            done, delay = True, 0
+            try:
+                self._bucket(item.key).acquire()
+                self._send(item, True)
+            except _Retry as e:
+                done, delay = False, e.delay
+
+            with self._cond:
+                items = self._queues[recipient_id]
+                if done:
+                    items.popleft()
+                    self.depth -= 1
+                    self._cond.notify_all()
+                if items:
+                    self._schedule(recipient_id, delay)
+                else:
+                    del self._queues[recipient_id]
+
+    def _send(self, item, retry):
+        """Send an item.
+
+        Returns:
+            boolean: True if sent, False if dead-lettered.
+
+        Raises:
+            _Retry: If the item should be retried after a delay.
+        """
+        item.attempts += 1
+        try:
+            status, body = self.send(item.key, item.recipient_id, item.data)
+        except Exception:
+            # outcome unknown, not retried to avoid duplicates
+            self.logger.exception("Fail to send to %s", item.recipient_id)
+            self._dead_letter(item, None, None, 'error')
+            return False
+
+        result = self.classify(status, body)
+        if result == SEND_OK:
+            with self._cond:
+                self.nsent += 1
+            return True
+        if result == SEND_FAILED:
+            self._dead_letter(item, status, body, 'failed')
+            return False
+        if not retry or item.attempts > self.max_retries:
+            self._dead_letter(item, status, body, 'retries')
+            return False
+
+        delay = self.backoff(item.attempts)
+        if result == SEND_THROTTLED:
+            self._bucket(item.key).pause(delay)
+        with self._cond:
+            self.nretried += 1
+        OUTBOX_RETRIES.inc((self.name, result))
+        self.logger.warning("Retry send to %s in %.2fs(%s %s)",
+                            item.recipient_id, delay, status, result)
+        raise _Retry(delay)
+
+    def _dead_letter(self, item, status, body, reason):
+        letter = DeadLetter(item.key, item.recipient_id, item.data, status,
+                            body, reason, item.attempts)
+        self.dead_letters.append(letter)
+        OUTBOX_DEAD_LETTERS.inc((self.name, reason))
+        self.logger.error("Dead letter to %s(%s %s): %s, data: %s",
+                          item.recipient_id, reason, status, body, item.data)
+        if self.on_dead_letter is not None:
+            try:
+                self.on_dead_letter(letter)
+            except Exception:
+                self.logger.exception("Fail to handle dead letter")
+
+
+class _Retry(Exception):
+    def __init__(self, delay):
+        super(_Retry, self).__init__(delay)
+        self.delay = delay
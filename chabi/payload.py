@@ -0,0 +1,224 @@
+"""Precompiled payload builders from JSON templates.
+
+A JSON template is rendered once with placeholder values, and the parsed
+result is compiled into a builder which makes payload dict directly. The
+template file stays the source of truth, while no render-then-parse round
+trip is needed for each payload.
+
+Only templates which substitute values can be compiled so: bare `{{ name }}`
+or `{{ name|tojson }}` of parameters, and `for` loops over loop parameters
+with an optional `{% if not loop.last %}` separator. Any other logic, like
+conditionals or other filters, would be evaluated on placeholders, so such
+templates are rendered for each payload instead.
+"""
+import re
+import json
+
+from jinja2 import nodes
+
+from chabi.cache import LRUCache
+from chabi.metrics import measure
+
+
+PLACEHOLDER = '@@chabi:{}@@'
+PLACEHOLDER_PTN = re.compile(r'@@chabi:([\w.]+)@@')
+
+
+def copy_json(data):
+    """Copy JSON compatible data, faster than `copy.deepcopy`."""
+    if type(data) is dict:
+        return {k: copy_json(v) for k, v in data.items()}
+    if type(data) is list:
+        return [copy_json(v) for v in data]
+    return data
+
+
+def _compile(node, loops):
+    if type(node) is dict:
+        items = [(k, _compile(v, loops)) for k, v in node.items()]
+        return lambda ctx, item: {k: f(ctx, item) for k, f in items}
+
+    if type(node) is list:
+        if len(node) == 1:
+            dumped = json.dumps(node[0])
+            for name in loops:
+                if '@@chabi:{}.'.format(name) in dumped:
+                    proto = _compile(node[0], loops)
+                    return lambda ctx, item: [proto(ctx, it) for it in
+                                              ctx.get(name, ())]
+        elems = [_compile(v, loops) for v in node]
+        return lambda ctx, item: [f(ctx, item) for f in elems]
+
+    if type(node) is str:
+        names = PLACEHOLDER_PTN.findall(node)
+        if len(names) == 0:
+            return lambda ctx, item: node
+        if node == PLACEHOLDER.format(names[0]):
+            return _value_getter(names[0])
+        getters = [(PLACEHOLDER.format(name), _value_getter(name)) for name
+                   in names]
+
+        def fmt(ctx, item):
+            res = node
+            for ph, getter in getters:
+                res = res.replace(ph, str(getter(ctx, item)))
+            return res
+        return fmt
+
+    return lambda ctx, item: node
+
+
+def _value_getter(name):
+    if '.' in name:
+        idx = int(name.split('.')[1])
+        return lambda ctx, item: item[idx]
+    return lambda ctx, item: ctx.get(name, '')
+
+
+def _is_value(node, names):
+    if type(node) is nodes.Filter:
+        if node.name != 'tojson' or node.args or node.kwargs or\
+                node.dyn_args or node.dyn_kwargs:
+            return False
+        node = node.node
+    return type(node) is nodes.Name and node.name in names
+
+
+def _is_separator(node):
+    # {% if not loop.last %}...{% endif %} of constant text
+    test = node.test
+    return type(test) is nodes.Not and type(test.node) is nodes.Getattr and\
+        type(test.node.node) is nodes.Name and\
+        test.node.node.name == 'loop' and test.node.attr == 'last' and\
+        not node.elif_ and not node.else_ and\
+        all(type(child) is nodes.Output and
+            all(type(n) is nodes.TemplateData for n in child.nodes)
+            for child in node.body)
+
+
+def _is_compilable(body, params, loops, in_loop=False):
+    for node in body:
+        if type(node) is nodes.Output:
+            for child in node.nodes:
+                if type(child) is not nodes.TemplateData and\
+                        not _is_value(child, params):
+                    return False
+        elif type(node) is nodes.For:
+            target = node.target
+            targets = target.items if type(target) is nodes.Tuple else\
+                [target]
+            if in_loop or node.else_ or node.test is not None or\
+                    node.recursive or type(node.iter) is not nodes.Name or\
+                    node.iter.name not in loops or\
+                    len(targets) != loops[node.iter.name] or\
+                    any(type(t) is not nodes.Name for t in targets):
+                return False
+            names = set(params) | set(t.name for t in targets)
+            if not _is_compilable(node.body, names, loops, True):
+                return False
+        elif type(node) is nodes.If:
+            if not in_loop or not _is_separator(node):
+                return False
+        else:
+            return False
+    return True
+
+
+def is_compilable(template, params=(), loops=None):
+    """Return whether the template only substitutes values of the parameters,
+    so it can be compiled.
+
+    Args:
+        template: Jinja template which renders JSON.
+        params (optional): Names of scalar parameters.
+        loops (optional): Dict of loop parameter name to number of fields
+            of its tuple items.
+    """
+    env = template.environment
+    if env.loader is None or template.name is None:
+        return False
+    source = env.loader.get_source(env, template.name)[0]
+    return _is_compilable(env.parse(source).body, set(params), loops or {})
+
+
+class JSONTemplate(object):
+
+    def __init__(self, template, params=(), loops=None, vendor=''):
+        """Init JSON template, compiled on first build.
+
+        Templates which can't be compiled are rendered for each payload.
+
+        Args:
+            template: Jinja template which renders JSON.
+            params (optional): Names of scalar parameters.
+            loops (optional): Dict of loop parameter name to number of fields
+                of its tuple items. Loop must render a list of items.
+            vendor (optional): Vendor label of build metrics.
+        """
+        self.template = template
+        self.name = template.name
+        self.vendor = vendor
+        self.params = params
+        self.loops = loops or {}
+        # True if compiled, False if rendered for each payload, None before
+        # first build
+        self.compiled = None
+        self._builder = None
+
+    def _compile(self):
+        if not is_compilable(self.template, self.params, self.loops):
+            self.compiled = False
+            return self._render
+        ctx = dict((name, PLACEHOLDER.format(name)) for name in self.params)
+        for name, nfield in self.loops.items():
+            item = tuple(PLACEHOLDER.format('{}.{}'.format(name, i)) for i in
+                         range(nfield))
+            ctx[name] = [item]
+        data = json.loads(self.template.render(**ctx))
+        self.compiled = True
+        return _compile(data, list(self.loops.keys()))
+
+    def _render(self, ctx, item):
+        return json.loads(self.template.render(**ctx))
+
+    def _build(self, ctx, item):
+        builder = self._builder
+        if builder is None:
+            builder = self._builder = self._compile()
+        return builder(ctx, item)
+
+    def build(self, **kwargs):
+        """Build payload.
+
+        Returns:
+            dict: New payload data.
+        """
+        with measure('template', self.vendor, self.name):
+            return self._build(kwargs, None)
+
+
+class CachedJSONTemplate(JSONTemplate):
+
+    def __init__(self, template, params=(), loops=None, vendor='',
+                 max_entries=128):
+        """Init JSON template, caching payloads of same arguments.
+
+        Useful for static payloads, like account link of fixed URLs.
+        """
+        super(CachedJSONTemplate, self).__init__(template, params, loops,
+                                                 vendor)
+        self.cache = LRUCache(max_entries)
+
+    def build(self, **kwargs):
+        """Build payload, or copy cached one.
+
+        Returns:
+            dict: New payload data.
+        """
+        with measure('template', self.vendor, self.name):
+            key = tuple(sorted(kwargs.items()))
+            data = self.cache.get(key)
+            if data is None:
+                data = self._build(kwargs, None)
+                self.cache.put(key, data)
+            return copy_json(data)
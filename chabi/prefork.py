@@ -0,0 +1,422 @@
+"""Pre-fork worker processes with sender-hash routing of webhook payloads."""
+import time
+import atexit
+import bisect
+import signal
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from chabi.models import db_session, write_behind
+from chabi.metrics import REGISTRY
+from chabi.warmup import warm_up
+from chabi.worker import QueueBusy
+from chabi.vendor.facebook import get_sender_id, split_payload
+
+
+WORKER_RESTARTS = REGISTRY.counter(
+    'chabi_worker_restarts_total', 'Number of restarted worker processes by '
+    'cause.', ('cause',))
+ROUTED_EVENTS = REGISTRY.counter(
+    'chabi_routed_events_total', 'Number of messaging events routed to '
+    'worker processes.', ('worker',))
+
+
+def _hash(key):
+    return int(hashlib.md5(str(key).encode('utf8')).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=100):
+        """Init consistent hash ring.
+
+        Adding or removing a node only moves keys of that node.
+
+        Args:
+            nodes: Node names.
+            replicas (optional): Number of virtual points per node.
+        """
+        points = sorted((_hash('{}-{}'.format(node, i)), node) for node in
+                        nodes for i in range(replicas))
+        self.nodes = list(nodes)
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        """Return node of the key."""
+        idx = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[idx % len(self._nodes)]
+
+
+_CLOSE = object()
+
+
+class WorkerChannel(object):
+
+    def __init__(self, ctx, maxsize, name):
+        """Init one-way channel of payloads to a worker process.
+
+        Unlike `multiprocessing.Queue`, the reading end takes no lock, so a
+        killed worker can't leave it locked for its successor. Payloads are
+        buffered in the parent and fed to the pipe by a thread.
+
+        Args:
+            ctx: Multiprocessing context.
+            maxsize: Maximum number of payloads buffered in the parent.
+            name: Feeder thread name.
+        """
+        self.reader, self._writer = ctx.Pipe(duplex=False)
+        self._pending = queue.Queue(maxsize)
+        self._feeder = threading.Thread(target=self._feed, name=name)
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def put(self, data, timeout=None):
+        """Put payload, None to stop the worker.
+
+        Raises:
+            queue.Full: If the buffer stays full for timeout.
+        """
+        self._pending.put(data, timeout=timeout)
+
+    def close(self):
+        """Close after feeding buffered payloads."""
+        self._pending.put(_CLOSE)
+        self._feeder.join()
+        self.reader.close()
+
+    def _feed(self):
+        while True:
+            data = self._pending.get()
+            if data is _CLOSE:
+                self._writer.close()
+                return
+            self._writer.send(data)
+
+
+def stop_senders(app):
+    """Flush and stop background senders and queue of the messenger."""
+    for name in ('webhook_queue', 'batch_sender', 'outbox'):
+        comp = getattr(app.msgn, name, None)
+        if comp is not None:
+            comp.stop()
+
+
+def stop_write_behind(app):
+    """Commit pending DB writes."""
+    write_behind.stop()
+
+
+def stop_log_listener(app):
+    """Write queued log records."""
+    listener = getattr(app, 'log_listener', None)
+    if listener is not None:
+        listener.stop()
+
+
+# in order; log listener last, for records of the others
+DEFAULT_SHUTDOWN = (stop_senders, stop_write_behind, stop_log_listener)
+
+
+def _worker_main(app_factory, reader, max_payloads, warm, shutdown):
+    """Entry of a worker process."""
+    # parent stops workers through queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    app = app_factory()
+    handled = 0
+    try:
+        if warm:
+            warm_up(app)
+        while True:
+            try:
+                data = reader.recv()
+            except EOFError:
+                return
+            if data is None:
+                return
+            try:
+                with app.app_context(), db_session:
+                    app.msgn.handle_msg_data(data)
+            except Exception:
+                app.logger.exception("Fail to handle routed payload")
+            handled += 1
+            if max_payloads and handled >= max_payloads:
+                return
+    finally:
+        # multiprocessing skips exit handlers, so shut down explicitly
+        for func in shutdown:
+            try:
+                func(app)
+            except Exception:
+                app.logger.exception("Fail to shut down by %s", func)
+
+
+class PreforkPool(object):
+
+    def __init__(self, app_factory, workers=4, queue_size=1000,
+                 put_timeout=1.0, max_payloads=0, replicas=100,
+                 key_func=get_sender_id, start_method=None, warm=False,
+                 shutdown=DEFAULT_SHUTDOWN, name='chabi-worker'):
+        """Init pre-fork worker pool.
+
+        Each worker process builds its own app by `app_factory` and handles
+        the payloads routed to it. A front app only parses webhook payloads
+        and routes each messaging event by consistent hash of its sender, so
+        events of a user are handled in order by the same worker, which keeps
+        the user's account link, token and session state warm.
+
+        Dead workers are restarted on the same queue, so only the payload
+        being handled by a crashed worker is lost.
+
+        Note:
+            Metrics are per process. Workers can expose theirs with
+            `chabi.metrics.Metrics` on their own port if needed.
+
+        Args:
+            app_factory: Callable returning a new Flask app with messenger,
+                chatbot and event handler. Called in each worker and for the
+                front app.
+            workers (optional): Number of worker processes.
+            queue_size (optional): Maximum number of pending payloads per
+                worker.
+            put_timeout (optional): Seconds to wait for room in full worker
+                queues. If one stays full, the webhook answers 503 so that
+                the payload is redelivered. None to wait without limit.
+            max_payloads (optional): If greater than 0, a worker is recycled
+                after handling this number of payloads.
+            replicas (optional): Virtual points per worker in hash ring.
+            key_func (optional): Callable to get routing key from an event.
+            start_method (optional): Multiprocessing start method. Default is
+                the platform default(fork on Linux).
+            warm (optional): If True, apps are warmed up by
+                `chabi.warmup.warm_up` before handling payloads.
+            shutdown (optional): Functions called in order with the app when
+                a worker exits, to flush its background threads. More can be
+                added by `on_shutdown`.
+            name (optional): Prefix of worker process names.
+        """
+        self.app_factory = app_factory
+        self.workers = workers
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+        self.max_payloads = max_payloads
+        self.key_func = key_func
+        self.warm = warm
+        self.shutdown = list(shutdown)
+        self.name = name
+        self.logger = logging.getLogger(__name__)
+        self.ring = HashRing(range(workers), replicas)
+        self.ctx = multiprocessing.get_context(start_method)
+        self.queues = []
+        self.procs = []
+        self.restarts = 0
+        self.routed = 0
+        # guards worker processes, held while restarting one
+        self._lock = threading.RLock()
+        self._count_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._supervisor = None
+
+    @property
+    def running(self):
+        return self._supervisor is not None
+
+    def on_shutdown(self, func):
+        """Register function called with the app when a worker exits.
+        Affects workers started after."""
+        self.shutdown.append(func)
+        return func
+
+    def route(self, key):
+        """Return worker index of the routing key."""
+        return self.ring.node(key)
+
+    def stats(self):
+        """Return pool counters."""
+        with self._lock:
+            alive = sum(1 for proc in self.procs if proc.is_alive())
+        return dict(workers=self.workers, alive=alive, routed=self.routed,
+                    restarts=self.restarts)
+
+    def start(self):
+        """Fork workers and start supervising them.
+
+        Should be called before the front app is made, so that workers don't
+        inherit its threads and connections.
+        """
+        with self._lock:
+            if self._supervisor is not None:
+                return
+            self._stopping.clear()
+            self.queues = [WorkerChannel(self.ctx, self.queue_size,
+                                         '{}-feeder-{}'.format(self.name, i))
+                           for i in range(self.workers)]
+            self.procs = [None] * self.workers
+            for idx in range(self.workers):
+                self._spawn(idx)
+            self._supervisor = threading.Thread(
+                target=self._supervise, name='{}-supervisor'.format(self.name))
+            self._supervisor.daemon = True
+            self._supervisor.start()
+        atexit.register(self.stop)
+
+    def attach(self, app):
+        """Make the app a front app, routing its webhook payloads to
+        workers."""
+        app.msgn.webhook_queue = self
+
+    def put(self, data):
+        """Route messaging events of the payload to workers.
+
+        Each part waits for room in the queue of its worker, up to
+        `put_timeout` for the whole payload. Events are never handled by a
+        process other than the owner of their sender.
+
+        Args:
+            data: Page payload.
+
+        Returns:
+            boolean: True, as all parts are routed.
+
+        Raises:
+            QueueBusy: If not running, or a worker queue stays full. Parts
+                routed to other workers are kept, and their events are
+                dropped as duplicates by those workers when the messenger
+                redelivers the payload.
+        """
+        if self._supervisor is None or self._stopping.is_set():
+            raise QueueBusy("worker pool is not running")
+        deadline = None if self.put_timeout is None else\
+            time.time() + self.put_timeout
+        busy = []
+        for idx, part in split_payload(data, self.route,
+                                       self.key_func).items():
+            timeout = None if deadline is None else\
+                max(0, deadline - time.time())
+            try:
+                self.queues[idx].put(part, timeout=timeout)
+            except queue.Full:
+                busy.append(idx)
+                continue
+            nevent = sum(len(entry["messaging"]) for entry in part["entry"])
+            with self._count_lock:
+                self.routed += nevent
+            ROUTED_EVENTS.inc((str(idx),), nevent)
+        if busy:
+            raise QueueBusy("worker queue {} is full ({})".format(
+                ', '.join(str(idx) for idx in busy), self.queue_size))
+        return True
+
+    def restart(self, timeout=None):
+        """Restart workers one by one, e.g. to load new code.
+
+        Payloads queued before are handled by the old worker, and ones queued
+        after by the new worker, so order is kept.
+
+        Args:
+            timeout (optional): Seconds to wait for each old worker.
+        """
+        for idx in range(self.workers):
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+                proc = self.procs[idx]
+                self.queues[idx].put(None)
+                proc.join(timeout)
+                if proc.is_alive():
+                    self.logger.warning("Terminate worker %s", idx)
+                    proc.terminate()
+                    proc.join()
+                self._spawn(idx)
+                self._count_restart('restart')
+
+    def stop(self, timeout=10):
+        """Stop workers after they handle queued payloads.
+
+        Args:
+            timeout (optional): Seconds to wait for each worker, before
+                terminating it.
+        """
+        with self._lock:
+            supervisor = self._supervisor
+            if supervisor is None:
+                return
+            self._stopping.set()
+            self._supervisor = None
+            procs = self.procs
+            for wqueue in self.queues:
+                wqueue.put(None)
+        supervisor.join()
+        for proc in procs:
+            proc.join(timeout)
+            if proc.is_alive():
+                self.logger.warning("Terminate worker %s", proc.name)
+                proc.terminate()
+                proc.join()
+        for wqueue in self.queues:
+            wqueue.close()
+
+    def run(self, host='127.0.0.1', port=5000, **options):
+        """Start workers and serve front app until interrupted.
+
+        SIGHUP restarts workers.
+
+        Args:
+            host (optional): Host to listen.
+            port (optional): Port to listen.
+            options (optional): Options of `Flask.run`.
+        """
+        self.start()
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=self.restart, name='{}-restart'.format(self.name)).start())
+        app = self.app_factory()
+        if self.warm:
+            warm_up(app)
+        self.attach(app)
+        options.setdefault('threaded', True)
+        try:
+            app.run(host, port, use_reloader=False, **options)
+        finally:
+            self.stop()
+
+    def _spawn(self, idx):
+        proc = self.ctx.Process(target=_worker_main,
+                                args=(self.app_factory,
+                                      self.queues[idx].reader,
+                                      self.max_payloads, self.warm,
+                                      self.shutdown),
+                                name='{}-{}'.format(self.name, idx))
+        proc.daemon = True
+        proc.start()
+        self.procs[idx] = proc
+
+    def _count_restart(self, cause):
+        with self._count_lock:
+            self.restarts += 1
+        WORKER_RESTARTS.inc((cause,))
+
+    def _supervise(self):
+        while not self._stopping.wait(0.2):
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+                for idx, proc in enumerate(self.procs):
+                    if proc.is_alive():
+                        continue
+                    proc.join()
+                    if proc.exitcode == 0:
+                        cause = 'recycle'
+                        self.logger.info("Recycle worker %s", idx)
+                    else:
+                        cause = 'crash'
+                        self.logger.error("Worker %s exited with %s",
+                                          idx, proc.exitcode)
+                    self._spawn(idx)
+                    self._count_restart(cause)
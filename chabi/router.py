@@ -0,0 +1,154 @@
+"""Declarative routing of actions, quick reply payloads and postbacks to event
+handler methods."""
+
+
+ACTION = 'action'
+QUICK_REPLY = 'quick_reply'
+POSTBACK = 'postback'
+
+# method attribute of declared routes
+ROUTES_ATTR = '_chabi_routes'
+# class attribute of compiled router
+ROUTER_ATTR = '_chabi_router'
+
+# trie node key of value, never a character of keys
+_VALUE = ''
+
+
+class PrefixTrie(object):
+
+    def __init__(self):
+        """Init trie of key prefixes.
+
+        Lookup takes time of the key length, not the number of prefixes.
+        """
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, prefix, value):
+        """Insert value of the prefix, replacing old one if any."""
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        if _VALUE not in node:
+            self.size += 1
+        node[_VALUE] = value
+
+    def longest(self, key):
+        """Return value of the longest prefix of the key, None if no prefix
+        matches."""
+        node = self.root
+        value = node.get(_VALUE)
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                break
+            value = node.get(_VALUE, value)
+        return value
+
+
+class Router(object):
+
+    def __init__(self):
+        """Init router of keys to handlers, by route kind.
+
+        Exact keys take precedence over prefixes, and longer prefixes over
+        shorter ones.
+        """
+        self.exact = {}
+        self.prefixes = {}
+
+    def __len__(self):
+        return sum(len(table) for table in self.exact.values()) +\
+            sum(len(trie) for trie in self.prefixes.values())
+
+    def add(self, kind, handler, names=(), prefix=None):
+        """Add route of exact key names and/or key prefix to the handler.
+
+        Args:
+            kind: Route kind, e.g. `ACTION`.
+            handler: Handler, e.g. method name.
+            names (optional): Exact keys.
+            prefix (optional): Key prefix.
+        """
+        if names:
+            table = self.exact.setdefault(kind, {})
+            for name in names:
+                table[name] = handler
+        if prefix is not None:
+            self.prefixes.setdefault(kind, PrefixTrie()).insert(prefix,
+                                                                handler)
+
+    def resolve(self, kind, key):
+        """Return handler of the key, None if no route."""
+        if key is None:
+            return None
+        table = self.exact.get(kind)
+        if table is not None:
+            handler = table.get(key)
+            if handler is not None:
+                return handler
+        trie = self.prefixes.get(kind)
+        if trie is not None:
+            return trie.longest(key)
+
+
+def route(kind, names=(), prefix=None):
+    """Decorator declaring route of an event handler method.
+
+    Routes are compiled per class by `compile_routes`. A method can have
+    several routes.
+
+    Args:
+        kind: Route kind, e.g. `ACTION`.
+        names (optional): Exact keys.
+        prefix (optional): Key prefix.
+    """
+    def decorate(func):
+        routes = func.__dict__.setdefault(ROUTES_ATTR, [])
+        routes.append((kind, tuple(names), prefix))
+        return func
+    return decorate
+
+
+def on_action(*names, **options):
+    """Route chatbot actions of the names, or of `prefix` option, to the
+    method, called with `sender_id` and `data`."""
+    return route(ACTION, names, options.get('prefix'))
+
+
+def on_quick_reply(*payloads, **options):
+    """Route quick reply payloads, or ones starting with `prefix` option, to
+    the method, called with `sender_id`, `text` and `payload`."""
+    return route(QUICK_REPLY, payloads, options.get('prefix'))
+
+
+def on_postback(*types, **options):
+    """Route postbacks of the types, or of types starting with `prefix`
+    option, to the method, called with the postback."""
+    return route(POSTBACK, types, options.get('prefix'))
+
+
+def compile_routes(cls):
+    """Compile routes declared on methods of the class and its bases.
+
+    Routes of a subclass override ones of its bases for the same key. Handlers
+    are method names, so overriding a routed method without decorator keeps
+    its routes. The router is cached on the class.
+
+    Returns:
+        Router: Router of method names.
+    """
+    router = cls.__dict__.get(ROUTER_ATTR)
+    if router is not None:
+        return router
+    router = Router()
+    for klass in reversed(cls.__mro__):
+        for name, attr in vars(klass).items():
+            for kind, names, prefix in getattr(attr, ROUTES_ATTR, ()):
+                router.add(kind, name, names, prefix)
+    setattr(cls, ROUTER_ATTR, router)
+    return router
@@ -0,0 +1,211 @@
+"""Chatbot session ids shared by worker processes and nodes."""
+import os
+import time
+import sqlite3
+import threading
+
+from chabi.cache import LRUCache
+from chabi.metrics import REGISTRY
+
+
+# session start time format of per process session ids
+SESSION_DT_FMT = '%Y-%m-%d %H:%M:%S'
+
+NEW_SESSIONS = REGISTRY.counter(
+    'chabi_new_sessions_total', 'Number of started chatbot sessions.',
+    ('registry',))
+
+
+def format_session_id(msgn_id, start_ts):
+    """Format chatbot session id from messenger id and session start time in
+    milliseconds, so that a restarted session gets a new id."""
+    return "{}_{}".format(msgn_id, int(start_ts * 1000))
+
+
+class SessionRegistryBase(object):
+    # registry name for metrics
+    name = ''
+
+    def __init__(self, ttl=None):
+        """Init session registry.
+
+        The registry maps a messenger user id to its chatbot session id, so
+        that every worker process(and node sharing the store) sends messages
+        of a user to the same NLU session. A session is started on the first
+        message of the user, and restarted after `ttl` seconds of idle.
+
+        To use an external store, subclass and implement `_get_or_start` and
+        `_remove` atomically, e.g. with Redis `SET NX` and `EXPIRE`.
+
+        Args:
+            ttl (optional): Idle seconds to keep a session. None for no
+                expiration.
+        """
+        self.ttl = ttl
+        self.started = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return session counters."""
+        return dict(started=self.started)
+
+    def session_id(self, msgn_id):
+        """Return session id of the messenger user, starting one if none.
+
+        Args:
+            msgn_id: Messenger user id.
+
+        Returns:
+            str: Chatbot session id.
+        """
+        now = time.time()
+        session_id, started = self._get_or_start(
+            msgn_id, format_session_id(msgn_id, now), now)
+        if started:
+            with self._lock:
+                self.started += 1
+            NEW_SESSIONS.inc((self.name,))
+        return session_id
+
+    def reset(self, msgn_id):
+        """End session of the messenger user, so that the next message starts
+        a new one."""
+        self._remove(msgn_id)
+
+    def _get_or_start(self, msgn_id, new_id, now):
+        """Atomically get unexpired session id, refreshing its last use, or
+        store the new one.
+
+        Returns:
+            str: Session id.
+            boolean: True if the new one was stored.
+        """
+        raise NotImplementedError()
+
+    def _remove(self, msgn_id):
+        raise NotImplementedError()
+
+
+class MemorySessionRegistry(SessionRegistryBase):
+    """In-memory session registry for single process deployment."""
+
+    name = 'memory'
+
+    def __init__(self, ttl=None, max_entries=100000):
+        super(MemorySessionRegistry, self).__init__(ttl)
+        self.sessions = LRUCache(max_entries, ttl)
+        self._start_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _get_or_start(self, msgn_id, new_id, now):
+        with self._start_lock:
+            session_id = self.sessions.get(msgn_id)
+            started = session_id is None
+            if started:
+                session_id = new_id
+            # refresh TTL
+            self.sessions.put(msgn_id, session_id)
+            return session_id, started
+
+    def _remove(self, msgn_id):
+        self.sessions.pop(msgn_id)
+
+
+class SQLiteSessionRegistry(SessionRegistryBase):
+    """Session registry on a SQLite file shared by worker processes of a
+    host. Sessions survive restarts."""
+
+    name = 'sqlite'
+
+    def __init__(self, filename, ttl=None, purge_every=1000,
+                 refresh_after=None):
+        """Init SQLite session registry.
+
+        Lookups of live sessions only read, and write last use time at most
+        once per `refresh_after` seconds. The write lock is taken only to
+        start a session.
+
+        Args:
+            filename: SQLite file path.
+            ttl (optional): Idle seconds to keep a session.
+            purge_every (optional): Purge expired sessions once per this
+                number of started sessions.
+            refresh_after (optional): Seconds after which last use time of a
+                session is refreshed. Defaults to a tenth of `ttl`.
+        """
+        super(SQLiteSessionRegistry, self).__init__(ttl)
+        self.filename = os.path.abspath(filename)
+        self.purge_every = purge_every
+        if refresh_after is None and ttl is not None:
+            refresh_after = ttl / 10.0
+        self.refresh_after = refresh_after
+        self._local = threading.local()
+        con = self._connect()
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('CREATE TABLE IF NOT EXISTS chatbot_session '
+                    '(msgn_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, '
+                    'used_ts REAL NOT NULL)')
+
+    def _connect(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.filename, timeout=5,
+                                  isolation_level=None)
+            self._local.con = con
+        return con
+
+    def _is_live(self, row, now):
+        return row is not None and\
+            (self.ttl is None or row[1] >= now - self.ttl)
+
+    def _get_or_start(self, msgn_id, new_id, now):
+        con = self._connect()
+        # deferred read of live session
+        row = con.execute('SELECT session_id, used_ts FROM chatbot_session '
+                          'WHERE msgn_id = ?', (msgn_id,)).fetchone()
+        if self._is_live(row, now):
+            if self.ttl is None or row[1] >= now - self.refresh_after:
+                return row[0], False
+            # refresh, unless restarted by another worker meanwhile
+            cur = con.execute('UPDATE chatbot_session SET used_ts = ? WHERE '
+                              'msgn_id = ? AND session_id = ?',
+                              (now, msgn_id, row[0]))
+            if cur.rowcount == 1:
+                return row[0], False
+
+        # lock for write, so that concurrent starts don't race
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            row = con.execute('SELECT session_id, used_ts FROM '
+                              'chatbot_session WHERE msgn_id = ?',
+                              (msgn_id,)).fetchone()
+            started = not self._is_live(row, now)
+            session_id = new_id if started else row[0]
+            con.execute('INSERT OR REPLACE INTO chatbot_session VALUES '
+                        '(?, ?, ?)', (msgn_id, session_id, now))
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        if started and self.ttl is not None and\
+                (self.started + 1) % self.purge_every == 0:
+            self.purge()
+        return session_id, started
+
+    def _remove(self, msgn_id):
+        self._connect().execute('DELETE FROM chatbot_session WHERE msgn_id '
+                                '= ?', (msgn_id,))
+
+    def purge(self):
+        """Remove expired sessions.
+
+        Returns:
+            int: Number of removed sessions.
+        """
+        if self.ttl is None:
+            return 0
+        cur = self._connect().execute('DELETE FROM chatbot_session WHERE '
+                                      'used_ts < ?', (time.time() - self.ttl,))
+        return cur.rowcount
@@ -0,0 +1,37 @@
+import pytest
+from pony import orm
+
+from chabi.models import db, safe_db_init
+
+from helpers import make_fbapp
+
+
+@pytest.fixture()
+def fbapp(request):
+    """Facebook test app.
+
+    Options of `make_fbapp` are given by indirect parametrization, e.g.
+    `@pytest.mark.parametrize('fbapp', [dict(outbox=outbox)], indirect=True)`.
+    """
+    return make_fbapp(**getattr(request, 'param', {}))
+
+
+@pytest.fixture(scope='session')
+def _db_file(tmpdir_factory):
+    return str(tmpdir_factory.mktemp('db').join('test.sqlite'))
+
+
+@pytest.fixture()
+def fbdb(_db_file):
+    """Temporary chabi DB, emptied after the test.
+
+    Pony can't unbind a mapped database, so it is bound once per test session
+    to a temporary file, and each test starts with empty tables.
+    """
+    if db.provider is None:
+        safe_db_init(db, _db_file)
+    yield db
+    with orm.db_session:
+        for entity in db.entities.values():
+            entity.select().delete(bulk=True)
+    db.disconnect()
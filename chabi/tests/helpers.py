@@ -0,0 +1,72 @@
+"""Test helpers of Facebook apps, shared by test modules."""
+import json
+
+from flask import Flask, Blueprint
+
+from chabi import ChatbotBase
+from chabi.vendor.facebook import Facebook, EventHandlerBase
+
+
+blueprint = Blueprint('dummy', __name__)
+
+
+class DummyChatbot(ChatbotBase):
+    def __init__(self, app, access_token):
+        super(DummyChatbot, self).__init__(app, blueprint)
+
+    def request_analyze(self, sender, msg):
+        return None
+
+    def handle_unknown(self, data):
+        return False, None
+
+    def handle_incomplete(self, data):
+        return False, None
+
+
+class EventHandler(EventHandlerBase):
+
+    def handle_postback(self, msg):
+        payload = msg['payload']
+        if payload == 'START_BUTTON':
+            res = "start button pressed"
+        else:
+            res = "Unknown postback payload '{}'".format(payload)
+        return dict(message=dict(text=res))
+
+
+class StubResponse(object):
+    status_code = 200
+    text = '{}'
+
+
+class StubTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def post(self, url, params=None, headers=None, data=None):
+        self.sent.append((url, json.loads(data)))
+        return StubResponse()
+
+
+def make_fbapp(messenger=Facebook, chatbot=DummyChatbot,
+               handler=EventHandler, access_token='access_token', testing=True,
+               **options):
+    """Make test app of Facebook messenger, chatbot and event handler.
+
+    Args:
+        messenger (optional): Facebook class.
+        chatbot (optional): Chatbot class, None for no chatbot.
+        handler (optional): Event handler class, None for no handler.
+        access_token (optional): Page access token.
+        testing (optional): Handle webhook inline, responding with results.
+        options: Keyword arguments of messenger, e.g. `transport`.
+    """
+    ap = Flask(__name__)
+    messenger(ap, access_token, 'verify_token', **options)
+    if chatbot is not None:
+        chatbot(ap, 'cb_access_token')
+    if handler is not None:
+        handler(ap)
+    ap.config['TESTING'] = testing
+    return ap
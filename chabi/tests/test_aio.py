@@ -0,0 +1,185 @@
+"""Async pipeline tests."""
+import json
+import asyncio
+
+from chabi.aio import AsyncApp, AsyncChatbotBase
+from chabi.vendor.aio_facebook import AsyncFacebook, EventHandlerBase
+
+
+class StubHTTPClient(object):
+    def __init__(self):
+        self.sent = []
+
+    async def post(self, url, params=None, headers=None, data=None):
+        self.sent.append((url, json.loads(data)))
+        return 200, '{}'
+
+    async def close(self):
+        pass
+
+
+class EchoChatbot(AsyncChatbotBase):
+    async def request_analyze(self, session_id, msg):
+        await asyncio.sleep(0.01)
+        return json.dumps(dict(result=dict(speech=msg)))
+
+    async def handle_action(self, sender_id, data):
+        return False, None
+
+    def handle_unknown(self, data):
+        return False, None
+
+    def handle_incomplete(self, data):
+        return False, None
+
+    def extract_text_msg(self, data):
+        return data['result']['speech']
+
+
+class EventHandler(EventHandlerBase):
+    async def handle_postback(self, msg):
+        return dict(message=dict(text="postback " + msg['payload']))
+
+
+def make_app(testing=True):
+    app = AsyncApp(config=dict(TESTING=testing), http=StubHTTPClient())
+    AsyncFacebook(app, 'access_token', 'verify_token')
+    EchoChatbot(app)
+    EventHandler(app)
+    return app
+
+
+async def request(app, method, path, query=b'', body=b''):
+    sent = []
+    received = [dict(type='http.request', body=body)]
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(msg):
+        sent.append(msg)
+
+    scope = dict(type='http', method=method, path=path, query_string=query)
+    await app(scope, receive, send)
+    return sent[0]['status'], sent[1]['body'].decode('utf8')
+
+
+def test_aio_verify():
+    app = make_app()
+    assert (200, 'OK') == asyncio.run(request(app, 'GET', '/facebook'))
+    query = b'hub.mode=subscribe&hub.challenge=ch&hub.verify_token=BAD'
+    status, _ = asyncio.run(request(app, 'GET', '/facebook', query))
+    assert 403 == status
+    query = b'hub.mode=subscribe&hub.challenge=ch&hub.verify_token='\
+        b'verify_token'
+    assert (200, 'ch') == asyncio.run(request(app, 'GET', '/facebook',
+                                              query))
+    status, _ = asyncio.run(request(app, 'GET', '/unknown'))
+    assert 404 == status
+
+
+def test_aio_webhook():
+    messaging = [dict(sender=dict(id='s{}'.format(i % 3)),
+                      recipient=dict(id='page'),
+                      message=dict(text='m{}'.format(i))) for i in range(6)]
+    messaging.append(dict(sender=dict(id='s0'), recipient=dict(id='page'),
+                          postback=dict(payload='{"type": "START"}')))
+    data = dict(object='page', entry=[dict(messaging=messaging)])
+    body = json.dumps(data).encode('utf8')
+
+    app = make_app()
+    status, res = asyncio.run(request(app, 'POST', '/facebook', body=body))
+    assert 200 == status
+    results = json.loads(res)
+    assert results[:6] == ['m{}'.format(i) for i in range(6)]
+    assert results[6]['message']['text'].startswith('postback')
+
+    # replies are sent in order for each sender
+    texts = [d['message']['text'] for _, d in app.http.sent
+             if d['recipient']['id'] == 's0' and 'message' in d]
+    assert texts[:2] == ['m0', 'm3']
+
+    # not testing: reply first, then handle in background
+    async def run():
+        app = make_app(False)
+        res = await request(app, 'POST', '/facebook', body=body)
+        await app.shutdown()
+        return app, res
+
+    app, res = asyncio.run(run())
+    assert (200, 'OK') == res
+    assert len([d for _, d in app.http.sent if 'message' in d]) == 7
+
+
+def test_aio_apiai_errors():
+    from chabi.aio import analyze_and_action
+    from chabi.breaker import NLUGuard, CircuitBreaker, OPEN,\
+        DEFAULT_FALLBACK_REPLY, BREAKER_OPEN
+    from chabi.vendor.aio_apiai import AsyncApiAI
+
+    class ErrorHTTPClient(StubHTTPClient):
+        async def post(self, url, params=None, headers=None, data=None):
+            self.sent.append((url, json.loads(data)))
+            return 503, 'unavailable'
+
+    def make_apiai_app(nlu_guard=None):
+        app = AsyncApp(config=dict(TESTING=True), http=ErrorHTTPClient())
+        AsyncApiAI(app, 'token', api_url='http://localhost/v1',
+                   nlu_guard=nlu_guard)
+        return app
+
+    # server errors are failures of the guarded call
+    breaker = CircuitBreaker(failure_threshold=1)
+    app = make_apiai_app(NLUGuard(breaker=breaker, fallback_reply='fallback'))
+    assert asyncio.run(analyze_and_action(app, 'sender1', 'hi')) ==\
+        'fallback'
+    assert breaker.state == OPEN
+    assert app.http.sent[0][1]['query'] == 'hi'
+    # breaker is named after the chatbot vendor
+    assert breaker.name == 'apiai'
+    assert ('chabi_breaker_open', '{breaker="apiai"}', 1) in\
+        list(BREAKER_OPEN.samples())
+
+    # and fall back without guard
+    app = make_apiai_app()
+    assert asyncio.run(analyze_and_action(app, 'sender1', 'hi')) ==\
+        DEFAULT_FALLBACK_REPLY
+
+
+def test_aio_apiai_action():
+    from chabi.aio import analyze_and_action
+    from chabi.router import on_action
+    from chabi.vendor.aio_apiai import AsyncApiAI
+
+    results = dict(
+        order=dict(action='order', actionIncomplete=False,
+                   fulfillment=dict(speech='ordering')),
+        size=dict(action='order', actionIncomplete=True,
+                  fulfillment=dict(speech='Which size?')),
+        hello=dict(action='', fulfillment=dict(speech='hi there')))
+
+    class NLUHTTPClient(StubHTTPClient):
+        async def post(self, url, params=None, headers=None, data=None):
+            body = json.loads(data)
+            self.sent.append((url, body))
+            if url.endswith('/query'):
+                return 200, json.dumps(dict(result=results[body['query']],
+                                            status=dict(code=200)))
+            return 200, '{}'
+
+    class OrderHandler(EventHandler):
+        @on_action('order')
+        async def handle_order(self, sender_id, data):
+            return 'ordered for ' + sender_id
+
+    app = AsyncApp(config=dict(TESTING=True), http=NLUHTTPClient())
+    AsyncFacebook(app, 'access_token', 'verify_token')
+    AsyncApiAI(app, 'token', api_url='http://localhost/v1')
+    OrderHandler(app)
+
+    def analyze(text):
+        return asyncio.run(analyze_and_action(app, 'sender1', text))
+
+    assert analyze('order') == 'ordered for sender1'
+    assert analyze('size') == 'Which size?'
+    assert analyze('hello') == 'hi there'
@@ -248,3 +248,28 @@ def test_apiai_webhook(sess):
                    data=json.dumps(data))
         assert '200 OK' == r.status
         assert 'result' in r.data.decode('utf8')
+
+
+def test_apiai_api_url(sess):
+    """Queries to API.AI compatible server at `api_url`."""
+    sent = []
+
+    class StubResponse(object):
+        status_code = 200
+        text = json.dumps(dict(result=dict(action='input.welcome'),
+                               status=dict(code=200)))
+
+    class StubTransport(object):
+        def post(self, url, params=None, headers=None, data=None):
+            sent.append((url, json.loads(data)))
+            return StubResponse()
+
+    app = Flask(__name__)
+    ai = ApiAI(app, 'token', api_url='http://localhost/v1',
+               transport=StubTransport())
+    data = ai.analyze(sess, 'hello')
+    assert data['result']['action'] == 'input.welcome'
+    ai.analyze_event(sess, 'login')
+    assert sent[0][0] == 'http://localhost/v1/query'
+    assert sent[0][1] == dict(query='hello', lang='en', sessionId=sess)
+    assert sent[1][1]['event'] == dict(name='login')
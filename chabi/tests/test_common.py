@@ -37,3 +37,301 @@ def test_common_template():
     data = temp.render(msg="Hello\nWorld.")
     data = json.loads(data)
     assert 'message' in data
+
+
+def test_common_lru_cache():
+    import time
+    from chabi.cache import LRUCache
+
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # 'b' is least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.hits == 3 and cache.misses == 1
+
+    cache = LRUCache(max_entries=10, max_bytes=10)
+    cache.put('a', 1, 6)
+    cache.put('b', 2, 6)
+    assert len(cache) == 1 and cache.nbytes == 6
+    cache.put('c', 3, 11)
+    assert cache.get('c') is None
+
+    cache = LRUCache(ttl=0.01)
+    cache.put('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_common_analysis_cache():
+    from chabi.cache import AnalysisCache
+
+    cache = AnalysisCache()
+    hello = dict(result=dict(action='input.welcome'))
+    cache.put('s1', 'Hello', 'en', hello, True)
+    assert cache.get('s2', '  hello ', 'en') is hello
+    assert cache.get('s2', 'hello', 'ko') is None
+
+    # session in dialog bypasses cache
+    order = dict(result=dict(actionIncomplete=True))
+    cache.put('s3', 'I need pizza', 'en', order, False)
+    assert cache.get('s3', 'I need pizza', 'en') is None
+    assert cache.get('s3', 'hello', 'en') is None
+    assert cache.bypasses == 2
+
+    # dialog finished
+    cache.put('s3', 'two', 'en', dict(result=dict()), True)
+    assert cache.get('s3', 'hello', 'en') is hello
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['entries'] == 2
+
+
+def test_common_token_store():
+    import time
+    from chabi.tokens import MemoryTokenStore, TOKEN_VALID, TOKEN_INVALID,\
+        TOKEN_CLOSED, TOKEN_EXPIRED
+
+    store = MemoryTokenStore(ttl=0.05, closed_ttl=0, purge_every=3)
+    store.issue('t1')
+    store.issue('t2')
+    assert store.close('t1') == TOKEN_VALID
+    assert store.close('t1') == TOKEN_CLOSED
+    assert store.close('t0') == TOKEN_INVALID
+    time.sleep(0.06)
+    assert store.close('t2') == TOKEN_EXPIRED
+    # 3rd issue purges closed and expired tokens
+    store.issue('t3')
+    assert len(store) == 1
+    assert store.close('t3') == TOKEN_VALID
+
+
+def test_common_account_link_cache():
+    from chabi.cache import AccountLinkCache
+
+    invalidated = []
+    cache = AccountLinkCache()
+    cache.add_hook(invalidated.append)
+    assert cache.get('s1') is None
+    # negative state is cached
+    cache.put('s1', False)
+    assert cache.get('s1') is False
+    cache.update('s1', True)
+    assert cache.get('s1') is True
+    assert invalidated == ['s1']
+    cache.invalidate('s1')
+    assert cache.get('s1') is None
+
+
+def test_common_lazy_logging(tmpdir, monkeypatch):
+    import logging
+    from flask import Flask
+    from chabi.util import init_logger, LazyJSON, PAYLOAD_LOG
+
+    class Payload(dict):
+        dumped = 0
+
+        def __iter__(self):
+            Payload.dumped += 1
+            return super(Payload, self).__iter__()
+
+    monkeypatch.chdir(tmpdir)
+    tmpdir.mkdir('logs')
+    app = Flask(__name__)
+    app.logger.setLevel(logging.DEBUG)
+    listener = init_logger(app, 'test.log', logging.INFO, queued=True,
+                           sampling=dict(payload=0))
+
+    # not serialized below log level
+    app.logger.debug("Request: %s", LazyJSON(Payload(a=1)))
+    # sampled out
+    app.logger.info("Request: %s", LazyJSON(Payload(a=1)), extra=PAYLOAD_LOG)
+    app.logger.info("Response: %s", LazyJSON(dict(b=2)))
+    listener.stop()
+    for handler in list(app.logger.handlers):
+        app.logger.removeHandler(handler)
+
+    assert Payload.dumped == 0
+    log = tmpdir.join('logs', 'test.log').read()
+    assert 'Response: {"b": 2}' in log
+    assert 'Request' not in log
+
+
+def test_common_metrics():
+    from flask import Flask
+    from chabi.metrics import Registry, Metrics, measure, STAGE_SECONDS
+
+    reg = Registry()
+    hist = reg.histogram('test_seconds', 'Test.', ('stage',),
+                         buckets=(0.1, 1))
+    hist.observe(0.05, ('a',))
+    hist.observe(0.5, ('a',))
+    hist.observe(5, ('a',))
+    assert hist.count(('a',)) == 3
+    text = reg.render()
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="a",le="1"} 2' in text
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'test_seconds_count{stage="a"} 3' in text
+
+    labels = ('analyze', 'test', '')
+    cnt = STAGE_SECONDS.count(labels)
+    try:
+        with measure('analyze', 'test'):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert STAGE_SECONDS.count(labels) == cnt + 1
+
+    app = Flask(__name__)
+    Metrics(app)
+    with app.test_client() as c:
+        rv = c.get('/metrics')
+        assert rv.status_code == 200
+        body = rv.data.decode('utf8')
+        assert 'chabi_stage_errors_total{stage="analyze",vendor="test",'\
+            'action=""} 1' in body
+
+
+def test_common_intent_resolver(tmpdir):
+    from chabi.intent import LocalIntentResolver, build_model, save_model
+
+    path = str(tmpdir.join('model.json'))
+    save_model(path, build_model({
+        'order.list': ['show my orders', 'list orders', 'what did I order'],
+    }))
+    res = LocalIntentResolver(
+        keywords=[(['cancel', 'order'], dict(action='confirm.cancel_order',
+                                             speech="Cancel your order?"))],
+        model=path, threshold=0.6)
+
+    data = res.resolve('s1', ' Log  Out ')
+    assert data['result']['action'] == 'logout'
+    assert data['result']['actionIncomplete'] is False
+    assert data['status']['code'] == 200
+
+    data = res.resolve('s1', 'Please cancel my order')
+    assert data['result']['action'] == 'confirm.cancel_order'
+    assert data['result']['fulfillment']['speech'] == "Cancel your order?"
+    assert res.resolve('s1', 'cancel the pizza order tonight') is None
+
+    data = res.resolve('s1', 'list my orders')
+    assert data['result']['action'] == 'order.list'
+    assert res.resolve('s1', 'what is the weather') is None
+
+    # falls through in the middle of a dialog
+    res.observe('s1', False)
+    assert res.resolve('s1', 'logout') is None
+    res.observe('s1', True)
+    assert res.resolve('s1', 'logout') is not None
+
+    stats = res.stats()
+    assert stats['phrase'] == 2
+    assert stats['keyword'] == 1
+    assert stats['model'] == 1
+    assert stats['miss'] == 2
+    assert stats['dialog'] == 1
+    assert stats['hit_rate'] == 4 / 7.0
+
+
+def test_common_session_registry(tmpdir):
+    import time
+    from datetime import datetime, timedelta
+    from flask import Flask
+    from chabi import make_chatbot_session_id
+    from chabi.session import MemorySessionRegistry, SQLiteSessionRegistry
+
+    # sessions of workers are shared, and survive restart
+    path = str(tmpdir.join('sessions.sqlite'))
+    reg1 = SQLiteSessionRegistry(path)
+    reg2 = SQLiteSessionRegistry(path)
+    sid = reg1.session_id('user1')
+    assert sid.startswith('user1_')
+    assert reg2.session_id('user1') == sid
+    assert SQLiteSessionRegistry(path).session_id('user1') == sid
+    assert reg1.session_id('user2') != sid
+    assert reg1.stats()['started'] == 2
+    assert reg2.stats()['started'] == 0
+
+    # restarted after reset or idle
+    reg1.reset('user1')
+    assert reg2.session_id('user1') != sid
+    reg3 = SQLiteSessionRegistry(path, ttl=0.1)
+    sid = reg3.session_id('user3')
+    assert reg3.session_id('user3') == sid
+    time.sleep(0.2)
+    assert reg3.session_id('user3') != sid
+    # all sessions are idle longer than ttl
+    time.sleep(0.2)
+    assert reg3.purge() == 3
+
+    # lookup of live session doesn't wait for the write lock
+    import sqlite3
+    sid = reg1.session_id('user5')
+    con = sqlite3.connect(path, isolation_level=None)
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        assert reg2.session_id('user5') == sid
+    finally:
+        con.execute('ROLLBACK')
+    # idle time is refreshed
+    reg4 = SQLiteSessionRegistry(path, ttl=0.3, refresh_after=0.05)
+    sid = reg4.session_id('user6')
+    for _ in range(4):
+        time.sleep(0.1)
+        assert reg4.session_id('user6') == sid
+
+    mreg = MemorySessionRegistry(ttl=60)
+    assert mreg.session_id('user1') == mreg.session_id('user1')
+    assert len(mreg) == 1
+
+    # app start time of each worker no longer matters
+    apps = []
+    for i in range(2):
+        ap = Flask(__name__)
+        ap.cb_start_dt = datetime.now() + timedelta(seconds=i)
+        ap.cb_sessions = reg1
+        apps.append(ap)
+    assert make_chatbot_session_id('user4', apps[0]) ==\
+        make_chatbot_session_id('user4', apps[1])
+    apps[1].cb_sessions = None
+    assert make_chatbot_session_id('user4', apps[0]) !=\
+        make_chatbot_session_id('user4', apps[1])
+
+
+def test_common_lazy_vendors():
+    import sys
+    import subprocess
+    import pytest
+    from chabi.vendor import get_vendor, make_vendor, register_vendor
+    from chabi.vendor.facebook import Facebook
+
+    # heavy dependencies are not loaded by core import
+    out = subprocess.check_output([
+        sys.executable, '-c', 'import sys, chabi, chabi.aio, chabi.vendor; '
+        'print(",".join(m for m in ("flask", "pony", "requests", "apiai") '
+        'if m in sys.modules))'])
+    assert out.decode('utf8').strip() == ''
+
+    # vendor module defers the DB until it is used
+    out = subprocess.check_output([
+        sys.executable, '-c', 'import sys, chabi.vendor.facebook; '
+        'print("pony" in sys.modules)'])
+    assert out.decode('utf8').strip() == 'False'
+
+    assert get_vendor('facebook') is Facebook
+    with pytest.raises(KeyError):
+        get_vendor('line')
+
+    class Line(object):
+        def __init__(self, app, token):
+            self.app, self.token = app, token
+
+    register_vendor('line', Line)
+    assert make_vendor('line', None, 'token').token == 'token'
+    register_vendor('line', 'chabi.cache:LRUCache')
+    assert get_vendor('line').__name__ == 'LRUCache'
@@ -1,84 +1,47 @@
 """Basic tests."""
 import json
+import itertools
 
-from flask import Flask, Blueprint
 from pony import orm
 import pytest
 
-from chabi import ChatbotBase
-from chabi.vendor.facebook import Facebook, EventHandlerBase, blueprint as fbbp
-from chabi.models import db
+from chabi.tokens import MemoryTokenStore, DBTokenStore
+from chabi.vendor.facebook import Facebook, blueprint as fbbp
 
+from helpers import DummyChatbot, EventHandler, StubTransport, make_fbapp
 
-blueprint = Blueprint('dummy', __name__)
 
-
-class DummyChatbot(ChatbotBase):
-    def __init__(self, app, access_token):
-        super(DummyChatbot, self).__init__(app, blueprint)
-
-    def request_analyze(self, sender, msg):
-        return None
-
-    def handle_unknown(self, data):
-        return False, None
-
-    def handle_incomplete(self, data):
-        return False, None
-
-
-class EventHandler(EventHandlerBase):
-
-    def handle_postback(self, msg):
-        payload = msg['payload']
-        if payload == 'START_BUTTON':
-            res = "start button pressed"
-        else:
-            res = "Unknown postback payload '{}'".format(payload)
-        return dict(message=dict(text=res))
-
-
-@pytest.fixture()
-def app():
-    ap = Flask(__name__)
-    Facebook(ap, 'access_token', 'verify_token')
-    DummyChatbot(ap, 'cb_access_token')
-    EventHandler(ap)
-    ap.config['TESTING'] = True
-    return ap
-
-
-def test_facebook_basic(app):
-    with app.test_client():
+def test_facebook_basic(fbapp):
+    with fbapp.test_client():
         sender_id = "1265395423496458"
-        msg = app.msgn.ask_enter_text_msg(sender_id)
+        msg = fbapp.msgn.ask_enter_text_msg(sender_id)
         assert msg['message']['text'] == 'Please enter text message.'
 
 
-def test_facebook_webhook(app):
+def test_facebook_webhook(fbapp):
     """Facebook webhook test."""
     # default GET
-    with app.test_client() as c:
+    with fbapp.test_client() as c:
         r = c.get('/facebook')
         assert 'OK' == r.data.decode('utf8')
         assert '200 OK' == r.status
 
     # GET with bad verify token
-    with app.test_client() as c:
+    with fbapp.test_client() as c:
         r = c.get('/facebook?hub.mode=subscribe&hub.challenge=access_token'
                   '&hub.verify_token=BAD')
         assert 'Verification token mismatch' == r.data.decode('utf8')
         assert '403 FORBIDDEN' == r.status
 
     # GET with good verify token
-    with app.test_client() as c:
+    with fbapp.test_client() as c:
         r = c.get('/facebook?hub.mode=subscribe&hub.challenge=access_token'
                   '&hub.verify_token=verify_token')
         assert 'access_token' == r.data.decode('utf8')
         assert '200 OK' == r.status
 
     # POST to facebook webhook
-    with app.test_client() as c:
+    with fbapp.test_client() as c:
         data = {
             'object': 'page',
             'entry': [
@@ -104,8 +67,13 @@ def test_facebook_webhook(app):
         assert '200 OK' == r.status
 
 
-def test_facebook_unsupport(app):
-    with app.test_client() as c:
+IMAGE_URL = 'https://scontent.xx.fbcdn.net/v/t34.0-12/'\
+    '16997218_1543730039000857_2025028651_n.gif?_nc_ad=z-m&'\
+    'oh=f1a2953fb8c25dfd56661e62ffc72435&oe=58B5BCE2'
+
+
+def test_facebook_unsupport(fbapp):
+    with fbapp.test_client() as c:
         data = {
             "object": "page",
             "entry": [
@@ -127,7 +95,7 @@ def test_facebook_unsupport(app):
                                 "attachments": [{
                                         "type": "image",
                                         "payload": {
-                                            "url": "https://scontent.xx.fbcdn.net/v/t34.0-12/16997218_1543730039000857_2025028651_n.gif?_nc_ad=z-m&oh=f1a2953fb8c25dfd56661e62ffc72435&oe=58B5BCE2"  # NOQA
+                                            "url": IMAGE_URL
                                         }
                                     }
                                 ]
@@ -150,8 +118,8 @@ def test_facebook_static():
         assert code
 
 
-def test_facebook_start(app):
-    with app.test_client() as c:
+def test_facebook_start(fbapp):
+    with fbapp.test_client() as c:
         data = {
             "object": "page",
             "entry": [
@@ -243,12 +211,10 @@ def do_logout(c):
     return r
 
 
-def test_facebook_loginout(app):
-    db.bind('sqlite', 'muorigin.sqlite', create_db=True)
-    db.generate_mapping(create_tables=True)
-    app.wsgi_app = orm.db_session(app.wsgi_app)
+def test_facebook_loginout(fbapp, fbdb):
+    fbapp.wsgi_app = orm.db_session(fbapp.wsgi_app)
 
-    with app.test_client() as c:
+    with fbapp.test_client() as c:
         r = do_login(c)
         assert '200 OK' == r.status
         data = r.data.decode('utf8')
@@ -270,10 +236,10 @@ def test_facebook_loginout(app):
         assert 'not logged in' in data
 
 
-def test_facebook_template(app):
+def test_facebook_template(fbapp):
     from flask import render_template
 
-    with app.app_context():
+    with fbapp.app_context():
         data = render_template('facebook/account_link.json', image_url="image",
                                login_url='url')
         assert '"url": "url"' in data
@@ -290,3 +256,871 @@ def test_facebook_template(app):
         data = render_template('facebook/buttons.json', text="test",
                                buttons=[('t1', 'p1'), ('t2', 'p2')])
         json.loads(data)
+
+
+def test_facebook_async_webhook():
+    import threading
+    import time
+
+    handled = []
+    release = threading.Event()
+
+    class AsyncFacebook(Facebook):
+        def handle_msg_data(self, data):
+            release.wait(5)
+            for entry in data['entry']:
+                for mevent in entry['messaging']:
+                    handled.append((mevent['sender']['id'],
+                                    mevent['message']['text'],
+                                    threading.current_thread().name))
+
+    ap = make_fbapp(AsyncFacebook, access_token=None, testing=False,
+                    async_workers=2, queue_size=2)
+    wqueue = ap.msgn.webhook_queue
+    senders = ['sender1', 'sender2', 'sender3', 'sender4']
+    assert len(set(wqueue.route(sender) for sender in senders)) == 2
+
+    with ap.test_client() as c:
+        for i in range(3):
+            data = make_text_data([(sender, str(i)) for sender in senders])
+            r = c.post('/facebook',
+                       headers={'Content-Type': 'application/json'},
+                       data=json.dumps(data))
+            assert '200 OK' == r.status
+            assert 'OK' == r.data.decode('utf8')
+            # both workers hold their part of the first payload
+            while i == 0 and wqueue.pending:
+                time.sleep(0.001)
+
+        # worker queues are full, until workers are released
+        r = c.post('/facebook', headers={'Content-Type': 'application/json'},
+                   data=json.dumps(make_text_data([('sender4', 'x')])))
+        assert '503 SERVICE UNAVAILABLE' == r.status
+
+        # not a page payload
+        r = c.post('/facebook', headers={'Content-Type': 'application/json'},
+                   data=json.dumps(dict(object='user')))
+        assert '200 OK' == r.status
+
+    release.set()
+    wqueue.stop()
+    # each sender is handled in order by one worker
+    for sender in senders:
+        mine = [(text, name) for sid, text, name in handled if sid == sender]
+        assert [text for text, _ in mine] == ['0', '1', '2']
+        assert len(set(name for _, name in mine)) == 1
+    assert len(handled) == 12
+    # stopped queue doesn't accept payload anymore
+    assert not wqueue.put(data)
+
+
+def test_facebook_transport():
+    transport = StubTransport()
+    ap = make_fbapp(transport=transport,
+                    graph_url='http://localhost:8000/v2.6')
+
+    with ap.test_client():
+        ap.msgn.send_message('sender_id', 'hello')
+    url, data = transport.sent[-1]
+    assert url == 'http://localhost:8000/v2.6/me/messages'
+    assert data['recipient']['id'] == 'sender_id'
+    assert data['message']['text'] == 'hello'
+
+
+def make_text_data(items):
+    messaging = [dict(sender=dict(id=sender), recipient=dict(id='page'),
+                      message=dict(text=text)) for sender, text in items]
+    return {'object': 'page', 'entry': [{'messaging': messaging}]}
+
+
+def test_facebook_dispatch():
+    import threading
+    import time
+
+    handled = []
+
+    class EchoFacebook(Facebook):
+        def handle_text_message(self, sender_id, msg_text):
+            time.sleep(0.01)
+            handled.append((sender_id, msg_text,
+                            threading.current_thread().name))
+            return msg_text
+
+    ap = make_fbapp(EchoFacebook, transport=StubTransport(),
+                    dispatch_workers=3)
+
+    items = [('s{}'.format(i % 3), 'm{}'.format(i)) for i in range(9)]
+    with ap.test_client() as c:
+        r = c.post('/facebook', headers={'Content-Type': 'application/json'},
+                   data=json.dumps(make_text_data(items)))
+        assert '200 OK' == r.status
+        results = json.loads(r.data.decode('utf8'))
+
+    # results keep original event order
+    assert results == [text for _, text in items]
+    # events of a sender keep order
+    for sender in ('s0', 's1', 's2'):
+        texts = [text for s, text, _ in handled if s == sender]
+        assert texts == [text for s, text in items if s == sender]
+    # senders are handled concurrently
+    assert len(set(name for _, _, name in handled)) > 1
+
+
+def test_facebook_payloads(fbapp):
+    from flask import render_template
+    from chabi.vendor.facebook import account_link_template,\
+        account_unlink_template, quick_reply_template
+
+    def rendered(name, **kwargs):
+        return json.loads(render_template(name, **kwargs))
+
+    with fbapp.app_context():
+        data = account_link_template('image', 'url')
+        assert data == rendered('facebook/account_link.json',
+                                image_url='image', login_url='url')
+        # cached payload is copied
+        data['recipient'] = dict(id='sender_id')
+        assert 'recipient' not in account_link_template('image', 'url')
+
+        data = account_unlink_template('image')
+        assert data == rendered('facebook/account_unlink.json',
+                                image_url='image')
+
+        items = [('Yes', 'yes.order'), ('No', 'no.order')]
+        data = quick_reply_template('Order "pizza"?', items)
+        assert data == rendered('facebook/quick_reply.json',
+                                text='Order "pizza"?', items=items)
+        assert quick_reply_template('Empty', [])['message'][
+            'quick_replies'] == []
+
+        buttons = [('t1', '{"id": 1}'), ('t2', 'p2')]
+        data = fbapp.msgn.payloads.buttons.build(text='test', buttons=buttons)
+        assert data == rendered('facebook/buttons.json', text='test',
+                                buttons=buttons)
+        # Facebook templates only substitute values
+        payloads = fbapp.msgn.payloads
+        assert payloads.buttons.compiled and payloads.quick_reply.compiled
+
+
+def test_facebook_payload_logic():
+    from jinja2 import Environment, DictLoader
+    from chabi.payload import JSONTemplate
+    from chabi.metrics import STAGE_SECONDS
+
+    env = Environment(loader=DictLoader({
+        'cond.json': '{"text": {% if text %}{{text|tojson}}{% else %}'
+                     '"empty"{% endif %}}',
+        'upper.json': '{"text": {{text|upper|tojson}}}',
+        'items.json': '[{% for a, b in items %}["{{a}}", {{b|tojson}}]'
+                      '{% if not loop.last %},{% endif %}{% endfor %}]'}))
+
+    # compiled on first build
+    tmpl = JSONTemplate(env.get_template('items.json'), (), dict(items=2))
+    assert tmpl.compiled is None
+    assert tmpl.build(items=[('a', 1), ('b', 2)]) == [['a', 1], ['b', 2]]
+    assert tmpl.compiled
+
+    # template logic is rendered for each payload
+    tmpl = JSONTemplate(env.get_template('cond.json'), ['text'])
+    assert tmpl.build(text='hello') == dict(text='hello')
+    assert tmpl.build(text='') == dict(text='empty')
+    assert tmpl.compiled is False
+    tmpl = JSONTemplate(env.get_template('upper.json'), ['text'],
+                        vendor='facebook')
+    labels = ('template', 'facebook', 'upper.json')
+    cnt = STAGE_SECONDS.count(labels)
+    assert tmpl.build(text='hello') == dict(text='HELLO')
+    assert tmpl.compiled is False
+    assert STAGE_SECONDS.count(labels) == cnt + 1
+
+
+_timestamps = itertools.count(1488519518811)
+
+
+def make_postback_data(payload, timestamp=None):
+    if timestamp is None:
+        timestamp = next(_timestamps)
+    messaging = [dict(sender=dict(id='sender_id'), recipient=dict(id='page'),
+                      timestamp=timestamp, postback=dict(payload=payload))]
+    return {'object': 'page', 'entry': [{'messaging': messaging}]}
+
+
+@pytest.mark.parametrize('fbapp', [
+    dict(transport=StubTransport(), token_store=MemoryTokenStore()),
+    dict(transport=StubTransport(), token_store=DBTokenStore())],
+    ids=['memory', 'db'], indirect=True)
+def test_facebook_postback_token(fbapp, fbdb):
+    from chabi.vendor.facebook import make_postback_buttons
+
+    ap = fbapp
+    ap.wsgi_app = orm.db_session(ap.wsgi_app)
+
+    with ap.app_context(), orm.db_session:
+        data = make_postback_buttons('order', 'Choose', [('A', 1), ('B', 2)])
+    buttons = data['message']['attachment']['payload']['buttons']
+    payload = buttons[0]['payload']
+    assert json.loads(payload)['id'] == 1
+
+    def post(payload):
+        r = c.post('/facebook', headers={'Content-Type': 'application/json'},
+                   data=json.dumps(make_postback_data(payload)))
+        return r.data.decode('utf8')
+
+    with ap.test_client() as c:
+        assert 'Unknown postback payload' in post(payload)
+        assert 'not valid anymore' in post(payload)
+        assert 'Invalid postback' in post(payload.replace('TEST_TOKEN',
+                                                          'BAD'))
+
+
+def test_facebook_db_token_store(fbdb):
+    from chabi.tokens import DBTokenStore, TOKEN_VALID, TOKEN_CLOSED
+    from chabi.models import PostbackToken
+
+    store = DBTokenStore(closed_ttl=0)
+    with orm.db_session:
+        store.issue('db_token')
+    with orm.db_session:
+        assert store.close('db_token') == TOKEN_VALID
+        assert store.close('db_token') == TOKEN_CLOSED
+    with orm.db_session:
+        store.purge()
+        assert PostbackToken.select(lambda t: t.value == 'db_token').\
+            count() == 0
+
+    # stores of two processes on one DB
+    store_a, store_b = DBTokenStore(), DBTokenStore()
+    with orm.db_session:
+        store_a.issue('shared_token')
+    with orm.db_session:
+        assert store_b.close('shared_token') == TOKEN_VALID
+    with orm.db_session:
+        assert store_a.close('shared_token') == TOKEN_CLOSED
+        assert store_b.close('shared_token') == TOKEN_CLOSED
+
+    # closing is committed with the caller's session
+    with orm.db_session:
+        store_a.issue('rollback_token')
+    with orm.db_session:
+        assert store_b.close('rollback_token') == TOKEN_VALID
+        orm.rollback()
+    with orm.db_session:
+        assert store_a.close('rollback_token') == TOKEN_VALID
+
+
+def test_facebook_account_cache(fbdb):
+    from chabi.models import AccountLink
+
+    ap = make_fbapp(transport=StubTransport())
+    ap.wsgi_app = orm.db_session(ap.wsgi_app)
+    invalidated = []
+    ap.msgn.account_cache.add_hook(invalidated.append)
+
+    with ap.test_client() as c:
+        assert 'successfully logged in' in do_login(c).data.decode('utf8')
+        assert ap.msgn.account_cache.get('senderid') is True
+        assert invalidated == ['senderid']
+
+        # cached state is used
+        with orm.db_session:
+            AccountLink['senderid'].delete()
+        assert 'already logged in' in do_login(c).data.decode('utf8')
+
+        ap.msgn.account_cache.invalidate('senderid')
+        assert 'not logged in' in do_logout(c).data.decode('utf8')
+        assert ap.msgn.account_cache.get('senderid') is False
+
+
+def test_facebook_write_behind(fbdb):
+    from chabi.models import AccountLink, WriteBatcher, write_behind
+    from chabi.vendor.facebook import link_account
+
+    batcher = WriteBatcher(linger=0.05)
+    batcher.start()
+    for i in range(10):
+        assert batcher.submit(link_account, 'batch{}'.format(i), 'code') is\
+            None
+    batcher.flush()
+    assert batcher.nbatch < 10
+    # failing write doesn't affect others
+    batcher.submit(AccountLink, 'batch0', 'dup')
+    batcher.submit(link_account, 'batch10', 'code')
+    batcher.flush()
+    with orm.db_session:
+        assert AccountLink.select(lambda a: a.id.startswith('batch')).\
+            count() == 11
+        orm.delete(a for a in AccountLink if a.id.startswith('batch'))
+    batcher.stop()
+    assert batcher.submit(lambda: 1) == 1
+
+    # write submitted while stopping isn't lost
+    import time
+    import threading
+    done = []
+    batcher.start()
+    batcher.submit(time.sleep, 0.2)
+    stopper = threading.Thread(target=batcher.stop)
+    stopper.start()
+    time.sleep(0.05)
+    batcher.submit(done.append, 1)
+    stopper.join()
+    assert done == [1]
+
+    # read your writes
+    ap = make_fbapp(transport=StubTransport())
+    ap.wsgi_app = orm.db_session(ap.wsgi_app)
+    write_behind.start()
+    try:
+        with ap.test_client() as c:
+            assert 'successfully logged in' in\
+                do_login(c).data.decode('utf8')
+            assert 'already logged in' in do_login(c).data.decode('utf8')
+            write_behind.flush()
+            with orm.db_session:
+                assert AccountLink.get(id='senderid') is not None
+            assert 'successfully logged out' in\
+                do_logout(c).data.decode('utf8')
+    finally:
+        write_behind.stop()
+    with orm.db_session:
+        assert AccountLink.get(id='senderid') is None
+
+
+def test_facebook_typing():
+    import threading
+    from chabi.indicator import TypingIndicator
+
+    transport = StubTransport()
+    ap = make_fbapp(transport=transport, typing_workers=0)
+    fb = ap.msgn
+
+    # coalesced until replied
+    assert fb.typing.notify('sender1')
+    assert not fb.typing.notify('sender1')
+    fb.send_message('sender1', 'hello')
+    assert fb.typing.notify('sender1')
+    actions = [d.get('sender_action', 'message') for _, d in transport.sent]
+    assert actions == ['typing_on', 'message', 'typing_on']
+    assert fb.typing.stats() == dict(sent=2, coalesced=1, dropped=0)
+
+    # pending indicator is dropped when reply is ready first
+    sent = []
+    gate = threading.Event()
+    typing = TypingIndicator(ap, sent.append, max_workers=1)
+    typing.executor.submit(gate.wait)
+    typing.notify('sender2')
+    typing.done('sender2')
+    gate.set()
+    typing.notify('sender3')
+    typing.shutdown()
+    typing.done('sender3')
+    assert sent == ['sender3']
+    assert typing.dropped == 1
+
+
+def test_facebook_dedup(tmpdir):
+    from chabi.dedup import SQLiteSeenSet
+    from chabi.vendor.facebook import get_event_key
+
+    transport = StubTransport()
+    ap = make_fbapp(transport=transport)
+    fb = ap.msgn
+
+    message = make_text_data([('sender1', 'hello')])
+    message['entry'][0]['messaging'][0]['message']['mid'] = 'mid.1'
+    postback = make_postback_data('START_BUTTON')
+    with ap.test_client() as c:
+        for data in (message, postback, message, postback):
+            r = c.post('/facebook',
+                       headers={'Content-Type': 'application/json'},
+                       data=json.dumps(data))
+            assert '200 OK' == r.status
+        assert '[]' == r.data.decode('utf8')
+    assert fb.seen_events.stats() == dict(checked=4, duplicates=2)
+    assert len([d for _, d in transport.sent if 'message' in d]) == 2
+
+    # postbacks without timestamp can't be told apart
+    mevent = make_postback_data('START_BUTTON')['entry'][0]['messaging'][0]
+    assert get_event_key(mevent).startswith('postback:sender_id:')
+    del mevent['timestamp']
+    assert get_event_key(mevent) is None
+
+    # shared by processes through SQLite file
+    path = str(tmpdir.join('seen.sqlite'))
+    seen1 = SQLiteSeenSet(path)
+    seen2 = SQLiteSeenSet(path)
+    assert not seen1.check('mid:1')
+    assert seen2.check('mid:1')
+    # expired key is not a duplicate
+    assert not SQLiteSeenSet(path, ttl=0).check('mid:1')
+    assert seen1.check(None) is False
+    assert seen2.duplicates == 1
+
+
+def test_facebook_batch_send():
+    from urllib.parse import parse_qs
+    from chabi.batch import BatchSender
+
+    class BatchResponse(object):
+        status_code = 200
+
+        def __init__(self, results):
+            self.text = json.dumps(results)
+
+    class BatchTransport(object):
+        def __init__(self):
+            self.batches = []
+
+        def post(self, url, params=None, headers=None, data=None):
+            ops = json.loads(parse_qs(data)['batch'][0])
+            self.batches.append(ops)
+            return BatchResponse([dict(code=200, body='{}') for _ in ops])
+
+    transport = BatchTransport()
+    fb = make_fbapp(chatbot=None, handler=None, transport=transport,
+                    typing_workers=0, batch_size=10, batch_linger=0.05).msgn
+    for i in range(3):
+        fb.send_message('r1', 'a{}'.format(i))
+        fb.send_message('r2', 'b{}'.format(i))
+    fb.batch_sender.stop()
+
+    ops = [op for batch in transport.batches for op in batch]
+    assert len(ops) == 6
+    assert len(transport.batches) < 6
+    texts = [json.loads(parse_qs(op['body'])['message'][0])['text'] for op
+             in ops]
+    assert [t for t in texts if t[0] == 'a'] == ['a0', 'a1', 'a2']
+    # sends of a recipient run in order within a batch
+    batch = transport.batches[0]
+    names = dict((op['name'], op) for op in batch)
+    for op in batch:
+        if 'depends_on' in op:
+            prev = names[op['depends_on']]
+            assert parse_qs(prev['body'])['recipient'] ==\
+                parse_qs(op['body'])['recipient']
+
+    # failed sub-requests are retried in order, or mapped to errors
+    statuses = {('r1', 'x0'): [500, 200], ('r1', 'x1'): [None, 200],
+                ('r2', 'y0'): [400]}
+    sent = []
+
+    def send_batch(items):
+        results = []
+        for item in items:
+            sent.append(item.data)
+            results.append((statuses[(item.key, item.data)].pop(0), 'body'))
+        return results
+
+    sender = BatchSender(send_batch, max_retries=1)
+    sender.start()
+    futures = [sender.send('r1', 'x0'), sender.send('r2', 'y0'),
+               sender.send('r1', 'x1')]
+    sender.stop()
+    assert [f.result()[0] for f in futures] == [200, 400, 200]
+    assert sent == ['x0', 'y0', 'x1', 'x0', 'x1']
+    assert sender.nfailed == 1
+    assert sender.nretried == 2
+
+
+def test_facebook_outbox():
+    import requests
+    from urllib3.exceptions import MaxRetryError, NewConnectionError,\
+        ProtocolError
+    from chabi.outbox import Outbox, TokenBucket
+    from chabi.vendor.facebook import classify_graph_response
+
+    throttled = json.dumps(dict(error=dict(code=613)))
+    bad = json.dumps(dict(error=dict(code=100)))
+    statuses = {'a0': [400, 200], 'a1': [500, 200], 'b0': ['refused', 200],
+                'b1': [400], 'c0': [500, 500, 500], 'd0': ['aborted']}
+    bodies = {'a0': throttled, 'b1': bad}
+    sent = []
+
+    class OutboxTransport(object):
+        def post(self, url, params=None, headers=None, data=None):
+            text = json.loads(data)['message']['text']
+            sent.append(text)
+            status = statuses[text].pop(0)
+            if status == 'refused':
+                raise requests.ConnectionError(MaxRetryError(
+                    None, url, NewConnectionError(None, 'refused')))
+            if status == 'aborted':
+                # may have been accepted
+                raise requests.ConnectionError(ProtocolError(
+                    'Connection aborted.'))
+            return type('Response', (), dict(status_code=status,
+                                             text=bodies.get(text, '{}')))
+
+    outbox = Outbox(rate=1000, burst=10, max_retries=2, base_delay=0.01,
+                    workers=2)
+    fb = make_fbapp(chatbot=None, handler=None,
+                    transport=OutboxTransport(), typing_workers=0,
+                    outbox=outbox).msgn
+    for text in ('a0', 'a1', 'b0', 'b1', 'c0', 'd0'):
+        fb.send_message(text[0], text)
+    assert outbox.flush(5)
+    outbox.stop()
+
+    # per recipient order is kept over retries, without duplicates
+    assert [t for t in sent if t[0] == 'a'] == ['a0', 'a0', 'a1', 'a1']
+    assert [t for t in sent if t[0] == 'b'] == ['b0', 'b0', 'b1']
+    assert sent.count('c0') == 3
+    assert sent.count('d0') == 1
+    letters = dict((dl.data['message']['text'], dl.reason) for dl in
+                   outbox.dead_letters)
+    assert letters == {'b1': 'failed', 'c0': 'retries', 'd0': 'error'}
+    assert outbox.stats() == dict(depth=0, sent=3, retried=5,
+                                  dead_letters=3)
+
+    assert classify_graph_response(400, throttled) == 'throttled'
+    assert classify_graph_response(400, bad) == 'failed'
+
+    bucket = TokenBucket(rate=100, burst=1)
+    bucket.acquire()
+    bucket.acquire()
+    assert bucket.tokens < 1
+
+
+def test_facebook_nlu_guard():
+    import time
+    from chabi import analyze_and_action
+    from chabi.breaker import NLUGuard, CircuitBreaker, OPEN, CLOSED
+
+    calls = []
+
+    class SlowChatbot(DummyChatbot):
+        delays = [0.3, 0, 0.5, 0.5, 0.5, 0.5, 0]
+
+        def request_analyze(self, sender, msg):
+            calls.append(msg)
+            time.sleep(self.delays.pop(0))
+            return json.dumps(dict(result=dict(action='', fulfillment=dict(
+                speech='analyzed'))))
+
+        def handle_action(self, sender_id, data):
+            return False, None
+
+        def extract_text_msg(self, data):
+            return data['result']['fulfillment']['speech']
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    guard = NLUGuard(timeout=0.1, breaker=breaker, hedge_after=0.05,
+                     fallback_reply='fallback')
+    ap = make_fbapp(chatbot=SlowChatbot, access_token=None)
+    ap.chatbot.nlu_guard = guard
+
+    with ap.app_context():
+        # slow call answered by hedged one
+        assert analyze_and_action('sender1', 'hello') == 'analyzed'
+        assert guard.hedged == 1
+        # timed out twice
+        assert analyze_and_action('sender1', 'hello') == 'fallback'
+        assert breaker.state == CLOSED
+        assert analyze_and_action('sender1', 'hello') == 'fallback'
+        assert breaker.state == OPEN
+        assert guard.hedged == 3
+        # rejected fast while open
+        st = time.time()
+        assert analyze_and_action('sender1', 'hello') == 'fallback'
+        assert time.time() - st < 0.05
+        assert len(calls) == 6
+        # trial call closes the breaker
+        time.sleep(0.2)
+        assert analyze_and_action('sender1', 'hello') == 'analyzed'
+        assert breaker.state == CLOSED
+
+
+class EchoFacebook(Facebook):
+    def handle_text_message(self, sender_id, msg_text):
+        self.handled.append(msg_text)
+        return msg_text
+
+
+@pytest.mark.parametrize('fbapp', [
+    dict(messenger=EchoFacebook, transport=StubTransport(),
+         dispatch_workers=workers) for workers in (0, 2)], indirect=True)
+def test_facebook_result_collector(fbapp):
+    fb = fbapp.msgn
+    fb.handled = handled = []
+    items = [('s{}'.format(i % 2), 'm{}'.format(i)) for i in range(4)]
+    with fbapp.app_context():
+        # results are dropped without collector
+        assert fb.handle_msg_data(make_text_data(items)) is None
+        assert sorted(handled) == [text for _, text in items]
+
+        # and streamed to collector in order
+        items = [(s, t + 'c') for s, t in items]
+        results = []
+        assert fb.handle_msg_data(make_text_data(items), results) is\
+            results
+        assert results == [text for _, text in items]
+
+
+def make_prefork_app(path):
+    import os
+
+    class LogFacebook(Facebook):
+        def handle_text_message(self, sender_id, msg_text):
+            with open(path, 'a') as f:
+                f.write('{} {} {}\n'.format(os.getpid(), sender_id, msg_text))
+
+    return make_fbapp(LogFacebook, testing=False, transport=StubTransport())
+
+
+class FullChannel(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def put(self, data, timeout=None):
+        import queue
+        raise queue.Full()
+
+    def close(self):
+        self.channel.close()
+
+
+def test_facebook_prefork(tmpdir):
+    import os
+    import time
+    import signal
+    from functools import partial
+    from chabi.prefork import PreforkPool, HashRing, split_payload
+    from chabi.worker import QueueBusy
+
+    # consistent hash moves only keys of the added node
+    keys = ['user{}'.format(i) for i in range(1000)]
+    ring3, ring4 = HashRing(range(3)), HashRing(range(4))
+    moved = [k for k in keys if ring3.node(k) != ring4.node(k)]
+    assert all(ring4.node(k) == 3 for k in moved)
+    assert 150 < len(moved) < 350
+
+    items = [('s{}'.format(i % 5), 'm{}'.format(i)) for i in range(20)]
+    parts = split_payload(make_text_data(items), lambda key: key[-1])
+    assert sorted(parts) == ['0', '1', '2', '3', '4']
+    assert [m['message']['text'] for m in parts['1']['entry'][0]['messaging']]\
+        == ['m1', 'm6', 'm11', 'm16']
+
+    path = str(tmpdir.join('handled.txt'))
+    pool = PreforkPool(partial(make_prefork_app, path), workers=3,
+                       start_method='fork')
+
+    def wait_handled(n):
+        for _ in range(100):
+            if os.path.isfile(path):
+                with open(path) as f:
+                    lines = [line.split() for line in f]
+                if len(lines) >= n:
+                    return lines
+            time.sleep(0.05)
+        assert False, "not handled"
+
+    down_path = str(tmpdir.join('down.txt'))
+
+    @pool.on_shutdown
+    def log_shutdown(app):
+        with open(down_path, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+
+    with pytest.raises(QueueBusy):
+        pool.put(make_text_data(items))
+    pool.start()
+    ap = make_prefork_app(path)
+    pool.attach(ap)
+    try:
+        with ap.test_client() as c:
+            r = c.post('/facebook',
+                       headers={'Content-Type': 'application/json'},
+                       data=json.dumps(make_text_data(items)))
+            assert 'OK' == r.data.decode('utf8')
+            lines = wait_handled(20)
+            # each sender is handled by one worker, in order
+            for sender in set(s for s, _ in items):
+                mine = [(pid, text) for pid, s, text in lines if s == sender]
+                assert len(set(pid for pid, _ in mine)) == 1
+                assert [text for _, text in mine] ==\
+                    [text for s, text in items if s == sender]
+            assert pool.stats()['routed'] == 20
+
+            # crashed worker is restarted
+            os.kill(pool.procs[0].pid, signal.SIGKILL)
+            for _ in range(50):
+                if pool.stats()['restarts'] == 1:
+                    break
+                time.sleep(0.05)
+            assert pool.stats()['alive'] == 3
+            pool.restart()
+            assert pool.stats()['restarts'] == 4
+            c.post('/facebook', headers={'Content-Type': 'application/json'},
+                   data=json.dumps(make_text_data(items)))
+            assert len(wait_handled(40)) == 40
+
+            # full worker queue is not bypassed by handling inline
+            full = FullChannel(pool.queues[1])
+            pool.queues[1] = full
+            r = c.post('/facebook',
+                       headers={'Content-Type': 'application/json'},
+                       data=json.dumps(make_text_data(items)))
+            assert r.status_code == 503
+            pool.queues[1] = full.channel
+            wait_handled(40 + sum(1 for s, _ in items
+                                  if pool.route(s) != 1))
+            time.sleep(0.2)
+            with open(path) as f:
+                handled = [line.split() for line in f][40:]
+            assert str(os.getpid()) not in set(pid for pid, _, _ in handled)
+            assert all(pool.route(s) != 1 for _, s, _ in handled)
+    finally:
+        pool.stop()
+    assert pool.stats()['alive'] == 0
+    # gracefully exited workers of restart and stop
+    with open(down_path) as f:
+        assert len(f.readlines()) == 6
+
+
+def test_facebook_warm_up(fbdb):
+    from chabi.models import db_session
+    from chabi.vendor.facebook import link_account, unlink_account
+    from chabi.warmup import warm_up
+
+    class WarmTransport(StubTransport):
+        def warm(self, url, connections=1):
+            self.sent.append((url, connections))
+            return connections
+
+    transport = WarmTransport()
+    ap = make_fbapp(transport=transport)
+
+    with db_session:
+        link_account('warm_sender', 'auth_code')
+    try:
+        report = warm_up(ap, connections=3)
+    finally:
+        with db_session:
+            unlink_account('warm_sender')
+
+    assert report.ok
+    assert [step.name for step in report] == ['templates', 'db', 'caches',
+                                              'connections']
+    assert report[0].detail.split()[0] != '0'
+    assert ap.msgn.account_cache.get('warm_sender') is True
+    assert transport.sent == [(ap.msgn.graph_url, 3)]
+    assert 'total' in str(report)
+
+    # failed step doesn't stop others
+    report = warm_up(ap, steps=('connections', 'nonexistent', 'templates'))
+    assert not report.ok
+    assert report[1].error is not None
+    assert report[2].error is None
+
+
+def test_facebook_router():
+    from chabi.router import ACTION, PrefixTrie, on_action, on_quick_reply,\
+        on_postback
+
+    trie = PrefixTrie()
+    trie.insert('order.', 1)
+    trie.insert('order.pizza.', 2)
+    assert len(trie) == 2
+    assert trie.longest('order.pizza.large') == 2
+    assert trie.longest('order.salad') == 1
+    assert trie.longest('ord') is None
+
+    class RoutedHandler(EventHandler):
+        @on_action(*['action{}'.format(i) for i in range(500)])
+        def handle_many(self, sender_id, data):
+            return 'many ' + data['result']['action']
+
+        @on_action('login')
+        def handle_login(self, sender_id, data):
+            return 'custom login'
+
+        @on_quick_reply(prefix='size.')
+        def handle_size(self, sender_id, text, payload):
+            return dict(message=dict(text='size ' + payload.split('.')[1]))
+
+        @on_postback('order')
+        def handle_order(self, msg):
+            return dict(message=dict(text='order ' + msg['payload']))
+
+    ap = make_fbapp(handler=RoutedHandler, transport=StubTransport())
+    evth = ap.evth
+
+    # compiled once per class, keeping base routes
+    assert evth.router is RoutedHandler(ap).router
+    assert evth.router.resolve(ACTION, 'action499') == 'handle_many'
+    assert evth.router.resolve(ACTION, 'login') == 'handle_login'
+    assert evth.router.resolve(ACTION, 'logout') ==\
+        'handle_action_logout_if_needed'
+    assert evth.router.resolve(ACTION, 'unknown') is None
+
+    def action(name, speech=''):
+        return dict(result=dict(action=name, fulfillment=dict(speech=speech)))
+
+    with ap.app_context():
+        assert evth.route_action('action7', 'sender_id', action('action7'))\
+            == 'many action7'
+        assert evth.route_action('login', 'sender_id', action('login')) ==\
+            'custom login'
+        assert evth.route_action('unknown', 'sender_id',
+                                 action('unknown')) is None
+        res = evth.route_action('confirm.order', 'sender_id',
+                                action('confirm.order', 'Sure?'))
+        assert res['message']['quick_replies'][0]['payload'] == 'yes.order'
+
+    def post(mevent):
+        mevent.update(sender=dict(id='sender_id'), recipient=dict(id='page'),
+                      timestamp=next(_timestamps))
+        r = c.post('/facebook', headers={'Content-Type': 'application/json'},
+                   data=json.dumps({'object': 'page',
+                                    'entry': [{'messaging': [mevent]}]}))
+        return json.loads(r.data.decode('utf8'))[0]
+
+    with ap.test_client() as c:
+        assert post(dict(message=dict(text='L', quick_reply=dict(
+            payload='size.large'))))['message']['text'] == 'size large'
+        assert post(dict(message=dict(text='No', quick_reply=dict(
+            payload='no.order')))).startswith('OK.')
+        assert post(dict(postback=dict(payload=json.dumps(dict(
+            type='order', id=1)))))['message']['text']\
+            .startswith('order ')
+        # no route
+        assert post(dict(postback=dict(payload='START_BUTTON')))['message'][
+            'text'] == 'start button pressed'
+
+
+def test_facebook_msg_events():
+    from chabi.events import TEXT, QUICK_REPLY, POSTBACK, ACCOUNT_LINK,\
+        ATTACHMENT, UNKNOWN
+    from chabi.vendor.facebook import parse_msg_event
+
+    def parse(**event):
+        event.update(sender=dict(id='sender_id'), recipient=dict(id='page'),
+                     timestamp=1)
+        return parse_msg_event(event)
+
+    event = parse(message=dict(mid='m1', text='hi'))
+    assert (event.type, event.text, event.key) == (TEXT, 'hi', 'mid:m1')
+    assert not hasattr(event, '__dict__')
+    event = parse(message=dict(mid='m2', text='Yes', quick_reply=dict(
+        payload='yes.order')))
+    assert (event.type, event.text, event.payload) ==\
+        (QUICK_REPLY, 'Yes', 'yes.order')
+    event = parse(postback=dict(payload='{"type": "order", "token": "t"}'))
+    assert (event.type, event.postback_type, event.token, event.key) ==\
+        (POSTBACK, 'order', 't', 'postback:sender_id:1')
+    event = parse(postback=dict(payload='START_BUTTON'))
+    assert (event.postback_type, event.token) == ('START_BUTTON', None)
+    event = parse_msg_event(dict(sender=dict(id='sender_id'),
+                                 recipient=dict(id='page'),
+                                 postback=dict(payload='START_BUTTON')))
+    # no timestamp to tell it from other postbacks
+    assert event.key is None
+    event = parse(account_linking=dict(status='linked',
+                                       authorization_code='code'))
+    assert (event.type, event.linked, event.auth_code) ==\
+        (ACCOUNT_LINK, True, 'code')
+    event = parse(message=dict(mid='m3', attachments=[dict(type='image')]))
+    assert event.type == ATTACHMENT
+    event = parse(delivery=dict(mids=['m1']))
+    assert (event.type, event.key) == (UNKNOWN, None)
+    assert 'sender_id' in repr(event)
@@ -0,0 +1,218 @@
+"""Postback token stores."""
+import time
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from pony import orm
+
+from chabi.models import db, PostbackToken, write_behind
+from chabi.cache import LRUCache
+from chabi.metrics import measure
+from chabi.const import TOKEN_VALID, TOKEN_INVALID, TOKEN_CLOSED,\
+    TOKEN_EXPIRED
+
+
+class TokenStoreBase(object):
+
+    def __init__(self, ttl=86400, closed_ttl=600, purge_every=100):
+        """Init token store.
+
+        Args:
+            ttl (optional): Seconds an issued token stays valid.
+            closed_ttl (optional): Seconds a closed token is kept, to tell it
+                from an invalid one.
+            purge_every (optional): Purge closed and expired tokens once per
+                this number of issues.
+        """
+        self.ttl = ttl
+        self.closed_ttl = closed_ttl
+        self.purge_every = purge_every
+        self._nissue = 0
+
+    def issue(self, value):
+        """Issue a token, purging old tokens once in a while.
+
+        Args:
+            value: Token value.
+
+        Returns:
+            datetime: Issue time.
+        """
+        dt = datetime.fromtimestamp(time.time())
+        self._issue(value, dt)
+        self._nissue += 1
+        if self._nissue % self.purge_every == 0:
+            self.purge()
+        return dt
+
+    def close(self, value):
+        """Validate and close a token.
+
+        Args:
+            value: Token value.
+
+        Returns:
+            str: One of TOKEN_VALID, TOKEN_INVALID, TOKEN_CLOSED and
+                TOKEN_EXPIRED. Token is closed only if it was valid.
+        """
+        raise NotImplementedError()
+
+    def purge(self):
+        """Remove closed and expired tokens.
+
+        Returns:
+            int: Number of removed tokens. None if the purge is deferred.
+        """
+        raise NotImplementedError()
+
+    def _issue(self, value, dt):
+        raise NotImplementedError()
+
+    def _expire_dt(self, ttl):
+        return datetime.fromtimestamp(time.time()) - timedelta(seconds=ttl)
+
+
+def _insert_token(value, issue_dt):
+    PostbackToken(value=value, issue_dt=issue_dt)
+
+
+def _find_token(value):
+    """Return the last issued token of the value."""
+    return PostbackToken.select(lambda t: t.value == value).\
+        order_by(orm.desc(PostbackToken.id)).first()
+
+
+def _close_token(value, close_dt):
+    pt = _find_token(value)
+    if pt is not None:
+        pt.close_dt = close_dt
+
+
+def _close_open_token(token_id, close_dt):
+    """Close the token if still open, atomically across processes. Committed
+    with the caller's DB session.
+
+    Returns:
+        boolean: True if closed by this call.
+    """
+    cur = db.execute('UPDATE {} SET close_dt = $close_dt WHERE id = $token_id'
+                     ' AND close_dt IS NULL'.format(PostbackToken._table_))
+    return cur.rowcount == 1
+
+
+def _purge_tokens(expire_dt, close_dt):
+    return orm.delete(t for t in PostbackToken if t.issue_dt < expire_dt or
+                      t.close_dt is not None and t.close_dt < close_dt)
+
+
+class DBTokenStore(TokenStoreBase):
+    """Token store on `PostbackToken` table. Needs DB session.
+
+    Issues go through `chabi.models.write_behind`, and recently issued tokens
+    are kept in memory, so that they are seen before committed. Closing a
+    committed token is a conditional update in DB, so a token is closed only
+    once across processes sharing the DB. The lock guards only the in-memory
+    tokens, not DB queries.
+    """
+
+    def __init__(self, ttl=86400, closed_ttl=600, purge_every=100,
+                 max_recent=10000):
+        super(DBTokenStore, self).__init__(ttl, closed_ttl, purge_every)
+        # value: [issue time, close time]
+        self._recent = LRUCache(max_recent, ttl)
+        self._lock = threading.Lock()
+
+    def _issue(self, value, dt):
+        self._recent.put(value, [dt, None])
+        write_behind.submit(_insert_token, value, dt)
+
+    def close(self, value):
+        with self._lock:
+            token = self._recent.get(value)
+            if token is not None and token[1] is not None:
+                # closed by this process
+                return TOKEN_CLOSED
+        with measure('db', '', 'postback_token'):
+            pt = _find_token(value)
+        if pt is None:
+            if token is None:
+                return TOKEN_INVALID
+            # issued by this process, not committed yet
+            issue_dt = token[0]
+        else:
+            if pt.close_dt is not None:
+                return TOKEN_CLOSED
+            issue_dt = pt.issue_dt
+        if issue_dt < self._expire_dt(self.ttl):
+            return TOKEN_EXPIRED
+        # set done time
+        close_dt = datetime.fromtimestamp(time.time())
+        if pt is None:
+            with self._lock:
+                if token[1] is not None:
+                    # closed by another thread meanwhile
+                    return TOKEN_CLOSED
+                token[1] = close_dt
+                self._recent.put(value, token)
+            write_behind.submit(_close_token, value, close_dt)
+        else:
+            with measure('db', '', 'postback_token'):
+                if not _close_open_token(pt.id, close_dt):
+                    # closed by another process meanwhile
+                    return TOKEN_CLOSED
+            if token is not None:
+                with self._lock:
+                    token[1] = close_dt
+                    self._recent.put(value, token)
+        return TOKEN_VALID
+
+    def purge(self):
+        return write_behind.submit(_purge_tokens, self._expire_dt(self.ttl),
+                                   self._expire_dt(self.closed_ttl))
+
+    def prepare_queries(self):
+        """Translate token lookup query and open DB connection ahead of
+        requests. Needs DB session."""
+        _find_token('')
+
+
+class MemoryTokenStore(TokenStoreBase):
+    """In-memory token store for single process deployment."""
+
+    def __init__(self, ttl=86400, closed_ttl=600, purge_every=100):
+        super(MemoryTokenStore, self).__init__(ttl, closed_ttl, purge_every)
+        # value: [issue time, close time]
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def _issue(self, value, dt):
+        with self._lock:
+            self._tokens.pop(value, None)
+            self._tokens[value] = [time.time(), None]
+
+    def close(self, value):
+        with self._lock:
+            token = self._tokens.get(value)
+            if token is None:
+                return TOKEN_INVALID
+            issue_ts, close_ts = token
+            if close_ts is not None:
+                return TOKEN_CLOSED
+            if issue_ts < time.time() - self.ttl:
+                return TOKEN_EXPIRED
+            token[1] = time.time()
+            return TOKEN_VALID
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            old = [value for value, (issue_ts, close_ts) in
+                   self._tokens.items() if issue_ts < now - self.ttl or
+                   close_ts is not None and close_ts < now - self.closed_ttl]
+            for value in old:
+                del self._tokens[value]
+        return len(old)
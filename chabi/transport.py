@@ -0,0 +1,99 @@
+"""HTTP transport with persistent connection pool."""
+import threading
+
+
+def make_retry(max_retries, backoff_factor, status_forcelist):
+    """Make retry policy for POST requests.
+
+    Note:
+        Messages are not idempotent, so read errors are never retried.
+        Connection errors are safe to retry because request was not sent.
+    """
+    from urllib3.util.retry import Retry
+    kwargs = dict(total=max_retries, connect=max_retries, read=0,
+                  status=max_retries if status_forcelist else 0,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=status_forcelist, raise_on_status=False)
+    methods = frozenset(['GET', 'POST'])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+
+class HTTPTransport(object):
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 max_retries=2, backoff_factor=0.2, status_forcelist=(),
+                 session=None):
+        """Init HTTP transport.
+
+        Args:
+            pool_size (optional): Maximum number of kept-alive connections per
+                host.
+            connect_timeout (optional): Connect timeout in seconds.
+            read_timeout (optional): Read timeout in seconds.
+            max_retries (optional): Maximum number of retries on connection
+                error (and on `status_forcelist` status).
+            backoff_factor (optional): Backoff factor between retries.
+            status_forcelist (optional): HTTP status codes to retry.
+            session (optional): `requests.Session` to use. Useful to mount
+                adapters for a local stub server.
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        if session is None:
+            # requests is imported by the first transport, not on import
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            retry = make_retry(max_retries, backoff_factor, status_forcelist)
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size, max_retries=retry)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+    def post(self, url, params=None, headers=None, data=None):
+        """Send POST request over pooled connection.
+
+        Returns:
+            requests.Response: Response of the request.
+        """
+        return self.session.post(url, params=params, headers=headers,
+                                 data=data, timeout=self.timeout)
+
+    def warm(self, url, connections=1):
+        """Open pooled connections to the host of url ahead of requests.
+
+        Sends concurrent HEAD requests, whose responses don't matter.
+
+        Args:
+            url: URL of the endpoint.
+            connections (optional): Number of connections to open, up to pool
+                size.
+
+        Returns:
+            int: Number of requests which got a response.
+        """
+        connections = min(connections, self.pool_size)
+        done = []
+
+        def head():
+            try:
+                self.session.head(url, timeout=self.timeout)
+            except Exception:
+                return
+            done.append(True)
+
+        threads = [threading.Thread(target=head) for _ in range(connections)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        return len(done)
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
@@ -1,14 +1,110 @@
 import os
+import json
+import atexit
 import logging
 from logging import Formatter
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler,\
+    QueueListener
 import random
 import string
 import hashlib
 
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+# `extra` for payload dump records, which can be sampled.
+PAYLOAD_LOG = dict(category='payload')
+
+
+class LazyJSON(object):
+    """Log argument which serializes data to JSON only when emitted."""
+
+    __slots__ = ('data', 'indent')
+
+    def __init__(self, data, indent=None):
+        self.data = data
+        self.indent = indent
+
+    def __str__(self):
+        return json.dumps(self.data, indent=self.indent)
+
+
+class NullCollector(object):
+    """Result collector which discards results, for when nobody reads
+    them."""
+
+    __slots__ = ()
+
+    def append(self, res):
+        pass
+
+
+NULL_COLLECTOR = NullCollector()
+
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rates):
+        """Init sampling filter.
+
+        Args:
+            rates: Dict of record category to ratio of records to pass. Records
+                without category or of unknown category always pass.
+        """
+        super(SamplingFilter, self).__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'category', None))
+        return rate is None or random.random() < rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue handler which defers formatting to the listener thread.
+
+    Note:
+        Log arguments must not be mutated after logging.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            # don't keep traceback objects alive in queue
+            record.exc_text = Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogListener(QueueListener):
+    """Queue listener, which can be stopped more than once."""
+
+    def stop(self):
+        if self._thread is not None:
+            super(LogListener, self).stop()
+
 
 def init_logger(app, filename, log_level, werkzeug_log=True, max_bytes=1048576,
-                backup_cnt=10):
+                backup_cnt=10, queued=False, sampling=None):
+    """Init file logger of the app.
+
+    Args:
+        app: A Flask app instance.
+        filename: Log file name under `logs` directory.
+        log_level: Log level of file handler.
+        werkzeug_log (optional): Whether to log werkzeug messages.
+        max_bytes (optional): Maximum bytes of a log file.
+        backup_cnt (optional): Number of rotated log files.
+        queued (optional): If True, records are formatted and written by a
+            background thread.
+        sampling (optional): Dict of record category to ratio of records to
+            write, e.g. `{'payload': 0.1}`.
+
+    Returns:
+        LogListener: Listener of queued logging, also set as
+            `app.log_listener`. None if not queued.
+    """
     formatter = Formatter('%(asctime)s %(pathname)s:%(lineno)d %(levelname)s -'
                           ' %(message)s', '%Y-%m-%d %H:%M:%S.%03d')
 
@@ -19,7 +115,23 @@ def init_logger(app, filename, log_level, werkzeug_log=True, max_bytes=1048576,
                                   maxBytes=max_bytes, backupCount=backup_cnt)
     handler.setFormatter(formatter)
     handler.setLevel(log_level)
-    app.logger.addHandler(handler)
+    if not queued:
+        if sampling:
+            handler.addFilter(SamplingFilter(sampling))
+        app.logger.addHandler(handler)
+        return
+
+    qhandler = LazyQueueHandler(queue.Queue())
+    qhandler.setLevel(log_level)
+    if sampling:
+        qhandler.addFilter(SamplingFilter(sampling))
+    listener = LogListener(qhandler.queue, handler,
+                           respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    app.log_listener = listener
+    app.logger.addHandler(qhandler)
+    return listener
 
 
 def generate_random_token():
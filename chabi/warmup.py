@@ -0,0 +1,134 @@
+"""Warm-up of templates, database, caches and connections before serving."""
+import logging
+from collections import namedtuple
+from timeit import default_timer
+
+from chabi.metrics import REGISTRY
+
+
+WARMUP_SECONDS = REGISTRY.gauge(
+    'chabi_warmup_seconds', 'Seconds taken by each warm-up step.', ('step',))
+
+DEFAULT_STEPS = ('templates', 'db', 'caches', 'connections')
+
+WarmupStep = namedtuple('WarmupStep', ['name', 'seconds', 'detail', 'error'])
+
+
+class WarmupReport(list):
+    """List of `WarmupStep`."""
+
+    @property
+    def seconds(self):
+        return sum(step.seconds for step in self)
+
+    @property
+    def ok(self):
+        return all(step.error is None for step in self)
+
+    def __str__(self):
+        lines = ['{:<12}{:>9.1f} ms  {}'.format(
+            step.name, step.seconds * 1000,
+            step.detail if step.error is None else
+            'failed: {}'.format(step.error)) for step in self]
+        lines.append('{:<12}{:>9.1f} ms'.format('total', self.seconds * 1000))
+        return '\n'.join(lines)
+
+
+def _components(app):
+    return [comp for comp in (getattr(app, 'msgn', None),
+                              getattr(app, 'chatbot', None),
+                              getattr(app, 'evth', None)) if comp is not None]
+
+
+def warm_templates(app, **options):
+    """Compile all templates of the app, including vendor ones."""
+    env = app.jinja_env
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return '{} templates'.format(len(names))
+
+
+def warm_db(app, **options):
+    """Open DB connection and translate ORM queries."""
+    from chabi.models import db, db_session
+    if db.provider is None:
+        return 'not bound'
+    prepared = 0
+    with db_session:
+        for comp in _components(app):
+            prepare = getattr(comp, 'prepare_queries', None)
+            if prepare is not None:
+                prepare()
+                prepared += 1
+    return '{} components'.format(prepared)
+
+
+def warm_caches(app, prime_accounts=1000, **options):
+    """Load cacheable state from DB."""
+    from chabi.models import db, db_session
+    if db.provider is None:
+        return 'not bound'
+    loaded = 0
+    with db_session:
+        for comp in _components(app):
+            prime = getattr(comp, 'prime_caches', None)
+            if prime is not None:
+                loaded += prime(prime_accounts)
+    return '{} entries'.format(loaded)
+
+
+def warm_connections(app, connections=2, **options):
+    """Open pooled connections to remote endpoints."""
+    opened = []
+    for comp in _components(app):
+        for transport, url in comp.endpoints():
+            if not hasattr(transport, 'warm'):
+                continue
+            opened.append('{} {}/{}'.format(
+                url, transport.warm(url, connections), connections))
+    return ', '.join(opened) or 'no endpoints'
+
+
+STEPS = dict(
+    templates=warm_templates,
+    db=warm_db,
+    caches=warm_caches,
+    connections=warm_connections,
+)
+
+
+def warm_up(app, steps=DEFAULT_STEPS, connections=2, prime_accounts=1000):
+    """Warm up the app before it accepts traffic.
+
+    Steps are best effort. A failed step is logged and reported, and doesn't
+    stop the others.
+
+    Args:
+        app: A Flask app instance with messenger, chatbot and event handler.
+        steps (optional): Names of steps to run in order, of `templates`,
+            `db`, `caches` and `connections`.
+        connections (optional): Number of connections to open per endpoint.
+        prime_accounts (optional): Maximum number of linked accounts to load
+            into account link cache.
+
+    Returns:
+        WarmupReport: Time taken by each step.
+    """
+    logger = getattr(app, 'logger', logging.getLogger(__name__))
+    report = WarmupReport()
+    with app.app_context():
+        for name in steps:
+            st = default_timer()
+            detail = error = None
+            try:
+                detail = STEPS[name](app, connections=connections,
+                                     prime_accounts=prime_accounts)
+            except Exception as e:
+                logger.exception("Fail to warm up %s", name)
+                error = str(e) or e.__class__.__name__
+            elapsed = default_timer() - st
+            WARMUP_SECONDS.set(elapsed, (name,))
+            report.append(WarmupStep(name, elapsed, detail, error))
+    logger.info("Warmed up in %.1f ms:\n%s", report.seconds * 1000, report)
+    return report
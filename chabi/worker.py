@@ -0,0 +1,150 @@
+"""Background processing queue for webhook payloads."""
+import zlib
+import atexit
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+_STOP = object()
+
+
+class QueueBusy(Exception):
+    """Payload can't be queued now, and must not be handled by this process
+    either. The webhook answers 503, so that the messenger redelivers it."""
+
+
+class WebhookQueue(object):
+
+    def __init__(self, app, handler, num_workers=4, maxsize=1000,
+                 name='chabi-webhook', split=None):
+        """Init webhook queue.
+
+        Workers are started lazily on first `put`, so that forking servers
+        don't lose them when they fork after app creation.
+
+        Without `split`, workers share one queue, so payloads of a sender can
+        be handled concurrently and out of order. With `split`, each worker
+        has its own queue, and parts of payloads are routed by hash of their
+        key(e.g. sender), so that a key is always handled in order by one
+        worker.
+
+        Args:
+            app: A Flask app instance.
+            handler: Callable to process a payload. Called within app context
+                and DB session in a worker thread.
+            num_workers (optional): Number of worker threads.
+            maxsize (optional): Maximum number of pending payloads of a
+                queue.
+            name (optional): Prefix of worker thread names.
+            split (optional): Callable of `(data, route)` splitting a payload
+                into dict of route to part, by `route(key)` of each item, e.g.
+                `chabi.vendor.facebook.split_payload`.
+        """
+        self.app = app
+        self.logger = app.logger
+        self.handler = handler
+        self.num_workers = num_workers
+        self.name = name
+        self.split = split
+        nqueue = num_workers if split is not None else 1
+        self._queues = [queue.Queue(maxsize) for _ in range(nqueue)]
+        self._workers = []
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    @property
+    def pending(self):
+        """Approximate number of payloads waiting for a worker."""
+        return sum(q.qsize() for q in self._queues)
+
+    def route(self, key):
+        """Return index of the worker queue of the key."""
+        return zlib.crc32(str(key).encode('utf8')) % len(self._queues)
+
+    def start(self):
+        """Start worker threads if not started yet."""
+        with self._lock:
+            if self._workers or self._stopped:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._run, args=(
+                    self._queues[i % len(self._queues)],),
+                    name='{}-{}'.format(self.name, i))
+                t.daemon = True
+                t.start()
+                self._workers.append(t)
+            atexit.register(self.stop)
+
+    def put(self, data):
+        """Enqueue payload for background processing.
+
+        Args:
+            data: Payload to process.
+
+        Returns:
+            boolean: True if enqueued, False if stopped, or the shared queue
+                is full.
+
+        Raises:
+            QueueBusy: If a worker queue of split payload is full. Handling
+                the part inline could overtake its queued parts. Parts
+                routed to other workers are kept, and their events are
+                dropped as duplicates when the messenger redelivers the
+                payload.
+        """
+        if self._stopped:
+            return False
+        self.start()
+        if self.split is None:
+            try:
+                self._queues[0].put_nowait(data)
+            except queue.Full:
+                self.logger.warning("webhook queue is full (%s)",
+                                    self._queues[0].maxsize)
+                return False
+            return True
+
+        busy = []
+        for idx, part in self.split(data, self.route).items():
+            try:
+                self._queues[idx].put_nowait(part)
+            except queue.Full:
+                busy.append(idx)
+        if busy:
+            raise QueueBusy("webhook queue {} is full ({})".format(
+                ', '.join(str(idx) for idx in busy), self._queues[0].maxsize))
+        return True
+
+    def stop(self, timeout=None):
+        """Stop accepting payloads, then drain the queue and join workers.
+
+        Args:
+            timeout (optional): Seconds to wait for each worker.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            workers = self._workers
+        for i in range(len(workers)):
+            self._queues[i % len(self._queues)].put(_STOP)
+        for t in workers:
+            t.join(timeout)
+
+    def _run(self, wqueue):
+        from chabi.models import db_session
+        while True:
+            data = wqueue.get()
+            try:
+                if data is _STOP:
+                    return
+                with self.app.app_context(), db_session:
+                    self.handler(data)
+            except Exception:
+                self.logger.exception("Fail to handle queued payload")
+            finally:
+                wqueue.task_done()